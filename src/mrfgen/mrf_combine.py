@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Combines the partial MRFs of a distributed mrfgen build into one MRF.
+#
+# Each node runs mrfgen --partition K/N with the same configuration and builds
+# a partial MRF of the same geometry from its spatial share of the granules.
+# The partial data files are concatenated (the empty tile that seeds each of
+# them is kept once), the index records are shifted by the offset of their data
+# file and the partial indexes are combined with vectorized NumPy operations.
+# Where more than one partial has a tile, the later partial on the command line
+# wins (--precedence last) or the earlier one (--precedence first). The
+# overviews are then built once from the combined base level, and with --layout
+# the tiles are rewritten level by level in index, Hilbert or Morton order.
+#
+# Example:
+#
+#  mrf_combine.py -o sst2019231_.mrf -p 1234 sst2019231__part1of4.mrf sst2019231__part2of4.mrf \
+#                 sst2019231__part3of4.mrf sst2019231__part4of4.mrf
+#
+
+import argparse
+import collections
+import os
+import shutil
+import sys
+import xml.dom.minidom
+import numpy as np
+from mrf_compact import compact_mrf
+from mrf_index import LAYOUTS, index_name, open_index, read_layout, write_index
+from mrf_pyramid import build_overviews, sampling_method, set_mp_safe
+
+# data file extensions written by mrfgen and vectorgen
+DATA_EXTENSIONS = ['.ppg', '.pjg', '.ptf', '.lrc', '.pvt']
+
+# index records combined per step
+CHUNK_RECORDS = 1 << 22
+
+# bytes copied per read/write
+COPY_SIZE = 64 << 20
+
+CombineReport = collections.namedtuple('CombineReport', ['partials', 'tiles', 'overlaps', 'data_bytes',
+                                                         'overview_blocks'])
+
+
+def data_name(mrf_filename):
+    """
+    Returns the data file of an MRF: its DataFile element, or the file next to the header with a data file extension
+    """
+    dom = xml.dom.minidom.parse(mrf_filename)
+    data_files = dom.getElementsByTagName('DataFile')
+    if data_files and data_files[0].firstChild is not None:
+        return os.path.join(os.path.dirname(mrf_filename), data_files[0].firstChild.nodeValue.strip())
+    bname, ext = os.path.splitext(mrf_filename)
+    for ext in DATA_EXTENSIONS:
+        if os.path.isfile(bname + ext):
+            return bname + ext
+    raise IOError("No data file found for {0}".format(mrf_filename))
+
+
+def compression(mrf_filename):
+    """
+    Returns the Compression of an MRF header, e.g. PPNG, or None if it isn't set
+    """
+    dom = xml.dom.minidom.parse(mrf_filename)
+    elements = dom.getElementsByTagName('Compression')
+    if elements and elements[0].firstChild is not None:
+        return elements[0].firstChild.nodeValue.strip()
+    return None
+
+
+def write_header(partial_mrf, output_mrf):
+    # the data and index files of the output are the ones next to its header
+    dom = xml.dom.minidom.parse(partial_mrf)
+    for tag in ('DataFile', 'IndexFile'):
+        for element in dom.getElementsByTagName(tag):
+            element.parentNode.removeChild(element)
+    with open(output_mrf, 'w') as f:
+        dom.writexml(f)
+
+
+def check_partials(partials):
+    """
+    Returns the layout shared by all the partial MRFs; raises ValueError if they don't have the same geometry
+    """
+    layout = read_layout(partials[0])
+    for partial in partials[1:]:
+        if read_layout(partial) != layout:
+            raise ValueError("{0} does not have the same size, page size and overviews as {1}".format(partial, partials[0]))
+    count = layout[0][-1].start + layout[0][-1].count
+    for partial in partials:
+        records = os.path.getsize(index_name(partial)) // 16
+        if records != count:
+            raise ValueError("{0} has {1} index records, expected {2}".format(index_name(partial), records, count))
+    return layout
+
+
+def combine_records(indexes, bases, prefix, precedence, start, stop):
+    """
+    Returns the combined records for index positions start to stop and the number of positions with more than one tile
+    Arguments:
+        indexes -- Memory mapped partial indexes
+        bases -- Offset of each partial's data (after its prefix) in the combined data file, minus the prefix
+        prefix -- Number of leading bytes of each data file holding the seeded empty tile
+        precedence -- 'last' or 'first': which partial wins where several have a tile
+        start, stop -- Range of index positions
+    """
+    offsets = np.stack([index['offset'][start:stop].astype(np.int64) for index in indexes])
+    sizes = np.stack([index['size'][start:stop].astype(np.int64) for index in indexes])
+    # records pointing into the prefix are the seeded empty tile, which any real tile replaces
+    filler = (sizes > 0) & (offsets + sizes <= prefix)
+    real = (sizes > 0) & ~filler
+    shifted = np.where(filler, offsets, offsets + np.asarray(bases, dtype=np.int64)[:, np.newaxis])
+
+    if precedence == 'first':
+        winner = np.argmax(real, axis=0)
+    else:
+        winner = len(indexes) - 1 - np.argmax(real[::-1], axis=0)
+    # positions without a real tile keep the empty tile of any partial that has one
+    no_tile = ~real.any(axis=0)
+    winner[no_tile] = np.argmax(filler, axis=0)[no_tile]
+
+    columns = np.arange(stop - start)
+    records = np.zeros(stop - start, dtype=indexes[0].dtype)
+    records['offset'] = np.where(sizes[winner, columns] > 0, shifted[winner, columns], 0)
+    records['size'] = sizes[winner, columns]
+    return records, int(np.count_nonzero(real.sum(axis=0) > 1))
+
+
+def combine_mrfs(partials, output_mrf, prefix=0, precedence='last', sampling='nearest', workers=1, layout='file'):
+    """
+    Combines partial MRFs with the same geometry into output_mrf and builds its overviews. Returns a CombineReport.
+    Arguments:
+        partials -- Partial MRF headers, lowest precedence first with precedence 'last'
+        output_mrf -- The MRF header to create; its data and index files are written next to it
+        prefix -- Number of leading bytes of each partial data file holding the seeded empty tile, kept once
+        precedence -- 'last' or 'first': which partial wins where several have a tile
+        sampling -- Overview resampling (avg, nearest or mode), or None to leave the overviews unbuilt; avg is
+                    replaced by mode for PPNG, as mrfgen does
+        workers -- Number of worker processes for the overviews; the MRF is marked mp_safe while they write
+        layout -- 'file' to leave the tiles in partial order, or one of mrf_index.LAYOUTS to rewrite them in that order
+    """
+    levels, depth, band_pages = check_partials(partials)
+    data_files = [data_name(partial) for partial in partials]
+    output_data = os.path.splitext(output_mrf)[0] + os.path.splitext(data_files[0])[1]
+    write_header(partials[0], output_mrf)
+
+    # the first prefix bytes are copied once; every partial's remaining data follows the previous one
+    bases = []
+    with open(output_data, 'wb') as dst:
+        for i, data_file in enumerate(data_files):
+            with open(data_file, 'rb') as src:
+                if i == 0:
+                    dst.write(src.read(prefix))
+                else:
+                    src.seek(prefix)
+                bases.append(dst.tell() - prefix)
+                shutil.copyfileobj(src, dst, COPY_SIZE)
+        data_bytes = dst.tell()
+
+    indexes = [open_index(index_name(partial)) for partial in partials]
+    count = len(indexes[0])
+    combined = np.zeros(count, dtype=indexes[0].dtype)
+    overlaps = 0
+    for start in range(0, count, CHUNK_RECORDS):
+        stop = min(start + CHUNK_RECORDS, count)
+        combined[start:stop], chunk_overlaps = combine_records(indexes, bases, prefix, precedence, start, stop)
+        overlaps += chunk_overlaps
+    indexes = None
+    write_index(index_name(output_mrf), combined)
+
+    overview_blocks = 0
+    if sampling is not None and len(levels) > 1:
+        if compression(output_mrf) == 'PPNG' and sampling_method(sampling) == 'avg':
+            sampling = 'mode' # averaging palette indices would produce unrelated colors
+        marked = workers > 1 and set_mp_safe(output_mrf)
+        try:
+            overview_blocks = build_overviews(output_mrf, sampling, workers=workers)
+        finally:
+            if marked:
+                set_mp_safe(output_mrf, False)
+    tiles = int(np.count_nonzero(combined['size'][:levels[0].count]))
+    if layout != 'file':
+        compact_mrf(output_data, prefix, layout, output_mrf)
+        data_bytes = os.path.getsize(output_data)
+    return CombineReport(len(partials), tiles, overlaps, data_bytes, overview_blocks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Combines the partial MRFs of a distributed mrfgen build.')
+    parser.add_argument('partials', nargs='+', help='Partial MRF headers (from mrfgen --partition)')
+    parser.add_argument('-o', '--output', dest='output', required=True,
+                        help='Output MRF header; its data and index files are written next to it')
+    parser.add_argument('-p', '--prefix', dest='prefix', type=int, default=0,
+                        help='Size of the empty tile that seeds each partial data file (mrf_empty_tile_filename).  Default: 0')
+    parser.add_argument('--precedence', dest='precedence', choices=['last', 'first'], default='last',
+                        help='Which partial wins where more than one has a tile.  Default: last')
+    parser.add_argument('-r', '--resampling', dest='resampling', default='nearest',
+                        help='Overview resampling: average (mode for PPNG), nearest or mode, or none to skip the '
+                             'overviews; use the overview_resampling of the mrfgen configuration.  Default: nearest')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Number of worker processes for the overviews.  Default: 1')
+    parser.add_argument('-l', '--layout', dest='layout', choices=['file'] + LAYOUTS, default='file',
+                        help='Order of the tiles in the combined data file: file (partial by partial), index (row-major), '
+                             'hilbert or morton.  Default: file')
+    args = parser.parse_args()
+
+    sampling = None
+    if args.resampling.lower() != 'none':
+        sampling = sampling_method(args.resampling)
+        if sampling is None:
+            parser.error('Unsupported resampling: {0}'.format(args.resampling))
+    try:
+        report = combine_mrfs(args.partials, args.output, args.prefix, args.precedence, sampling, args.workers,
+                              args.layout)
+    except (IOError, ValueError, RuntimeError) as e:
+        print("Unable to combine MRFs: {0}".format(e))
+        sys.exit(1)
+    print("Combined {0} partial MRFs into {1}: {2} tiles, {3} positions with more than one tile, {4} data bytes, "
+          "{5} overview blocks".format(report.partials, args.output, report.tiles, report.overlaps, report.data_bytes,
+                                       report.overview_blocks))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# In-process compaction of MRF data files, replacing mrf_clean.py.
+#
+# The index is memory mapped with mrf_index.py as an array of (offset, size) records.
+# Referenced byte ranges are merged into live spans (tiles shared by several
+# records, as written by mrf_dedup.py, are kept once) and the dead bytes between
+# them are squeezed out. By default the spans are slid down inside the data file
+# in file order with large sequential reads and writes, so no second copy of the
+# data file is needed; the new index then replaces the old one. With --layout,
+# tiles are instead copied to a new data file level by level, each level in
+# index (row-major) order like mrf_clean.py does, or along a Hilbert or Morton
+# curve so that tiles that are close on the map are also close in the file.
+#
+# Example:
+#
+#  mrf_compact.py -n output.ppg
+#  mrf_compact.py output.ppg
+#  mrf_compact.py --layout hilbert output.ppg
+#
+
+import argparse
+import collections
+import os
+import sys
+import numpy as np
+from mrf_index import LAYOUTS, index_name, layout_order, open_index, read_layout, write_index
+
+# bytes moved per read/write
+CHUNK_SIZE = 64 << 20
+
+CompactReport = collections.namedtuple('CompactReport', ['tiles', 'file_bytes', 'live_bytes', 'dead_bytes'])
+
+
+def compacting_marker(data_filename):
+    """
+    Returns the name of the file that exists while a data file is being compacted in place
+    """
+    bname, ext = os.path.splitext(data_filename)
+    return bname + os.extsep + "compacting"
+
+
+def live_spans(idx, prefix=0):
+    """
+    Returns the sorted start and end offsets of the non-overlapping byte ranges referenced by an index
+    Arguments:
+        idx -- Index records, as returned by mrf_index.open_index
+        prefix -- Number of leading bytes that are always live (e.g. the empty tile that seeded the data file)
+    """
+    used = idx['size'] > 0
+    starts = idx['offset'][used].astype(np.int64)
+    ends = starts + idx['size'][used].astype(np.int64)
+    if prefix > 0:
+        starts = np.append(starts, 0)
+        ends = np.append(ends, prefix)
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    # a span begins wherever a range starts past the end of everything before it; touching ranges are joined
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1]
+    heads = np.nonzero(first)[0]
+    return starts[heads], np.maximum.reduceat(ends, heads)
+
+
+def measure_garbage(data_filename, prefix=0):
+    """
+    Returns a CompactReport with the live and dead (unreferenced) bytes of an MRF data file
+    Arguments:
+        data_filename -- The MRF data file (.ppg, .pjg, ...); its index is the .idx file next to it
+        prefix -- Number of leading bytes that are always live
+    """
+    idx = open_index(index_name(data_filename))
+    starts, ends = live_spans(idx, prefix)
+    file_bytes = os.path.getsize(data_filename)
+    live_bytes = int((np.minimum(ends, file_bytes) - np.minimum(starts, file_bytes)).sum())
+    return CompactReport(int(np.count_nonzero(idx['size'])), file_bytes, live_bytes, file_bytes - live_bytes)
+
+
+def format_compaction(report):
+    return ("{0} tiles: {1} live bytes, {2} dead bytes ({3:.1f}%) of {4}".
+            format(report.tiles, report.live_bytes, report.dead_bytes,
+                   100.0 * report.dead_bytes / report.file_bytes if report.file_bytes else 0, report.file_bytes))
+
+
+def compact_in_place(data_filename, starts, ends):
+    """
+    Slides the live spans of a data file down over the dead bytes, in file order, and truncates it.
+    Returns the new offset of each span.
+    """
+    lengths = ends - starts
+    new_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    marker = compacting_marker(data_filename)
+    open(marker, 'w').close()
+    with open(data_filename, 'r+b', buffering=0) as f:
+        # every span moves down, so the bytes still to be read are never overwritten
+        for start, end, position in zip(starts.tolist(), ends.tolist(), new_starts.tolist()):
+            offset = start
+            while offset < end and offset != position:
+                f.seek(offset)
+                data = f.read(min(CHUNK_SIZE, end - offset))
+                if not data:
+                    break
+                f.seek(position)
+                f.write(data)
+                offset += len(data)
+                position += len(data)
+        f.truncate(int(lengths.sum()))
+        os.fsync(f.fileno())
+    return new_starts
+
+
+def compact_ordered(data_filename, idx, prefix, order):
+    """
+    Copies the referenced tiles to a new data file in the given record order and renames it over the old one.
+    Returns the new index, which the caller writes before removing the compacting marker.
+    Arguments:
+        data_filename -- The MRF data file
+        idx -- Index records
+        prefix -- Number of leading bytes to keep as they are
+        order -- Record numbers in the order their tiles are written, e.g. from mrf_index.layout_order
+    """
+    out_idx = np.array(idx)
+    used = order[idx['size'][order] > 0]
+    records = np.stack((idx['offset'][used].astype(np.int64), idx['size'][used].astype(np.int64)), axis=1)
+    if len(records) == 0:
+        records = records.reshape(0, 2)
+    # records pointing at the same tile (see mrf_dedup.py) share one copy, placed where the first one in order is
+    unique, first, inverse = np.unique(records, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    new_offsets = np.zeros(len(unique), dtype=np.int64)
+
+    bname, ext = os.path.splitext(data_filename)
+    target_path = bname + os.extsep + "tmp" + ext
+    with open(data_filename, 'rb') as src, open(target_path, 'wb', buffering=CHUNK_SIZE) as dst:
+        if prefix > 0:
+            dst.write(src.read(prefix))
+        position = prefix
+        for u in np.argsort(first, kind='stable').tolist():
+            offset, size = int(unique[u, 0]), int(unique[u, 1])
+            if offset + size <= prefix: # already in the bytes that were kept
+                new_offsets[u] = offset
+                continue
+            src.seek(offset)
+            dst.write(src.read(size))
+            new_offsets[u] = position
+            position += size
+        dst.flush()
+        os.fsync(dst.fileno())
+    out_idx['offset'][used] = new_offsets[inverse]
+    # the old index doesn't match the new data file until the new index is written
+    open(compacting_marker(data_filename), 'w').close()
+    os.rename(target_path, data_filename)
+    return out_idx
+
+
+def compact_mrf(data_filename, prefix=0, layout='file', mrf_filename=None):
+    """
+    Removes the unreferenced bytes from an MRF data file and rewrites its index. Returns the CompactReport
+    measured before compacting.
+    Arguments:
+        data_filename -- The MRF data file (.ppg, .pjg, ...); its index is the .idx file next to it
+        prefix -- Number of leading bytes to keep as they are (e.g. an empty tile that seeded the data file)
+        layout -- 'file' to compact in place, keeping the order of the tiles in the file, or one of
+                  mrf_index.LAYOUTS to copy the tiles to a new data file in that order
+        mrf_filename -- The MRF header, needed for the other layouts; defaults to the .mrf next to the data file
+    """
+    idx_filename = index_name(data_filename)
+    report = measure_garbage(data_filename, prefix)
+    if report.dead_bytes == 0 and layout == 'file':
+        return report
+
+    idx = np.array(open_index(idx_filename)) # a copy; the mapped file is replaced below
+    if layout != 'file':
+        if mrf_filename is None:
+            mrf_filename = os.path.splitext(data_filename)[0] + '.mrf'
+        order = layout_order(*read_layout(mrf_filename), layout=layout)
+        # records beyond the geometry of the header, if any, follow in index order
+        order = np.concatenate((order[order < len(idx)], np.arange(len(order), len(idx), dtype=np.int64)))
+        write_index(idx_filename, compact_ordered(data_filename, idx, prefix, order))
+        os.remove(compacting_marker(data_filename))
+        return report
+
+    starts, ends = live_spans(idx, prefix)
+    new_starts = compact_in_place(data_filename, starts, ends)
+    used = np.nonzero(idx['size'])[0]
+    offsets = idx['offset'][used].astype(np.int64)
+    span = np.searchsorted(starts, offsets, side='right') - 1
+    idx['offset'][used] = new_starts[span] + (offsets - starts[span])
+    write_index(idx_filename, idx)
+    os.remove(compacting_marker(data_filename))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Removes unreferenced bytes from an MRF data file.')
+    parser.add_argument('data_file', help='MRF data file, e.g. output.ppg; the .idx next to it is updated too')
+    parser.add_argument('-p', '--prefix', dest='prefix', type=int, default=0,
+                        help='Leading bytes of the data file to keep as they are, e.g. the empty tile.  Default: 0')
+    parser.add_argument('-l', '--layout', dest='layout', choices=['file'] + LAYOUTS, default='file',
+                        help='Order of the tiles: file (compact in place), index (row-major), hilbert or morton.  '
+                             'Default: file')
+    parser.add_argument('-m', '--mrf', dest='mrf',
+                        help='MRF header, for the index, hilbert and morton layouts.  Default: the .mrf next to the data file')
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true',
+                        help='Only report the live and dead bytes')
+    args = parser.parse_args()
+
+    if args.dry_run:
+        report = measure_garbage(args.data_file, args.prefix)
+    else:
+        report = compact_mrf(args.data_file, args.prefix, args.layout, args.mrf)
+    print(format_compaction(report))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Content-hash deduplication of MRF data files.
+#
+# Copies the tiles referenced by an MRF index into a new data file, like
+# mrf_clean.py, but stores byte-identical encoded tiles (open ocean, polar night,
+# fill colors) only once and points every index record that used one of them at
+# the single stored copy. Unreferenced bytes are dropped at the same time.
+#
+# Example:
+#
+#  mrf_dedup.py output.ppg
+#  mrf_dedup.py -n output.ppg
+#
+
+import argparse
+import collections
+import hashlib
+import os
+import sys
+import numpy as np
+from mrf_compact import compacting_marker
+from mrf_index import index_name, open_index, write_index
+
+# bytes_deduplicated is the size of the stored copies that were dropped because an identical tile was kept elsewhere
+DedupReport = collections.namedtuple('DedupReport', ['tiles', 'unique_tiles', 'bytes_before', 'bytes_after',
+                                                     'bytes_deduplicated'])
+
+
+def format_report(report):
+    return ("{0} tiles, {1} unique: {2} bytes deduplicated, data file {3} -> {4} bytes".
+            format(report.tiles, report.unique_tiles, report.bytes_deduplicated, report.bytes_before, report.bytes_after))
+
+
+def dedup_mrf(data_filename, target_path=None, prefix=0, dry_run=False):
+    """
+    Writes a compacted copy of an MRF data file and index in which identical tiles are stored once.
+    Tiles are written in index order. Returns a DedupReport.
+    Arguments:
+        data_filename -- The MRF data file (.ppg, .pjg, ...); its index is the .idx file next to it
+        target_path -- Output data file, or None to replace the input files once the copy is complete
+        prefix -- Number of leading bytes to keep as they are (e.g. an empty tile that seeded the data file)
+        dry_run -- Only compute the report
+    """
+    idx = open_index(index_name(data_filename))
+    out_idx = np.array(idx)
+    bytes_before = os.path.getsize(data_filename)
+    stored = {} # (size, digest) -> offset in the new data file
+    copied = {} # (offset, size) in the old data file -> offset in the new one
+    position = prefix
+    tiles = deduplicated = 0
+
+    in_place = target_path is None
+    if in_place:
+        bname, ext = os.path.splitext(data_filename)
+        target_path = bname + os.extsep + "tmp" + ext
+    with open(data_filename, 'rb') as src:
+        dst = None if dry_run else open(target_path, 'wb')
+        try:
+            if prefix > 0:
+                data = src.read(prefix)
+                stored[(prefix, hashlib.sha1(data).digest())] = 0 # tiles identical to the seeded empty tile
+                if dst is not None:
+                    dst.write(data)
+            for i in np.nonzero(idx['size'])[0]:
+                offset, size = int(idx['offset'][i]), int(idx['size'][i])
+                tiles += 1
+                if offset + size <= prefix: # already in the bytes that were kept
+                    continue
+                if (offset, size) not in copied:
+                    src.seek(offset)
+                    data = src.read(size)
+                    key = (size, hashlib.sha1(data).digest())
+                    if key not in stored:
+                        stored[key] = position
+                        position += size
+                        if dst is not None:
+                            dst.write(data)
+                    else: # a copy of a tile that is already stored
+                        deduplicated += size
+                    copied[(offset, size)] = stored[key]
+                out_idx['offset'][i] = copied[(offset, size)]
+            if dst is not None:
+                dst.flush()
+                os.fsync(dst.fileno())
+        finally:
+            if dst is not None:
+                dst.close()
+
+    if not dry_run:
+        if not in_place:
+            write_index(index_name(target_path), out_idx)
+        else:
+            # the new data file and index can't be renamed over the old ones together: until the new index is in
+            # place, the marker tells an interrupted run (see mrfgen's resume) that the pair doesn't match
+            marker = compacting_marker(data_filename)
+            open(marker, 'w').close()
+            os.rename(target_path, data_filename)
+            write_index(index_name(data_filename), out_idx)
+            os.remove(marker)
+    return DedupReport(tiles, len(stored), bytes_before, position, deduplicated)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stores identical tiles of an MRF data file only once.')
+    parser.add_argument('data_file', help='MRF data file, e.g. output.ppg; the .idx next to it is updated too')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Write the deduplicated data file (and its .idx) here instead of replacing the input')
+    parser.add_argument('-p', '--prefix', dest='prefix', type=int, default=0,
+                        help='Leading bytes of the data file to keep as they are, e.g. the empty tile.  Default: 0')
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true',
+                        help='Only report the bytes that would be saved')
+    args = parser.parse_args()
+
+    report = dedup_mrf(args.data_file, args.output, args.prefix, args.dry_run)
+    print(format_report(report))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# In-process replacement for the mrf_insert utility.
+#
+# The target MRF is opened once per process and kept open between granules.
+# Each granule is read at the target resolution, pasted into the block-aligned
+# window of the base level and the covered area of any existing overviews is
+# regenerated with the same Avg/NearNB sampling that mrf_insert -r provides.
+# With merge, only the valid (not nodata, not transparent) granule pixels replace
+# what is already in the MRF, like gdal_merge.py on the block-aligned window.
+#
+# Example:
+#
+#  mrf_inserter.py -r Avg -m -n 0 granule.tif output.mrf
+#
+
+import argparse
+import collections
+import os
+import sys
+import numpy as np
+from osgeo import gdal
+from mrf_pyramid import overview_blocks, rebuild_blocks
+
+# status values for InsertResult
+INSERTED = 'inserted'
+OUTSIDE = 'outside'
+FAILED = 'error'
+
+InsertResult = collections.namedtuple('InsertResult', ['tile', 'status', 'message', 'window'])
+
+
+def align_window(window, blocksize, x_size, y_size):
+    """
+    Expands a pixel window (x0, y0, x1, y1) to block boundaries, clipped to the raster size
+    """
+    x0, y0, x1, y1 = window
+    x0 = (x0 // blocksize) * blocksize
+    y0 = (y0 // blocksize) * blocksize
+    x1 = min(-(-x1 // blocksize) * blocksize, x_size)
+    y1 = min(-(-y1 // blocksize) * blocksize, y_size)
+    return (x0, y0, x1, y1)
+
+
+class MRFInserter:
+    """
+    Keeps an MRF open for update and inserts granules into it.
+    Arguments:
+        mrf -- The MRF to update (may include the :MRF:Z<n> suffix)
+        insert_method -- Overview sampling, Avg or NearNB (same as mrf_insert -r)
+    """
+    def __init__(self, mrf, insert_method='Avg'):
+        self.mrf = mrf
+        self.insert_method = insert_method
+        self.ds = None
+        self.files = []
+        self.identity = None
+        # base level windows written so far; with defer_overviews the caller patches overviews later
+        self.touched = []
+        self.defer_overviews = False
+
+    def file_identity(self):
+        identity = []
+        for filename in self.files:
+            try:
+                stats = os.stat(filename)
+                identity.append((stats.st_dev, stats.st_ino))
+            except OSError:
+                identity.append(None)
+        return identity
+
+    def open(self):
+        # Reopen if the data or index file was replaced underneath us (e.g. by clean_mrf)
+        if self.ds is not None and self.file_identity() == self.identity:
+            return self.ds
+        self.close()
+        self.ds = gdal.Open(self.mrf, gdal.GA_Update)
+        if self.ds is None:
+            raise IOError("Unable to open {0} for update: {1}".format(self.mrf, gdal.GetLastErrorMsg()))
+        self.files = [f for f in (self.ds.GetFileList() or []) if not f.endswith('.aux.xml')]
+        self.identity = self.file_identity()
+        band = self.ds.GetRasterBand(1)
+        self.blocksize = band.GetBlockSize()[0]
+        self.geotransform = self.ds.GetGeoTransform()
+        self.nodata = band.GetNoDataValue()
+        return self.ds
+
+    def close(self):
+        if self.ds is not None:
+            self.ds.FlushCache()
+        self.ds = None
+
+    def target_window(self, src):
+        """
+        Returns the granule footprint as a pixel window (x0, y0, x1, y1) of the target base level
+        """
+        sgt = src.GetGeoTransform()
+        s_lrx = sgt[0] + sgt[1] * src.RasterXSize + sgt[2] * src.RasterYSize
+        s_lry = sgt[3] + sgt[4] * src.RasterXSize + sgt[5] * src.RasterYSize
+        return self.pixel_window((sgt[0], sgt[3], s_lrx, s_lry))
+
+    def pixel_window(self, extents):
+        """
+        Returns spatial extents (ulx, uly, lrx, lry) as a pixel window (x0, y0, x1, y1) of the target base level
+        """
+        gt = self.geotransform
+        ulx, uly, lrx, lry = [float(x) for x in extents]
+        x0 = int(round((ulx - gt[0]) / gt[1]))
+        y0 = int(round((uly - gt[3]) / gt[5]))
+        x1 = int(round((lrx - gt[0]) / gt[1]))
+        y1 = int(round((lry - gt[3]) / gt[5]))
+        return (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+    def read_granule(self, src, window):
+        """
+        Reads the granule at target resolution for a (clipped) target window; returns a list of band arrays
+        """
+        gt = self.geotransform
+        x0, y0, x1, y1 = window
+        proj_win = [gt[0] + x0 * gt[1], gt[3] + y0 * gt[5], gt[0] + x1 * gt[1], gt[3] + y1 * gt[5]]
+        resampled = gdal.Translate('', src, format='MEM', projWin=proj_win, width=x1 - x0, height=y1 - y0)
+        if resampled is None:
+            raise IOError(gdal.GetLastErrorMsg())
+        bands = [resampled.GetRasterBand(i).ReadAsArray() for i in range(1, resampled.RasterCount + 1)]
+        resampled = None
+
+        target_bands = self.ds.RasterCount
+        if len(bands) == target_bands:
+            return bands
+        if len(bands) > target_bands:
+            return bands[:target_bands]
+        if len(bands) == 3 and target_bands == 4:
+            # RGB into RGBA, treat every granule pixel as opaque
+            return bands + [np.full(bands[0].shape, 255, dtype=bands[0].dtype)]
+        raise ValueError("Granule has {0} bands but {1} has {2}".format(len(bands), self.mrf, target_bands))
+
+    def valid_mask(self, granule, nodata):
+        """
+        Returns a boolean array of the granule pixels to merge: opaque where the MRF has an alpha band,
+        otherwise pixels where any band differs from nodata
+        Arguments:
+            granule -- List of band arrays from read_granule
+            nodata -- Nodata value, or None if every pixel is valid
+        """
+        last = self.ds.GetRasterBand(self.ds.RasterCount)
+        if len(granule) > 1 and last.GetColorInterpretation() == gdal.GCI_AlphaBand:
+            return granule[-1] != 0
+        if nodata is None:
+            return np.ones(granule[0].shape, dtype=bool)
+        valid = np.zeros(granule[0].shape, dtype=bool)
+        for data in granule:
+            valid |= data != nodata
+        return valid
+
+    def coverage_mask(self, coverage, window):
+        """
+        Returns a boolean array over a pixel window that is True inside any of a list of extents
+        Arguments:
+            coverage -- List of spatial extents (ulx, uly, lrx, lry), e.g. the granules of a mosaic
+            window -- Pixel window (x0, y0, x1, y1) of the target base level
+        """
+        x0, y0, x1, y1 = window
+        covered = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for extents in coverage:
+            cx0, cy0, cx1, cy1 = self.pixel_window(extents)
+            covered[max(cy0 - y0, 0):max(cy1 - y0, 0), max(cx0 - x0, 0):max(cx1 - x0, 0)] = True
+        return covered
+
+    def patch_overviews(self, windows):
+        """
+        Regenerates the overview blocks that descend from a list of base level pixel windows.
+        Each dirty block is rebuilt once per level, from its children in the level below.
+        Arguments:
+            windows -- List of base level pixel windows (x0, y0, x1, y1)
+        """
+        self.open()
+        for level, blocks in enumerate(overview_blocks(self.ds, windows)):
+            rebuild_blocks(self.ds, level, blocks, self.insert_method)
+
+    def insert(self, tile, merge=False, nodata=None, coverage=None):
+        """
+        Inserts a granule into the MRF and returns an InsertResult
+        Argument:
+            tile -- The granule to insert; it should already be in the MRF projection
+            merge -- Keep existing MRF pixels where the granule is nodata or transparent
+            nodata -- Nodata value used by merge (defaults to the MRF nodata)
+            coverage -- Only write the pixels inside this list of extents (e.g. the granules of a mosaic
+                        VRT), keeping the existing MRF pixels in the gaps between them
+        """
+        try:
+            self.open()
+        except IOError as e:
+            return InsertResult(tile, FAILED, str(e), None)
+
+        src = gdal.Open(tile)
+        if src is None:
+            return InsertResult(tile, FAILED, "Unable to open {0}: {1}".format(tile, gdal.GetLastErrorMsg()), None)
+
+        x_size, y_size = self.ds.RasterXSize, self.ds.RasterYSize
+        gx0, gy0, gx1, gy1 = self.target_window(src)
+        window = (max(gx0, 0), max(gy0, 0), min(gx1, x_size), min(gy1, y_size))
+        if window[0] >= window[2] or window[1] >= window[3]:
+            return InsertResult(tile, OUTSIDE, "Access window out of range for {0}".format(tile), None)
+
+        try:
+            granule = self.read_granule(src, window)
+        except (IOError, ValueError) as e:
+            return InsertResult(tile, FAILED, str(e), window)
+        src = None
+
+        # Write whole blocks so every touched block is encoded exactly once
+        ax0, ay0, ax1, ay1 = align_window(window, self.blocksize, x_size, y_size)
+        ox, oy = window[0] - ax0, window[1] - ay0
+        valid = self.valid_mask(granule, self.nodata if nodata is None else nodata) if merge else None
+        if coverage is not None:
+            covered = self.coverage_mask(coverage, window)
+            valid = covered if valid is None else valid & covered
+        for i, data in enumerate(granule):
+            band = self.ds.GetRasterBand(i + 1)
+            if valid is not None or (ax0, ay0, ax1, ay1) != window:
+                block = band.ReadAsArray(ax0, ay0, ax1 - ax0, ay1 - ay0)
+                target = block[oy:oy + data.shape[0], ox:ox + data.shape[1]]
+                if valid is not None:
+                    target[valid] = data[valid]
+                else:
+                    target[...] = data
+                data = block
+            if band.WriteArray(data, ax0, ay0) != gdal.CE_None:
+                return InsertResult(tile, FAILED, gdal.GetLastErrorMsg(), window)
+
+        self.touched.append((ax0, ay0, ax1, ay1))
+        if not self.defer_overviews:
+            self.patch_overviews([(ax0, ay0, ax1, ay1)])
+        self.ds.FlushCache()
+        return InsertResult(tile, INSERTED, "Inserted {0} at pixel window {1}".format(tile, window), (ax0, ay0, ax1, ay1))
+
+
+# One inserter per (process, MRF); forked pool workers must not reuse their parent's handle
+inserters = {}
+
+
+def get_inserter(mrf, insert_method='Avg'):
+    """
+    Returns the open inserter for this process, creating it if needed
+    """
+    key = (os.getpid(), mrf)
+    if key not in inserters:
+        inserters[key] = MRFInserter(mrf, insert_method)
+    return inserters[key]
+
+
+def release_inserter(mrf=None):
+    """
+    Flushes and closes this process' inserter for an MRF, or all of them
+    """
+    for key in list(inserters.keys()):
+        if key[0] == os.getpid() and (mrf is None or key[1] == mrf):
+            inserters.pop(key).close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inserts georeferenced granules into an existing MRF.')
+    parser.add_argument('tiles', nargs='+', help='Granules to insert, followed by the target MRF')
+    parser.add_argument('-r', '--resampling', dest='resampling', default='Avg',
+                        help='Overview sampling, Avg or NearNB.  Default: Avg')
+    parser.add_argument('-m', '--merge', dest='merge', action='store_true',
+                        help='Merge over the existing MRF pixels, skipping nodata and transparent granule pixels')
+    parser.add_argument('-n', '--nodata', dest='nodata', type=float, default=None,
+                        help='Nodata value for --merge.  Default: the MRF nodata value')
+    args = parser.parse_args()
+    if len(args.tiles) < 2:
+        parser.error('At least one granule and the target MRF are required')
+
+    inserter = MRFInserter(args.tiles[-1], args.resampling)
+    errors = 0
+    for tile in args.tiles[:-1]:
+        result = inserter.insert(tile, args.merge, args.nodata)
+        print("{0}: {1}".format(result.status, result.message))
+        errors += result.status == FAILED
+    inserter.close()
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
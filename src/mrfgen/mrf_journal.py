@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Append-only journal of an mrfgen run, used by mrfgen --resume.
+#
+# Each line is a JSON record: a "start" record with the output basename and the
+# configuration fingerprint, one "tile" record per granule inserted into the MRF
+# and one "stage" record per finished stage (create, gdaladdo, mrf_clean, ...).
+# Records are appended with a single write and fsync'd so a killed run leaves at
+# most one partial line behind, which is ignored when the journal is loaded.
+#
+# Example:
+#
+#  mrf_journal.py /mrfgen/working_dir/MYR4ODLOLLDY_20141004_mrfgen_journal.jsonl
+#
+
+import hashlib
+import json
+import os
+import sys
+from osgeo import gdal
+
+# bytes read from the start and end of a granule for its fingerprint
+SAMPLE_SIZE = 1 << 20
+
+
+def fingerprint(filename):
+    """
+    Returns a content fingerprint for a granule: its size plus a hash of its first and last SAMPLE_SIZE bytes.
+    Small files (e.g. VRTs) are hashed completely. Remote (/vsi) files use their size and modification time.
+    Arguments:
+        filename -- The granule to fingerprint
+    """
+    digest = hashlib.sha1()
+    if filename.startswith('/vsi'):
+        stats = gdal.VSIStatL(filename)
+        if stats is None:
+            return None
+        digest.update("{0}:{1}:{2}".format(filename, stats.size, stats.mtime).encode())
+        return digest.hexdigest()
+
+    try:
+        size = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            digest.update(str(size).encode())
+            digest.update(f.read(SAMPLE_SIZE))
+            if size > SAMPLE_SIZE:
+                f.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+                digest.update(f.read(SAMPLE_SIZE))
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class InsertJournal:
+    """
+    Records the progress of an mrfgen run so that it can be resumed after a crash.
+    Arguments:
+        filename -- Journal file, normally in the working_dir
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.basename = None
+        self.config = None
+        self.tiles = {}
+        self.stages = {}
+
+    def append(self, record):
+        line = (json.dumps(record, sort_keys=True) + '\n').encode()
+        # O_APPEND with a single write keeps records from parallel insert workers whole
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def load(self, config):
+        """
+        Reads an existing journal. Returns False if there is none or it belongs to a different configuration.
+        Arguments:
+            config -- Fingerprint of the configuration for this run
+        """
+        self.basename, self.config, self.tiles, self.stages = None, None, {}, {}
+        try:
+            with open(self.filename) as f:
+                lines = f.readlines()
+        except IOError:
+            return False
+        if lines and not lines[-1].endswith('\n'):
+            # terminate a partial last line so that new records start on their own line
+            with open(self.filename, 'a') as f:
+                f.write('\n')
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError: # partial last line from a killed run
+                continue
+            if record.get('event') == 'start':
+                self.basename = record['basename']
+                self.config = record['config']
+            elif record.get('event') == 'tile':
+                self.tiles[record['tile']] = record
+            elif record.get('event') == 'stage':
+                self.stages[record['stage']] = record
+        return self.basename is not None and self.config == config
+
+    def reset(self, basename, config):
+        """
+        Starts a new journal for a run, discarding any previous one
+        Arguments:
+            basename -- Basename of the output files of this run
+            config -- Fingerprint of the configuration for this run
+        """
+        self.remove()
+        self.basename, self.config, self.tiles, self.stages = basename, config, {}, {}
+        self.append({'event': 'start', 'basename': basename, 'config': config})
+
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    def record_tile(self, tile, window=None, deferred=False):
+        """
+        Records a granule as inserted
+        Arguments:
+            tile -- The granule that was inserted
+            window -- Base level pixel window that was written (optional)
+            deferred -- True if the overviews over the window have not been patched yet
+        """
+        record = {'event': 'tile', 'tile': tile, 'fingerprint': fingerprint(tile),
+                  'window': list(window) if window else None, 'deferred': deferred}
+        self.append(record)
+        self.tiles[tile] = record
+
+    def record_stage(self, stage, **values):
+        """
+        Records a stage as finished, with any values needed to skip it on resume
+        """
+        record = dict(values, event='stage', stage=stage)
+        self.append(record)
+        self.stages[stage] = record
+
+    def is_done(self, tile):
+        """
+        Returns True if the granule was inserted and has not changed since
+        """
+        record = self.tiles.get(tile)
+        return record is not None and record['fingerprint'] is not None and record['fingerprint'] == fingerprint(tile)
+
+    def pending(self, tiles):
+        """
+        Returns the granules from a list that still need to be inserted
+        """
+        return [tile for tile in tiles if not self.is_done(tile)]
+
+    def deferred_windows(self):
+        """
+        Returns the windows of inserted granules whose overviews were left for a patch that never ran
+        """
+        if 'patch_overviews' in self.stages:
+            return []
+        return [tuple(r['window']) for r in self.tiles.values() if r['deferred'] and r['window']]
+
+    def has_stage(self, stage):
+        return stage in self.stages
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: mrf_journal.py <journal>")
+        sys.exit(1)
+    journal = InsertJournal(sys.argv[1])
+    journal.load(None)
+    print("basename: {0}".format(journal.basename))
+    print("tiles inserted: {0}".format(len(journal.tiles)))
+    for stage in journal.stages:
+        print("stage done: {0}".format(stage))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Per-stage timing and resource metrics for mrfgen.
+#
+# Each stage accumulates its run count, wall time, CPU time (including waited-for
+# subprocesses and pool workers), bytes read and written to storage, the number
+# of subprocesses started and the peak RSS of the process so far. Stages recorded
+# by pool workers are returned to the parent and merged. The totals are written
+# as JSON and as OpenMetrics text next to the mrfgen log.
+#
+# Example:
+#
+#  mrf_metrics.py /mrfgen/logfile_dir/MYR4ODLOLLDY_20141004___mrfgen_metrics.json
+#
+
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# ru_inblock/ru_oublock are counted in 512 byte blocks
+BLOCK_SIZE = 512
+
+# ru_maxrss can't be reset, so a process that runs several jobs (see mrfgen_batch.py) reports the peak of every job
+# it ran so far, not that of the current one; the field name says so
+HELP = {'process_peak_rss_bytes': 'Peak RSS of the mrfgen process (and its children) since it started, '
+                                  'including earlier jobs run by the same process'}
+
+FIELDS = ['count', 'wall_seconds', 'cpu_seconds', 'read_bytes', 'written_bytes', 'subprocesses', 'process_peak_rss_bytes']
+
+
+def usage():
+    """
+    Returns the current (wall, cpu, read, written, peak rss) totals of this process and its waited-for children
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.time(),
+            own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+            (own.ru_inblock + children.ru_inblock) * BLOCK_SIZE,
+            (own.ru_oublock + children.ru_oublock) * BLOCK_SIZE,
+            max(own.ru_maxrss, children.ru_maxrss) * 1024) # ru_maxrss is in KB on Linux
+
+
+class Metrics:
+    """
+    Accumulates resource usage per named stage
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.subprocesses = 0
+
+    def count_subprocess(self):
+        self.subprocesses += 1
+
+    def start(self):
+        """
+        Returns a token for stop(), marking the start of a stage
+        """
+        return usage() + (self.subprocesses,)
+
+    def stop(self, name, token):
+        """
+        Adds the usage since start() to a stage
+        Arguments:
+            name -- Stage name, e.g. reproject or insert_granule
+            token -- Value returned by start()
+        """
+        now = usage() + (self.subprocesses,)
+        wall, cpu, read, written, _, subprocesses = [b - a for a, b in zip(token, now)]
+        self.add(name, {'count': 1, 'wall_seconds': wall, 'cpu_seconds': cpu, 'read_bytes': read,
+                        'written_bytes': written, 'subprocesses': subprocesses, 'process_peak_rss_bytes': now[4]})
+
+    @contextmanager
+    def stage(self, name):
+        token = self.start()
+        try:
+            yield
+        finally:
+            self.stop(name, token)
+
+    def add(self, name, values):
+        stage = self.stages.setdefault(name, dict((field, 0) for field in FIELDS))
+        for field in FIELDS:
+            if field == 'process_peak_rss_bytes':
+                stage[field] = max(stage[field], values[field])
+            else:
+                stage[field] += values[field]
+
+    def merge(self, stages):
+        """
+        Adds the stages recorded by another process (e.g. a parallel_mrf_insert worker)
+        """
+        for name, values in stages.items():
+            self.add(name, values)
+
+    def openmetrics(self, job):
+        lines = []
+        for field in FIELDS:
+            metric = 'mrfgen_stage_' + field
+            lines.append('# TYPE {0} gauge'.format(metric))
+            if field in HELP:
+                lines.append('# HELP {0} {1}'.format(metric, HELP[field]))
+            for name in sorted(self.stages):
+                lines.append('{0}{{job="{1}",stage="{2}"}} {3}'.format(metric, job, name, self.stages[name][field]))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, basename, job):
+        """
+        Writes <basename>.json and <basename>.prom (OpenMetrics text)
+        Arguments:
+            basename -- Output path without extension
+            job -- Name of the run, used as the OpenMetrics job label
+        """
+        with open(basename + '.json', 'w') as f:
+            json.dump({'job': job, 'stages': self.stages}, f, indent=2, sort_keys=True)
+        with open(basename + '.prom', 'w') as f:
+            f.write(self.openmetrics(job))
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: mrf_metrics.py <metrics.json>")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        summary = json.load(f)
+    print("{0:<20} {1:>6} {2:>10} {3:>10} {4:>12} {5:>12} {6:>5} {7:>12}".format(
+        'stage', 'count', 'wall s', 'cpu s', 'read MB', 'written MB', 'procs', 'proc peak MB'))
+    for name, stage in sorted(summary['stages'].items(), key=lambda s: -s[1]['wall_seconds']):
+        print("{0:<20} {1:>6} {2:>10.1f} {3:>10.1f} {4:>12.1f} {5:>12.1f} {6:>5} {7:>12.1f}".format(
+            name, stage['count'], stage['wall_seconds'], stage['cpu_seconds'], stage['read_bytes'] / 1e6,
+            stage['written_bytes'] / 1e6, stage['subprocesses'], stage['process_peak_rss_bytes'] / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# In-process RGBA to paletted PNG conversion for PPNG MRFs.
+#
+# The colormap is parsed once into a lookup table of packed RGBA values, sorted
+# so that whole pixel arrays are mapped to palette indexes with NumPy. Images are
+# read with GDAL in strips of rows, so TIFFs and /vsi paths are converted
+# directly, and the output PNG keeps the georeferencing of its input. Pixels
+# whose color is not in the colormap get the fill index and their colors are
+# reported, like RgbPngToPalPng.py. Inputs that already have a palette are not
+# converted, but their palette can be checked against the colormap in the same
+# pass, like oe_validate_palette.py. mrfgen converts its granules with a pool of
+# worker processes.
+#
+# Example:
+#
+#  mrf_palette.py -c colormap.xml -f 0 -o output_indexed.png input.png
+#  mrf_palette.py -c colormap.xml --validate input_indexed.png
+#
+
+import argparse
+import collections
+import sys
+import urllib.request
+import xml.etree.ElementTree as xmlet
+import numpy as np
+from osgeo import gdal
+
+# rows of the input image mapped at once
+STRIP_ROWS = 1024
+
+# colors not found in the colormap that are reported per image, as by RgbPngToPalPng.py
+MAX_NOT_FOUND = 100
+
+# output is None when the input already had a palette; mismatches is None when the palette wasn't validated
+PaletteReport = collections.namedtuple('PaletteReport', ['tile', 'output', 'missing', 'mismatches', 'error'])
+
+
+def read_colormap(colormap_filename):
+    """
+    Returns the RGBA colors of a GIBS colormap as an (entries, 4) uint8 array, in palette order
+    Arguments:
+        colormap_filename -- Colormap XML file or URL
+    """
+    if '://' in colormap_filename:
+        root = xmlet.parse(urllib.request.urlopen(colormap_filename)).getroot()
+    else:
+        root = xmlet.parse(colormap_filename).getroot()
+    colors = []
+    for entry in root.iter('ColorMapEntry'):
+        r, g, b = [int(value) for value in entry.get('rgb').split(',')[:3]]
+        colors.append((r, g, b, 0 if entry.get('transparent') == 'true' else 255))
+    if len(colors) == 0:
+        raise ValueError("{0} has no ColorMapEntry elements".format(colormap_filename))
+    if len(colors) > 256:
+        raise ValueError("{0} has {1} entries, a PNG palette holds at most 256".format(colormap_filename, len(colors)))
+    return np.array(colors, dtype=np.uint8).reshape(-1, 4)
+
+
+def pack_rgba(rgba):
+    """
+    Packs the last axis of an (..., 4) array of RGBA values into uint32 values
+    """
+    rgba = rgba.astype(np.uint32)
+    return (rgba[..., 0] << 24) | (rgba[..., 1] << 16) | (rgba[..., 2] << 8) | rgba[..., 3]
+
+
+def unpack_rgba(keys):
+    return [((key >> 24) & 255, (key >> 16) & 255, (key >> 8) & 255, key & 255) for key in keys.tolist()]
+
+
+class PaletteLUT:
+    """
+    Maps packed RGBA values to colormap indexes. Where a color is in the colormap more than once,
+    its first entry is used.
+    """
+    def __init__(self, colors):
+        self.keys, first = np.unique(pack_rgba(colors), return_index=True)
+        self.indexes = first.astype(np.uint8)
+
+    def lookup(self, keys, fill):
+        """
+        Returns the palette index of each packed color, with fill where the color isn't in the colormap,
+        and the sorted unique colors that weren't found
+        Arguments:
+            keys -- Array of packed RGBA values
+            fill -- Index given to colors that aren't in the colormap
+        """
+        # map each distinct color once, then spread the result over the pixels
+        colors, inverse = np.unique(keys, return_inverse=True)
+        position = np.minimum(np.searchsorted(self.keys, colors), len(self.keys) - 1)
+        found = self.keys[position] == colors
+        indexes = np.where(found, self.indexes[position], fill).astype(np.uint8)
+        return indexes[inverse].reshape(keys.shape), colors[~found]
+
+
+def read_rgba(ds, y, rows):
+    """
+    Returns rows of an RGB or RGBA dataset as a (rows, cols, 4) array; RGB images are opaque
+    """
+    data = ds.ReadAsArray(0, y, ds.RasterXSize, rows)
+    if data is None:
+        raise IOError(gdal.GetLastErrorMsg())
+    rgba = np.empty((rows, ds.RasterXSize, 4), dtype=np.uint8)
+    rgba[..., :3] = np.moveaxis(data[:3], 0, -1)
+    rgba[..., 3] = data[3] if ds.RasterCount == 4 else 255
+    return rgba
+
+
+def color_table(colors):
+    table = gdal.ColorTable()
+    for i, color in enumerate(colors.tolist()):
+        table.SetColorEntry(i, tuple(color))
+    return table
+
+
+def palette_mismatches(table, colors, fill=(0, 0, 0, 0)):
+    """
+    Returns the number of palette entries of an image that don't match the colormap index by index:
+    differing entries, colormap entries the palette lacks and extra palette entries that aren't fill
+    Arguments:
+        table -- The image's gdal.ColorTable
+        colors -- Colormap colors from read_colormap
+        fill -- Color of unused palette entries
+    """
+    entries = [tuple(table.GetColorEntry(i)) for i in range(table.GetCount())]
+    expected = [tuple(color) for color in colors.tolist()]
+    mismatched = sum(1 for entry, color in zip(entries, expected) if entry != color)
+    missing = max(len(expected) - len(entries), 0)
+    extra = sum(1 for entry in entries[len(expected):] if entry != tuple(fill))
+    return mismatched + missing + extra
+
+
+def palettize(tile, output_filename, colors, fill=0, validate=False):
+    """
+    Converts an RGB or RGBA image to a paletted PNG using the colormap colors; images that already have a
+    palette are only validated. Returns a PaletteReport; errors are reported rather than raised so that
+    this can run in a worker process.
+    Arguments:
+        tile -- Input image (PNG, TIFF, /vsi path, ...)
+        output_filename -- Paletted PNG to write; a world file and .aux.xml are written next to it
+        colors -- Colormap colors from read_colormap
+        fill -- Palette index for pixels whose color isn't in the colormap
+        validate -- Check the palette of an already paletted input against the colormap
+    """
+    try:
+        ds = gdal.Open(tile)
+        if ds is None:
+            raise IOError("Unable to open {0}: {1}".format(tile, gdal.GetLastErrorMsg()))
+        table = ds.GetRasterBand(1).GetColorTable()
+        if table is not None:
+            mismatches = palette_mismatches(table, colors) if validate else None
+            return PaletteReport(tile, None, [], mismatches, None)
+        if output_filename is None:
+            raise ValueError("{0} has no palette".format(tile))
+        if ds.RasterCount not in (3, 4):
+            raise ValueError("{0} has {1} bands, expected RGB or RGBA".format(tile, ds.RasterCount))
+
+        lut = PaletteLUT(colors)
+        paletted = gdal.GetDriverByName('MEM').Create('', ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Byte)
+        paletted.SetGeoTransform(ds.GetGeoTransform())
+        paletted.SetProjection(ds.GetProjection())
+        band = paletted.GetRasterBand(1)
+        band.SetColorTable(color_table(colors))
+        missing = np.zeros(0, dtype=np.uint32)
+        for y in range(0, ds.RasterYSize, STRIP_ROWS):
+            rows = min(STRIP_ROWS, ds.RasterYSize - y)
+            indexes, not_found = lut.lookup(pack_rgba(read_rgba(ds, y, rows)), fill)
+            band.WriteArray(indexes, 0, y)
+            if len(missing) < MAX_NOT_FOUND and len(not_found):
+                missing = np.union1d(missing, not_found)
+        ds = None
+
+        output = gdal.GetDriverByName('PNG').CreateCopy(output_filename, paletted, 0, ['WORLDFILE=YES'])
+        if output is None:
+            raise IOError("Unable to write {0}: {1}".format(output_filename, gdal.GetLastErrorMsg()))
+        output = None
+        # the output palette is the colormap, so only the colors that weren't found need validating
+        return PaletteReport(tile, output_filename, unpack_rgba(missing[:MAX_NOT_FOUND]), 0 if validate else None, None)
+    except (IOError, ValueError, RuntimeError) as e:
+        return PaletteReport(tile, None, [], None, str(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts an RGB or RGBA image to a paletted PNG using a GIBS colormap.')
+    parser.add_argument('input', help='Input image')
+    parser.add_argument('-c', '--colormap', dest='colormap', required=True, help='Colormap XML file or URL')
+    parser.add_argument('-o', '--output', dest='output', help='Output paletted PNG')
+    parser.add_argument('-f', '--fill', dest='fill', type=int, default=0,
+                        help='Palette index for colors that are not in the colormap.  Default: 0')
+    parser.add_argument('--validate', dest='validate', action='store_true',
+                        help='Check the palette of an already paletted input against the colormap')
+    args = parser.parse_args()
+
+    if not 0 <= args.fill <= 255:
+        parser.error('Fill value is not between 0 and 255')
+    if args.output is None and not args.validate:
+        parser.error('--output or --validate must be given')
+    report = palettize(args.input, args.output, read_colormap(args.colormap), args.fill, args.validate)
+    if report.error is not None:
+        print(report.error)
+        sys.exit(255)
+    if report.output is not None:
+        print("Created " + report.output)
+    for color in report.missing:
+        print("Color not found in colormap: " + ",".join(str(value) for value in color))
+    if report.mismatches:
+        print("{0} palette entries do not match the colormap".format(report.mismatches))
+    sys.exit(min(len(report.missing) + (report.mismatches or 0), 254))
+
+
+if __name__ == "__main__":
+    main()
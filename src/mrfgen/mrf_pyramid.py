@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Parallel pyramid builder for MRF overviews.
+#
+# Regenerates the blocks of an MRF's existing overview levels (e.g. created with
+# UNIFORM_SCALE or by gdaladdo) from the level below. Levels are built in order;
+# within a level the blocks are split into stripes of block rows that are built
+# by a pool of worker processes, each reading the child blocks under its parent
+# blocks and writing the result into the overview's existing index slots.
+# Only blocks that descend from a list of base level windows can be rebuilt.
+#
+# Example:
+#
+#  mrf_pyramid.py -r average -w 8 output.mrf
+#
+
+import argparse
+import multiprocessing
+import sys
+import numpy as np
+from osgeo import gdal
+
+# stripes per worker at each level, so that uneven stripes still balance
+STRIPES_PER_WORKER = 4
+
+
+def sampling_method(resampling):
+    """
+    Maps a gdaladdo/mrf_insert resampling name to 'avg', 'nearest' or 'mode'; returns None if it isn't supported
+    Arguments:
+        resampling -- Resampling name, e.g. average, Avg, nearest, NNb, NearNB or mode
+    """
+    resampling = resampling.lower()
+    if resampling in ('avg', 'average'):
+        return 'avg'
+    if resampling.startswith('near') or resampling == 'nnb':
+        return 'nearest'
+    if resampling == 'mode':
+        return 'mode'
+    return None
+
+
+def set_mp_safe(mrf, mp_safe=True):
+    """
+    Marks an MRF as mp_safe so that several processes can write to it at the same time, or removes the mark.
+    Returns True if the header was changed.
+    Arguments:
+        mrf -- An existing MRF file (may include the :MRF:Z<n> suffix)
+        mp_safe -- False to remove the mark
+    """
+    mrf = mrf.split(':MRF:')[0]
+    with open(mrf) as f:
+        data = f.read()
+    old, new = "<Raster>", "<Raster mp_safe=\"on\">"
+    if not mp_safe:
+        old, new = new, old
+    if old not in data:
+        return False
+    with open(mrf, "w") as f: # overwrite mrf
+        f.write(data.replace(old, new))
+    return True
+
+
+def downsample(data, factor, sampling, nodata=None):
+    """
+    Reduces a 2D array by an integer factor
+    Arguments:
+        data -- 2D numpy array
+        factor -- Reduction factor (2 for standard MRF pyramids)
+        sampling -- 'Avg' to average each factor x factor cell, 'mode' for its most frequent value,
+                    anything else picks the upper-left sample
+        nodata -- Value ignored when averaging or picking the mode (optional)
+    """
+    if factor == 1:
+        return data
+    method = sampling_method(sampling)
+    if method not in ('avg', 'mode'):
+        return data[::factor, ::factor]
+
+    height, width = data.shape
+    out_h = -(-height // factor)
+    out_w = -(-width // factor)
+    valid = np.zeros((out_h * factor, out_w * factor), dtype=bool)
+    if nodata is None:
+        valid[:height, :width] = True
+    else:
+        valid[:height, :width] = data != nodata
+
+    if method == 'mode':
+        padded = np.pad(data, ((0, out_h * factor - height), (0, out_w * factor - width)), mode='edge')
+        cells = padded.reshape(out_h, factor, out_w, factor).transpose(0, 2, 1, 3).reshape(out_h, out_w, -1)
+        valid = valid.reshape(out_h, factor, out_w, factor).transpose(0, 2, 1, 3).reshape(out_h, out_w, -1)
+        # count the matches of each sample within its cell; ties go to the first (upper-left) sample
+        counts = (cells[..., :, None] == cells[..., None, :]).sum(axis=-1) * valid
+        pick = counts.argmax(axis=-1)
+        return np.take_along_axis(cells, pick[..., None], axis=-1)[..., 0]
+
+    integer = np.issubdtype(data.dtype, np.integer)
+    padded = np.zeros((out_h * factor, out_w * factor), dtype=np.int64 if integer else np.float64)
+    padded[:height, :width] = data
+    padded *= valid
+    sums = padded.reshape(out_h, factor, out_w, factor).sum(axis=(1, 3))
+    counts = np.maximum(valid.reshape(out_h, factor, out_w, factor).sum(axis=(1, 3)), 1)
+    if integer:
+        # halves are rounded up, like the (2 + sum) / 4 of mrf_insert -r Avg
+        means = np.floor_divide(sums + counts // 2, counts)
+    else:
+        means = sums / counts
+    out = np.where(valid.reshape(out_h, factor, out_w, factor).any(axis=(1, 3)), means,
+                   0 if nodata is None else nodata)
+    return out.astype(data.dtype)
+
+
+def overview_blocks(ds, windows=None):
+    """
+    Returns, for each overview level of a dataset, the set of (bx, by) blocks that descend from the base level windows
+    Arguments:
+        ds -- Open GDAL dataset
+        windows -- List of base level pixel windows (x0, y0, x1, y1), or None for every block
+    """
+    band = ds.GetRasterBand(1)
+    blocksize = band.GetBlockSize()[0]
+    if windows is None:
+        windows = [(0, 0, ds.RasterXSize, ds.RasterYSize)]
+    blocks = set()
+    for x0, y0, x1, y1 in windows:
+        for by in range(y0 // blocksize, -(-y1 // blocksize)):
+            for bx in range(x0 // blocksize, -(-x1 // blocksize)):
+                blocks.add((bx, by))
+
+    levels = []
+    parent = band
+    for level in range(band.GetOverviewCount()):
+        overview = band.GetOverview(level)
+        factor = max(1, int(round(float(parent.XSize) / overview.XSize)))
+        blocks = set((bx // factor, by // factor) for bx, by in blocks)
+        levels.append(blocks)
+        parent = overview
+    return levels
+
+
+def rebuild_blocks(ds, level, blocks, sampling):
+    """
+    Rebuilds blocks of one overview level, in every band, from the level below
+    Arguments:
+        ds -- GDAL dataset open for update
+        level -- Overview index (0 is the first overview, built from the base level)
+        blocks -- Iterable of (bx, by) blocks of that overview
+        sampling -- Resampling passed to downsample
+    """
+    for i in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(i)
+        nodata = band.GetNoDataValue()
+        blocksize = band.GetBlockSize()[0]
+        parent = band if level == 0 else band.GetOverview(level - 1)
+        overview = band.GetOverview(level)
+        factor = max(1, int(round(float(parent.XSize) / overview.XSize)))
+        for bx, by in sorted(blocks, key=lambda b: (b[1], b[0])):
+            ox0, oy0 = bx * blocksize, by * blocksize
+            ox1 = min(ox0 + blocksize, overview.XSize)
+            oy1 = min(oy0 + blocksize, overview.YSize)
+            if ox0 >= ox1 or oy0 >= oy1:
+                continue
+            sx1, sy1 = min(ox1 * factor, parent.XSize), min(oy1 * factor, parent.YSize)
+            data = parent.ReadAsArray(ox0 * factor, oy0 * factor, sx1 - ox0 * factor, sy1 - oy0 * factor)
+            reduced = downsample(data, factor, sampling, nodata)
+            overview.WriteArray(reduced[:oy1 - oy0, :ox1 - ox0], ox0, oy0)
+
+
+def stripes(blocks, no_stripes):
+    """
+    Splits blocks into at most no_stripes lists of whole, consecutive block rows with similar block counts
+    """
+    rows = {}
+    for bx, by in blocks:
+        rows.setdefault(by, []).append((bx, by))
+    target = -(-len(blocks) // max(no_stripes, 1))
+    result, current = [], []
+    for by in sorted(rows):
+        current.extend(rows[by])
+        if len(current) >= target:
+            result.append(current)
+            current = []
+    if current:
+        result.append(current)
+    return result
+
+
+def build_stripe(task):
+    """
+    Pool entry point: rebuilds one stripe of an overview level. Returns the number of blocks written
+    """
+    mrf, level, blocks, sampling = task
+    ds = gdal.Open(mrf, gdal.GA_Update)
+    if ds is None:
+        raise IOError("Unable to open {0} for update: {1}".format(mrf, gdal.GetLastErrorMsg()))
+    rebuild_blocks(ds, level, blocks, sampling)
+    ds.FlushCache()
+    ds = None
+    return len(blocks)
+
+
+def build_overviews(mrf, sampling, windows=None, workers=1):
+    """
+    Rebuilds the existing overview levels of an MRF, level by level, with up to workers processes per level.
+    Parallel builds need the MRF to be mp_safe (see set_mp_safe).
+    Returns the number of overview blocks written.
+    Arguments:
+        mrf -- The MRF to update (may include the :MRF:Z<n> suffix)
+        sampling -- Resampling passed to downsample (avg, nearest or mode)
+        windows -- Base level pixel windows (x0, y0, x1, y1) whose overviews are rebuilt, or None for all of them
+        workers -- Maximum number of worker processes
+    """
+    ds = gdal.Open(mrf)
+    if ds is None:
+        raise IOError("Unable to open {0}: {1}".format(mrf, gdal.GetLastErrorMsg()))
+    levels = overview_blocks(ds, windows)
+    ds = None
+
+    written = 0
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for level, blocks in enumerate(levels):
+            tasks = [(mrf, level, stripe, sampling) for stripe in stripes(blocks, workers * STRIPES_PER_WORKER)]
+            if pool is None or len(tasks) == 1:
+                written += sum(map(build_stripe, tasks))
+            else:
+                # the pool finishes a level before the next one, which reads it, is started
+                written += sum(pool.imap_unordered(build_stripe, tasks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuilds the existing overview levels of an MRF in parallel.')
+    parser.add_argument('mrf', help='The MRF to update')
+    parser.add_argument('-r', '--resampling', dest='resampling', default='average',
+                        help='Resampling: average, nearest or mode.  Default: average')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Number of worker processes (the MRF must be mp_safe for more than 1).  Default: 1')
+    args = parser.parse_args()
+    if sampling_method(args.resampling) is None:
+        parser.error('Unsupported resampling: {0}'.format(args.resampling))
+
+    written = build_overviews(args.mrf, args.resampling, workers=args.workers)
+    print("Wrote {0} overview blocks".format(written))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -85,16 +85,26 @@ import math
 import oe_utils
 import json
 import re
-from overtiffpacker import pack
+import collections
+import threading
+from multiprocessing.pool import ThreadPool
+from overtiffpacker import pack, source_minmax
+from mrf_inserter import get_inserter, release_inserter, OUTSIDE, FAILED
+from mrf_journal import InsertJournal, fingerprint
+from mrf_pyramid import build_overviews, sampling_method, set_mp_safe
+from mrf_metrics import Metrics
+from mrf_dedup import dedup_mrf, format_report
+from mrf_compact import compact_mrf, measure_garbage, format_compaction, compacting_marker
+from mrf_index import LAYOUTS, MRFIndex, format_locality
+from mrf_palette import read_colormap, palettize
 from decimal import *
-from osgeo import gdal
-from oe_utils import basename, sigevent, log_sig_exit, log_sig_err, log_sig_warn, log_info_mssg, log_info_mssg_with_timestamp, log_the_command, get_modification_time, get_dom_tag_value, remove_file, check_abs_path, add_trailing_slash, verify_directory_path_exists, get_input_files, get_doy_string
+from osgeo import gdal, osr
+from oe_utils import basename, sigevent, log_sig_exit, log_sig_err, log_sig_warn, log_info_mssg, log_info_mssg_with_timestamp, get_modification_time, get_dom_tag_value, remove_file, check_abs_path, add_trailing_slash, verify_directory_path_exists, get_input_files, get_doy_string
 
 import multiprocessing
 import datetime
 from contextlib import contextmanager  # used to build context pool
 import functools
-import random
 
 versionNumber = os.environ.get('ONEARTH_VERSION')
 oe_utils.basename = None
@@ -104,6 +114,11 @@ errors = 0
 # Begin defining subroutines.
 #-------------------------------------------------------------------------------
 
+empty_configs = {} # parsed empty_config files, kept for later runs in the same process
+
+# base level blocks across and down each window that build_direct copies
+DIRECT_WINDOW_BLOCKS = 16
+
 def lookupEmptyTile(empty_tile):
     """
     Lookup predefined empty tiles form config file
@@ -111,15 +126,18 @@ def lookupEmptyTile(empty_tile):
     script_dir = os.path.dirname(__file__)
     if script_dir == '/usr/bin':
         script_dir = '/usr/share/onearth/mrfgen' # use default directory if in bin
-    try:
-        empty_config_file=open(script_dir+"/empty_config", 'r')
-    except IOError:
-        log_sig_exit('ERROR', script_dir+"/empty_config could not be found", sigevent_url)
-    tiles = {}
-    for line in empty_config_file:
-        (key, val) = line.split()
-        tiles[key] = val
-    empty_config_file.close()
+    tiles = empty_configs.get(script_dir)
+    if tiles is None:
+        try:
+            empty_config_file=open(script_dir+"/empty_config", 'r')
+        except IOError:
+            log_sig_exit('ERROR', script_dir+"/empty_config could not be found", sigevent_url)
+        tiles = {}
+        for line in empty_config_file:
+            (key, val) = line.split()
+            tiles[key] = val
+        empty_config_file.close()
+        empty_configs[script_dir] = tiles
     try:
         if tiles[empty_tile][0] == '/':   
             return os.path.abspath(tiles[empty_tile])
@@ -156,6 +174,312 @@ def get_mrf_names(mrf_data, mrf_name, parameter_name, date_of_data, time_of_data
     vrt = mrf.replace('.mrf', '.vrt')
     return (mrf, index, data, aux, vrt)
 
+class TileInfo:
+    """
+    Per-run cache of raster metadata. Each dataset is opened once through the GDAL bindings
+    and its extents, geotransform, EPSG, band count and color table presence are kept by path.
+    Local files are re-probed if their size or modification time changes, so intermediates
+    that are rewritten in place (e.g. .merge.tif or .vrt outputs) are never served stale.
+    Granules may be probed from several threads at once (see probe_inputs).
+    """
+    def __init__(self):
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def stamp(self, tile):
+        # MRF z-level paths (file.mrf:MRF:Z1) are stamped with the MRF header itself
+        path = tile.split(':MRF:')[0]
+        if path.startswith('/vsimem/'):
+            stats = gdal.VSIStatL(path)
+            return None if stats is None else (stats.mtime, stats.size)
+        if path.startswith('/vsi'):
+            return None
+        try:
+            stats = os.stat(path)
+        except OSError:
+            return None
+        return (stats.st_mtime_ns, stats.st_size)
+
+    def invalidate(self, tile=None):
+        """
+        Drop cached metadata for a tile, or for all tiles if none is given
+        Argument:
+            tile -- Tile to forget
+        """
+        with self.lock:
+            if tile is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(tile, None)
+
+    def get(self, tile):
+        """
+        Returns a dict of metadata for the tile, or None if GDAL cannot open it
+        Argument:
+            tile -- Tile to probe
+        """
+        stamp = self.stamp(tile)
+        with self.lock:
+            cached = self.cache.get(tile)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        log_info_mssg("Reading image metadata for " + tile)
+        ds = gdal.Open(tile)
+        if ds is None:
+            self.invalidate(tile)
+            return None
+        geotransform = ds.GetGeoTransform()
+        x_size = ds.RasterXSize
+        y_size = ds.RasterYSize
+        ulx = geotransform[0]
+        uly = geotransform[3]
+        lrx = geotransform[0] + geotransform[1] * x_size + geotransform[2] * y_size
+        lry = geotransform[3] + geotransform[4] * x_size + geotransform[5] * y_size
+
+        epsg = None
+        wkt = ds.GetProjectionRef()
+        if wkt != "":
+            lastAuth = wkt.rfind("AUTHORITY")
+            if lastAuth != -1:
+                m = re.search(".*EPSG.*([0-9]{4}).*", wkt[lastAuth:])
+                if m:
+                    epsg = "EPSG:" + m.group(1)
+
+        color_table = False
+        palette = False
+        for i in range(1, ds.RasterCount + 1):
+            band = ds.GetRasterBand(i)
+            color_table |= band.GetColorTable() is not None
+            palette |= band.GetColorInterpretation() == gdal.GCI_PaletteIndex
+
+        info = {'geotransform': geotransform,
+                'size': (x_size, y_size),
+                'extents': [str(ulx), str(uly), str(lrx), str(lry)],
+                'epsg': epsg,
+                'bands': ds.RasterCount,
+                'color_table': color_table,
+                'palette': palette}
+        ds = None
+        with self.lock:
+            self.cache[tile] = (stamp, info)
+        return info
+
+tile_info = TileInfo() # shared by the helpers below so each granule is only opened once
+
+def probe_inputs(tiles, threads):
+    """
+    Checks the input granules with a bounded pool of threads and yields (tile, exists, info, error) for each,
+    in input order, as soon as it and the granules before it have been checked. Only the headers are read,
+    and the metadata is kept in tile_info for the later stages.
+    Arguments:
+        tiles -- List of input granules
+        threads -- Maximum number of granules checked at once
+    """
+    def probe(tile):
+        if not tile.startswith("/vsi") and not os.path.exists(tile):
+            return tile, False, None, None
+        try:
+            return tile, True, tile_info.get(tile), None
+        except RuntimeError as e:
+            # remote granules that cannot be opened are treated as missing
+            return tile, not tile.startswith("/vsi"), None, e
+
+    if len(tiles) == 0:
+        return
+    pool = ThreadPool(max(1, min(threads, len(tiles))))
+    try:
+        for result in pool.imap(probe, tiles):
+            yield result
+    finally:
+        pool.terminate()
+
+journal = None # InsertJournal of the current run, set up by the main program
+metrics = Metrics() # per-stage resource usage of the current run, written next to the log
+mosaics = {} # granules of each mosaic VRT made by coalesce_tiles, in input order
+
+class WarpCache:
+    """
+    Per-run cache for the reprojection stage. Each EPSG code is looked up once, and the output grid
+    that gdalwarp derives for a source grid is kept per (source EPSG, target EPSG, source size and
+    geotransform), so granules on the same source grid (e.g. a fixed tiling) are warped to it directly.
+    Shared by the threads of reproject_tiles.
+    """
+    def __init__(self):
+        self.srs = {}
+        self.grids = {}
+        self.lock = threading.Lock()
+
+    def wkt(self, epsg):
+        with self.lock:
+            if epsg not in self.srs:
+                srs = osr.SpatialReference()
+                if srs.SetFromUserInput(epsg) != 0:
+                    raise RuntimeError("Unknown projection " + epsg)
+                self.srs[epsg] = srs.ExportToWkt()
+            return self.srs[epsg]
+
+    def grid(self, key):
+        with self.lock:
+            return self.grids.get(key)
+
+    def set_grid(self, key, grid):
+        with self.lock:
+            self.grids[key] = grid
+
+def warp_tile(tile, tile_vrt, s_epsg, t_epsg, cache):
+    """
+    Creates a VRT of tile warped from s_epsg to t_epsg, like gdalwarp -of vrt. Returns an error message, or None.
+    Arguments:
+        tile -- Input granule
+        tile_vrt -- VRT to create
+        s_epsg, t_epsg -- Source and target projections, e.g. EPSG:4326
+        cache -- WarpCache of the run
+    """
+    tileInfo = tile_info.get(tile)
+    if tileInfo is None:
+        return "Unable to read image metadata for " + tile
+    key = (s_epsg, t_epsg, tuple(tileInfo['size']), tuple(tileInfo['geotransform']))
+    options = {'format': 'VRT', 'srcSRS': cache.wkt(s_epsg), 'dstSRS': cache.wkt(t_epsg)}
+    grid = cache.grid(key)
+    if grid is not None:
+        options['outputBounds'], options['width'], options['height'] = grid
+    if os.path.isfile(tile_vrt):
+        remove_file(tile_vrt)
+    warped = gdal.Warp(tile_vrt, tile, **options)
+    if warped is None:
+        return gdal.GetLastErrorMsg() or "gdal.Warp failed"
+    if grid is None:
+        geotransform = warped.GetGeoTransform()
+        width, height = warped.RasterXSize, warped.RasterYSize
+        bounds = (geotransform[0], geotransform[3] + geotransform[5] * height,
+                  geotransform[0] + geotransform[1] * width, geotransform[3])
+        cache.set_grid(key, (bounds, width, height))
+    warped = None
+    tile_info.invalidate(tile_vrt)
+    return None
+
+def reproject_tiles(tiles, source_epsg, target_epsg, working_dir, threads):
+    """
+    Creates VRTs in target_epsg for the granules that aren't in it, with a pool of threads. Returns the new
+    list of granules, in the same order: reprojected granules are replaced by their VRTs and granules that
+    have no detectable EPSG or fail to warp are left out.
+    Arguments:
+        tiles -- List of input granules
+        source_epsg -- EPSG of the granules, or "detect" to read it from each granule
+        target_epsg -- EPSG of the MRF
+        working_dir -- Directory for the VRTs
+        threads -- Number of threads
+    """
+    cache = WarpCache()
+
+    def reproject(tile):
+        s_epsg = get_image_epsg(tile) if source_epsg == "detect" else source_epsg
+        if not s_epsg:
+            return tile, None, None
+        if s_epsg == target_epsg:
+            return tile, tile, None
+        tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
+        tile_vrt = os.path.join(working_dir, tile_basename + "_reproject.vrt")
+        log_info_mssg("Creating VRT for input tile: " + tile)
+        try:
+            error = warp_tile(tile, tile_vrt, s_epsg, target_epsg, cache)
+        except RuntimeError as e:
+            error = str(e)
+        return tile, (tile_vrt if error is None else None), error
+
+    if len(tiles) == 0:
+        return []
+    reprojected = []
+    pool = ThreadPool(max(1, min(threads, len(tiles))))
+    try:
+        for tile, output, error in pool.imap(reproject, tiles):
+            if output is not None:
+                reprojected.append(output)
+            elif error is None:
+                # if EPSG can't be determined, remove the tile
+                log_sig_warn(tile + " has undetectable EPSG", sigevent_url)
+            else:
+                log_info_mssg(error)
+                log_sig_err("Error creating VRT for input image " + tile, sigevent_url)
+    finally:
+        pool.terminate()
+    return reprojected
+
+class ScratchSpace:
+    """
+    Allocates names for throwaway intermediates (cut/warp/merge VRTs, merged tiles). When enabled, they are kept
+    in GDAL's in-memory filesystem (/vsimem) until the memory budget is used up, after which new intermediates
+    spill to the working_dir. In-memory intermediates are only visible to this process and its forked workers,
+    so they must be created and read through the GDAL bindings, never by a subprocess.
+    Arguments:
+        budget -- Maximum bytes kept in /vsimem; 0 keeps every intermediate in the working_dir
+    """
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.sizes = {} # bytes counted for each in-memory intermediate handed out by path()
+        self.unmeasured = [] # in-memory intermediates handed out since the last call to used()
+        self.allocated = 0
+
+    def prefix(self):
+        # forked workers inherit a copy of the parent's /vsimem, so each process writes under its own directory
+        return '/vsimem/mrfgen_{0}/'.format(os.getpid())
+
+    def used(self):
+        """
+        Returns the number of bytes this process holds in /vsimem. Only the intermediates handed out since the
+        last call are measured; the others were counted then and are uncounted by remove().
+        """
+        if self.pid != os.getpid(): # a forked worker, which starts with an empty directory of its own
+            self.reset()
+        for path in self.unmeasured:
+            stats = gdal.VSIStatL(path)
+            if path in self.sizes and stats is not None: # not removed yet; a reused name replaces its old size
+                self.allocated += stats.size - self.sizes[path]
+                self.sizes[path] = stats.size
+        self.unmeasured = []
+        return self.allocated
+
+    def path(self, working_dir, name, estimate=0):
+        """
+        Returns the path for a new intermediate
+        Arguments:
+            working_dir -- Directory to use when the intermediate is spilled to disk
+            name -- File name of the intermediate
+            estimate -- Expected size in bytes (VRTs are small and can use 0)
+        """
+        if self.budget > 0 and self.used() + estimate <= self.budget:
+            path = self.prefix() + name
+            self.sizes.setdefault(path, 0)
+            self.unmeasured.append(path)
+            return path
+        if self.budget > 0:
+            log_info_mssg("In-memory budget of {0} bytes reached, writing {1} to {2}".format(self.budget, name, working_dir))
+        return working_dir + name
+
+    def remove(self, path):
+        if path.startswith('/vsimem/'):
+            gdal.Unlink(path)
+            if self.pid == os.getpid():
+                self.allocated -= self.sizes.pop(path, 0)
+        else:
+            remove_file(path)
+        tile_info.invalidate(path)
+
+    def release(self, name):
+        """
+        Frees the in-memory intermediates whose names start with name (e.g. everything derived from one granule)
+        """
+        for child in gdal.ReadDirRecursive(self.prefix()) or []:
+            if os.path.basename(child).startswith(name):
+                self.remove(self.prefix() + child)
+
+scratch = ScratchSpace() # replaced by the main program when <mrf_vsimem> is set
+
 def diff_resolution(tiles):
     """
     Compares images within a list for different image resolutions
@@ -170,17 +494,13 @@ def diff_resolution(tiles):
     log_info_mssg("Checking for different resolutions in tiles")
     res = None
     for tile in tiles:
-        gdalinfo_command_list=['gdalinfo', '-json', tile]
-        log_the_command(gdalinfo_command_list)
-        gdalinfo = subprocess.Popen(gdalinfo_command_list,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        returncode = gdalinfo.wait()
-        if returncode != 0:
-            log_sig_err('gdalinfo return code {0}'.format(returncode), sigevent_url)
+        tileInfo = tile_info.get(tile)
+        if tileInfo is None:
+            log_sig_err('Unable to read image metadata for {0}'.format(tile), sigevent_url)
             return(False, next_x)
-        tileInfo = json.loads(gdalinfo.stdout.read())
 
-        tile_res_x = float(tileInfo["geoTransform"][1])
-        tile_res_y = float(tileInfo["geoTransform"][5])
+        tile_res_x = float(tileInfo["geotransform"][1])
+        tile_res_y = float(tileInfo["geotransform"][5])
 
         if not res:
             log_info_mssg("Input tile pixel size is: " + str(tile_res_x) + ", " + str(tile_res_y))
@@ -210,19 +530,12 @@ def is_global_image(tile, xmin, ymin, xmax, ymax):
     upper_left  = False
     lower_right = False
 
-    gdalinfo_command_list = ['gdalinfo', '-json', tile]
-    log_the_command(gdalinfo_command_list)
-    gdalinfo = subprocess.Popen(gdalinfo_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    returncode = gdalinfo.wait()
-    if returncode != 0:
-        log_sig_err('gdalinfo return code {0}'.format(returncode), sigevent_url)
+    tileInfo = tile_info.get(tile)
+    if tileInfo is None:
+        log_sig_err('Unable to read image metadata for {0}'.format(tile), sigevent_url)
         return False
-    tileInfo = json.loads(gdalinfo.stdout.read())
 
-    in_xmin = str(tileInfo["cornerCoordinates"]["upperLeft"][0])
-    in_ymax = str(tileInfo["cornerCoordinates"]["upperLeft"][1])
-    in_xmax = str(tileInfo["cornerCoordinates"]["lowerRight"][0])
-    in_ymin = str(tileInfo["cornerCoordinates"]["lowerRight"][1])
+    in_xmin, in_ymax, in_xmax, in_ymin = tileInfo["extents"]
 
     if int(round(float(in_xmin))) <= int(round(float(xmin))) and int(round(float(in_ymax))) >= int(round(float(ymax))):
         upper_left = True
@@ -243,26 +556,12 @@ def get_image_epsg(tile):
     """
     log_info_mssg("Getting image epsg")
 
-    gdalinfo_command_list = ['gdalinfo', '-json', tile]
-    log_the_command(gdalinfo_command_list)
-    gdalinfo = subprocess.Popen(gdalinfo_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    returncode = gdalinfo.wait()
-    if returncode != 0:
-        log_sig_err('gdalinfo return code {0}'.format(returncode), sigevent_url)
+    tileInfo = tile_info.get(tile)
+    if tileInfo is None:
+        log_sig_err('Unable to read image metadata for {0}'.format(tile), sigevent_url)
         return None
-    tileInfo = json.loads(gdalinfo.stdout.read())
-
-    wkt = tileInfo["coordinateSystem"]["wkt"]
 
-    epsg = None
-    if wkt != "":
-        lastAuth = wkt.rfind("AUTHORITY")
-        if lastAuth != -1:
-            m = re.search(".*EPSG.*([0-9]{4}).*", wkt[lastAuth:])
-            if m:
-                epsg = "EPSG:" + m.group(1)
-
-    return epsg
+    return tileInfo["epsg"]
 
 def get_image_extents(tile):
     """
@@ -272,25 +571,12 @@ def get_image_extents(tile):
     """
     log_info_mssg("Getting image extents")
 
-    gdalinfo_command_list = ['gdalinfo', '-json', tile]
-    log_the_command(gdalinfo_command_list)
-
-    gdalinfo = subprocess.Popen(gdalinfo_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    returncode = gdalinfo.wait()
-    if returncode != 0:
-        log_sig_err('gdalinfo return code {0}'.format(returncode), sigevent_url)
-    try:
-        tileInfo = json.loads(gdalinfo.stdout.read())
-
-        ulx = str(tileInfo["cornerCoordinates"]["upperLeft"][0])
-        uly = str(tileInfo["cornerCoordinates"]["upperLeft"][1])
-        lrx = str(tileInfo["cornerCoordinates"]["lowerRight"][0])
-        lry = str(tileInfo["cornerCoordinates"]["lowerRight"][1])
-
-        return [ulx, uly, lrx, lry]
-    except:
+    tileInfo = tile_info.get(tile)
+    if tileInfo is None:
         log_sig_exit('ERROR', "Error reading " + tile, sigevent_url)
 
+    return list(tileInfo["extents"])
+
 def has_color_table(tile):
     """
     Test if input tile has a color table
@@ -298,19 +584,12 @@ def has_color_table(tile):
         tile -- Tile to test
     """
     log_info_mssg("Checking for color table in " + tile)
-    has_color_table = False
-
-    gdalinfo_command_list=['gdalinfo', '-json', tile]
-    log_the_command(gdalinfo_command_list)
-    gdalinfo = subprocess.Popen(gdalinfo_command_list,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    returncode = gdalinfo.wait()
-    if returncode != 0:
-        log_sig_err('gdalinfo return code {0}'.format(returncode), sigevent_url)
-        return False
-    tileInfo = json.loads(gdalinfo.stdout.read())
 
-    for band in tileInfo["bands"]:
-        has_color_table |= "colorTable" in band
+    tileInfo = tile_info.get(tile)
+    if tileInfo is None:
+        log_sig_err('Unable to read image metadata for {0}'.format(tile), sigevent_url)
+        return False
+    has_color_table = tileInfo["color_table"]
 
     log_info_mssg(("No color table found", "Color table found in image")[has_color_table])
     return has_color_table
@@ -367,122 +646,405 @@ def mrf_block_align(extents, xmin, ymin, xmax, ymax, target_x, target_y, mrf_blo
 
     return (str(ulx), str(uly), str(lrx), str(lry))
 
-def gdalmerge(mrf, tile, extents, target_x, target_y, mrf_blocksize, xmin, ymin, xmax, ymax, nodata,
-              resize_resampling, working_dir, target_epsg):
+def mrf_block_footprint(extents, xmin, ymin, xmax, ymax, target_x, target_y, mrf_blocksize, target_epsg):
     """
-    Runs gdalmerge and returns merged tile
+    Returns the MRF base level blocks touched when a granule is inserted, as a list of (c0, r0, c1, r1) block ranges.
+    Uses the coarser mrf_block_align alignment, a superset of the blocks the inserter reads and writes.
     Arguments:
-        mrf -- An existing MRF file
-        tile -- Tile to insert
         extents -- spatial extents as ulx, uly, lrx, lry
-        target_x -- The target resolution for x
-        target_y -- The target resolution for y
-        mrf_blocksize -- The block size of MRF tiles
         xmin -- Minimum x value
         ymin -- Minimum y value
         xmax -- Maximum x value
         ymax -- Maximum y value
-        nodata -- nodata value
-        resize_resampling -- resampling method; nearest is used for PPNG
-        working_dir -- Directory to use for temporary files
-        target_epsg -- EPSG code for output tile
-    """
-    if resize_resampling == '':
-        resize_resampling = "average" # use average as default for RGBA
-    ulx, uly, lrx, lry = mrf_block_align(extents, xmin, ymin, xmax, ymax, target_x, target_y, mrf_blocksize)
-    new_tile = working_dir + os.path.basename(tile)+".merge.tif"
-
-    if has_color_table(tile) == True:
-        gdal_merge_command_list = ['gdal_merge.py', '-ul_lr', ulx, uly, lrx, lry, '-ps',
-                                   str((Decimal(xmax)-Decimal(xmin))/Decimal(target_x)),
-                                   str((Decimal(ymin)-Decimal(ymax))/Decimal(target_y)),
-                                   '-o', new_tile, '-of', 'GTiff', '-pct']
-        if nodata != "":
-            gdal_merge_command_list.append('-n')
-            gdal_merge_command_list.append(nodata)
-            gdal_merge_command_list.append('-a_nodata')
-            gdal_merge_command_list.append(nodata)
-        gdal_merge_command_list.append(mrf)
-        gdal_merge_command_list.append(tile)
-
-    else: # use gdalbuildvrt/gdalwarp/gdal_translate for RGBA imagery
-
-        # Build a VRT, adding SRS to the input. Technically, if this is a TIF we wouldn't have to do that
-        vrt_tile = working_dir + os.path.basename(tile) + ".vrt"
-        gdal_vrt_command_list = ['gdalbuildvrt', '-a_srs', target_epsg, vrt_tile, tile]
-        log_the_command(gdal_vrt_command_list)
-        gdal_vrt = subprocess.Popen(gdal_vrt_command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        insert_message = gdal_vrt.stdout.readlines()
-        for message in insert_message:
-            if 'ERROR' in str(message).upper():
-                log_sig_err("{0} in merging image (gdalbuildvrt) while processing {1}".format(message, tile), sigevent_url)
-            else:
-                log_info_mssg(str(message).strip())
-        returncode = gdal_vrt.wait()
-        if returncode != 0:
-            log_sig_err('gdalbuildvrt return code {0}'.format(returncode), sigevent_url)
-            return None
-        
-        # Warp the input image VRT to have the right resolution
-        warp_vrt_tile = working_dir + os.path.basename(tile) + ".warp.vrt"
-        gdal_warp_command_list = ['gdalwarp', '-overwrite', '-of', 'VRT', '-tr',
-                                  str((Decimal(xmax)-Decimal(xmin))/Decimal(target_x)),
-                                  str((Decimal(ymin)-Decimal(ymax))/Decimal(target_y)),
-                                  vrt_tile, warp_vrt_tile]
-        log_the_command(gdal_warp_command_list)
-        gdal_warp = subprocess.Popen(gdal_warp_command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        insert_message = gdal_warp.stdout.readlines()
-        for message in insert_message:
-            if 'ERROR' in str(message).upper():
-                log_sig_err("{0} in merging image (gdalwarp) while processing {1}".format(message, tile), sigevent_url)
-            else:
-                log_info_mssg(str(message).strip())
-        returncode = gdal_warp.wait()
-        if returncode != 0:
-            log_sig_err('gdalwarp return code {0}'.format(returncode), sigevent_url)
-            return None
-              
-        # Now build a combined VRT for both the input VRT and the MRF
-        combined_vrt_tile = working_dir + os.path.basename(tile) + ".combined.vrt"
-        gdal_vrt_command_list2 = ['gdalbuildvrt']
-        if nodata != "":
-            gdal_vrt_command_list2.extend(['-vrtnodata', nodata, '-srcnodata', nodata])
-        gdal_vrt_command_list2.extend([combined_vrt_tile, mrf, warp_vrt_tile])
-
-        log_the_command(gdal_vrt_command_list2)
-        gdal_vrt2 = subprocess.Popen(gdal_vrt_command_list2, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        insert_message = gdal_vrt2.stdout.readlines()
-        for message in insert_message:
-            if 'ERROR' in str(message).upper():
-                log_sig_err("{0} in merging image (gdalbuildvrt - 2) while processing {1}".format(message, tile), sigevent_url)
-            else:
-                log_info_mssg(str(message).strip())
-        returncode = gdal_vrt2.wait()
-        if returncode != 0:
-            log_sig_err('gdalbuildvrt return code {0}'.format(returncode), sigevent_url)
-            return None
-
-        # Create a merged VRT containing only the portion of the combined VRT we will insert back into the MRF
-        new_tile = working_dir + os.path.basename(tile)+".merge.vrt"
-        gdal_merge_command_list = ['gdal_translate', '-outsize',
-                                   str(int(round((Decimal(lrx)-Decimal(ulx))/((Decimal(xmax)-Decimal(xmin))/Decimal(target_x))))),
-                                   str(int(round((Decimal(lry)-Decimal(uly))/((Decimal(ymin)-Decimal(ymax))/Decimal(target_y))))),
-                                   '-projwin', ulx, uly, lrx, lry, '-of', 'VRT', combined_vrt_tile, new_tile]
-
-    # Execute the merge
-    log_the_command(gdal_merge_command_list)
-    gdal_merge = subprocess.Popen(gdal_merge_command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    insert_message = gdal_merge.stdout.readlines()
-    for message in insert_message:
-        if 'ERROR' in str(message).upper():
-            log_sig_err("{0} in merging image while processing {1}".format(message, tile), sigevent_url)
+        target_x -- The target resolution for x
+        target_y -- The target resolution for y
+        mrf_blocksize -- The block size of MRF tiles
+        target_epsg -- The target EPSG code
+    """
+    ulx, uly, lrx, lry = [Decimal(x) for x in extents]
+    t_xmin, t_ymin, t_xmax, t_ymax = [Decimal(x) for x in (xmin, ymin, xmax, ymax)]
+    width = t_xmax - t_xmin
+    uly, lry = min(uly, t_ymax), max(lry, t_ymin)
+
+    # Granules crossing the antimeridian are inserted as two halves, one on each edge of the MRF
+    if target_epsg in ['EPSG:4326', 'EPSG:3857'] and (ulx > lrx or lrx > t_xmax or ulx < t_xmin):
+        if ulx > lrx:
+            spans = [(ulx, t_xmax), (t_xmin, lrx)]
+        elif lrx > t_xmax:
+            spans = [(ulx, t_xmax), (t_xmin, lrx - width)]
         else:
-            log_info_mssg(str(message).strip())
-    returncode = gdal_merge.wait()
-    if returncode != 0: 
-        log_sig_err('gdal_translate return code {0}'.format(returncode), sigevent_url)
+            spans = [(ulx + width, t_xmax), (t_xmin, lrx)]
+    else: # polar and other granules are cropped to the target extents
+        spans = [(max(ulx, t_xmin), min(lrx, t_xmax))]
+
+    x_block = width / Decimal(target_x) * Decimal(mrf_blocksize)
+    y_block = (t_ymax - t_ymin) / Decimal(target_y) * Decimal(mrf_blocksize)
+    footprint = []
+    for s_ulx, s_lrx in spans:
+        if s_ulx >= s_lrx or uly <= lry:
+            continue
+        a_ulx, a_uly, a_lrx, a_lry = [Decimal(x) for x in mrf_block_align([str(s_ulx), str(uly), str(s_lrx), str(lry)],
+                                                                         xmin, ymin, xmax, ymax,
+                                                                         target_x, target_y, mrf_blocksize)]
+        footprint.append((int(math.floor((a_ulx - t_xmin) / x_block)), int(math.floor((t_ymax - a_uly) / y_block)),
+                          int(math.ceil((a_lrx - t_xmin) / x_block)), int(math.ceil((t_ymax - a_lry) / y_block))))
+    return footprint
+
+def insert_cost(tile, extents, target_x, target_y, target_extents, target_epsg, merge):
+    """
+    Estimates the relative work of inserting a tile, for scheduling.
+    The granule pixel area is weighted up for the extra passes run_mrf_insert makes: a gdalwarp when the resolution
+    differs from the target, a crop or split for tiles outside the target extents and a merge read-back.
+    Arguments:
+        tile -- Tile to insert
+        extents -- spatial extents of the tile as ulx, uly, lrx, lry
+        target_x -- The target resolution for x
+        target_y -- The target resolution for y
+        target_extents -- Full extents of the target imagery
+        target_epsg -- The target EPSG code
+        merge -- Merge over transparent regions of imagery
+    """
+    t_xmin, t_ymin, t_xmax, t_ymax = [float(x) for x in target_extents]
+    s_xmin, s_ymax, s_xmax, s_ymin = [float(x) for x in extents]
+    tileInfo = tile_info.get(tile)
+    if tileInfo is None:
+        return 1
+    x_size, y_size = tileInfo["size"]
+    cost = float(x_size * y_size)
+
+    res_x = (t_xmax - t_xmin) / float(target_x)
+    res_y = (t_ymax - t_ymin) / float(target_y)
+    tile_res_x, tile_res_y = abs(tileInfo["geotransform"][1]), abs(tileInfo["geotransform"][5])
+    if not math.isclose(tile_res_x, res_x, rel_tol=1e-9) or not math.isclose(tile_res_y, res_y, rel_tol=1e-9):
+        # warped to the target grid, the granule covers a different number of pixels
+        cost += abs(s_xmax - s_xmin) / res_x * abs(s_ymax - s_ymin) / res_y
+    if s_xmin > s_xmax or s_xmin < t_xmin or s_xmax > t_xmax or s_ymin < t_ymin or s_ymax > t_ymax:
+        cost *= 2
+    if merge:
+        cost *= 2
+    return max(cost, 1)
+
+def spatial_regions(tiles, target_x, target_y, mrf_blocksize, target_extents, target_epsg, merge):
+    """
+    Groups tiles into regions whose MRF block footprints are disjoint and returns (tiles, cost) pairs,
+    costliest first. Tiles that share a block end up in the same region, so they are never inserted or
+    merged concurrently, and keep their input order within it.
+    Arguments:
+        tiles -- List of tiles to insert
+        target_x -- The target resolution for x
+        target_y -- The target resolution for y
+        mrf_blocksize -- The block size of MRF tiles
+        target_extents -- Full extents of the target imagery
+        target_epsg -- The target EPSG code
+        merge -- Merge over transparent regions of imagery
+    """
+    t_xmin, t_ymin, t_xmax, t_ymax = target_extents
+    parent = list(range(len(tiles)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owners = {}
+    costs = []
+    for i, tile in enumerate(tiles):
+        extents = get_image_extents(tile)
+        costs.append(insert_cost(tile, extents, target_x, target_y, target_extents, target_epsg, merge))
+        for c0, r0, c1, r1 in mrf_block_footprint(extents, t_xmin, t_ymin, t_xmax, t_ymax,
+                                                   target_x, target_y, mrf_blocksize, target_epsg):
+            for r in range(r0, r1):
+                for c in range(c0, c1):
+                    if (c, r) in owners:
+                        a, b = find(owners[(c, r)]), find(i)
+                        if a != b:
+                            parent[max(a, b)] = min(a, b)
+                    else:
+                        owners[(c, r)] = i
+
+    regions = {}
+    for i, tile in enumerate(tiles):
+        region = regions.setdefault(find(i), [[], 0])
+        region[0].append(tile)
+        region[1] += costs[i]
+
+    log_info_mssg("Grouped {0} tiles into {1} disjoint block regions".format(len(tiles), len(regions)))
+    return [tuple(region) for region in sorted(regions.values(), key=lambda r: -r[1])]
+
+def partition_tiles(tiles, part, parts, target_x, target_y, mrf_blocksize, target_extents, target_epsg, merge):
+    """
+    Returns the tiles of one spatial partition of a distributed build, in input order. The disjoint block regions
+    of spatial_regions are dealt to the partitions costliest first, each to the partition with the lowest total
+    cost so far, so every node computes the same assignment from the same granules and no MRF block is written
+    by two partitions.
+    Arguments:
+        tiles -- List of tiles to insert
+        part -- Partition to return, 1 to parts
+        parts -- Number of partitions
+        target_x ... merge -- Same as spatial_regions
+    """
+    if target_y == '':
+        target_y = float(int(target_x)/2)
+    totals = [0] * parts
+    selected = set()
+    for region_tiles, cost in spatial_regions(tiles, target_x, target_y, mrf_blocksize, target_extents, target_epsg, merge):
+        owner = totals.index(min(totals))
+        totals[owner] += cost
+        if owner == part - 1:
+            selected.update(region_tiles)
+    log_info_mssg("Partition {0} of {1} has {2} of {3} tiles, estimated costs {4}".
+                  format(part, parts, len(selected), len(tiles), [int(total) for total in totals]))
+    return [tile for tile in tiles if tile in selected]
+
+def coalesce_key(tile, target_res, target_extents):
+    """
+    Returns what granules of a mosaic must share (bands and palette), or None if the granule can't be part of
+    one: it isn't at the target resolution, or it would be cropped or split across the antimeridian on insert
+    Arguments:
+        tile -- Granule to check
+        target_res -- Target pixel size as x, y
+        target_extents -- Full extents of the target imagery
+    """
+    tileInfo = tile_info.get(tile)
+    if tileInfo is None:
+        return None
+    t_xmin, t_ymin, t_xmax, t_ymax = [float(x) for x in target_extents]
+    s_xmin, s_ymax, s_xmax, s_ymin = [float(x) for x in tileInfo["extents"]]
+    if s_xmin >= s_xmax or s_ymin >= s_ymax or s_xmin < t_xmin or s_xmax > t_xmax or s_ymin < t_ymin or s_ymax > t_ymax:
+        return None
+    geotransform = tileInfo["geotransform"]
+    if geotransform[2] != 0 or geotransform[4] != 0 or \
+            not math.isclose(abs(geotransform[1]), target_res[0], rel_tol=1e-9) or \
+            not math.isclose(abs(geotransform[5]), target_res[1], rel_tol=1e-9):
         return None
-    return new_tile
+    return (tileInfo["bands"], tileInfo["color_table"], tileInfo["palette"])
+
+def extents_overlap(a, b):
+    a_xmin, a_ymax, a_xmax, a_ymin = [float(x) for x in a]
+    b_xmin, b_ymax, b_xmax, b_ymin = [float(x) for x in b]
+    return a_xmin < b_xmax and b_xmin < a_xmax and a_ymin < b_ymax and b_ymin < a_ymax
+
+def coalesce_tiles(tiles, target_x, target_y, mrf_blocksize, target_extents, target_epsg, nodata, merge, working_dir,
+                   max_blocks):
+    """
+    Replaces groups of granules that share MRF blocks with mosaic VRTs, so the blocks of a group are read, merged
+    and encoded by one insert instead of once per granule. Groups are runs of consecutive granules of a
+    spatial_regions region, so granules that overlap are still written in input order, and span at most
+    max_blocks base level blocks (the bounding box of their block footprints). Only granules at the target
+    resolution and inside the target extents, with the same bands and palette, are grouped. With merge, granules
+    of a group may only overlap if they have one band and a nodata value, which the mosaic skips like
+    the inserter does. Returns the new list of tiles, each mosaic in place of its first granule (see mosaics).
+    Arguments:
+        tiles ... merge -- Same as run_mrf_insert
+        working_dir -- Directory for the mosaic VRTs
+        max_blocks -- Maximum area of a group in MRF blocks
+    """
+    if target_y == '':
+        target_y = float(int(target_x)/2)
+    t_xmin, t_ymin, t_xmax, t_ymax = target_extents
+    target_res = ((float(t_xmax) - float(t_xmin)) / float(target_x), (float(t_ymax) - float(t_ymin)) / float(target_y))
+
+    def area(bounds):
+        return (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+
+    groups = []
+    for region_tiles, _ in spatial_regions(tiles, target_x, target_y, mrf_blocksize, target_extents, target_epsg, merge):
+        group, group_key, bounds = [], None, None
+        for tile in region_tiles:
+            key = coalesce_key(tile, target_res, target_extents)
+            footprint = None
+            if key is not None:
+                footprint = mrf_block_footprint(get_image_extents(tile), t_xmin, t_ymin, t_xmax, t_ymax,
+                                                target_x, target_y, mrf_blocksize, target_epsg)[0]
+            if group and key == group_key:
+                joined = (min(bounds[0], footprint[0]), min(bounds[1], footprint[1]),
+                          max(bounds[2], footprint[2]), max(bounds[3], footprint[3]))
+                may_overlap = not merge or (nodata != '' and key[0] == 1)
+                if area(joined) <= max_blocks and (may_overlap or not any(
+                        extents_overlap(get_image_extents(tile), get_image_extents(member)) for member in group)):
+                    group.append(tile)
+                    bounds = joined
+                    continue
+            if len(group) > 1:
+                groups.append(group)
+            if key is not None and area(footprint) <= max_blocks:
+                group, group_key, bounds = [tile], key, footprint
+            else:
+                group, group_key, bounds = [], None, None
+        if len(group) > 1:
+            groups.append(group)
+
+    # the mosaic is on the target grid, so run_mrf_insert inserts it without warping
+    options = {'resolution': 'user', 'xRes': target_res[0], 'yRes': target_res[1]}
+    if merge and nodata != '':
+        options.update(srcNodata=float(nodata), VRTNodata=float(nodata))
+    replaced = {}
+    coalesced = 0
+    for group in groups:
+        mosaic = scratch.path(working_dir, os.path.basename(group[0]) + "_mosaic.vrt")
+        log_info_mssg("gdal.BuildVRT {0} from {1} granules".format(mosaic, len(group)))
+        vrt = gdal.BuildVRT(mosaic, group, **options)
+        if vrt is None:
+            log_sig_warn("Unable to build mosaic {0}, inserting its granules one by one: {1}".
+                         format(mosaic, gdal.GetLastErrorMsg()), sigevent_url)
+            continue
+        vrt = None
+        tile_info.invalidate(mosaic)
+        mosaics[mosaic] = group
+        replaced[group[0]] = mosaic
+        replaced.update((member, None) for member in group[1:])
+        coalesced += len(group)
+
+    log_info_mssg("Coalesced {0} of {1} granules into {2} mosaics of at most {3} blocks".
+                  format(coalesced, len(tiles), len(mosaics), max_blocks))
+    return [replaced.get(tile, tile) for tile in tiles if replaced.get(tile, tile) is not None]
+
+def release_mosaics():
+    """
+    Removes the mosaic VRTs made by coalesce_tiles
+    """
+    for mosaic in list(mosaics.keys()):
+        scratch.remove(mosaic)
+    mosaics.clear()
+
+def covers_extents(tiles, target_x, target_y, mrf_blocksize, target_extents):
+    """
+    Returns True if every base level block of the MRF lies entirely inside at least one of the granules,
+    so a mosaic of them leaves no block empty. Granules crossing the antimeridian are not counted.
+    Arguments:
+        tiles -- List of granules
+        target_x, target_y -- The MRF size in pixels
+        mrf_blocksize -- The block size of MRF tiles
+        target_extents -- Full extents of the target imagery
+    """
+    t_xmin, t_ymin, t_xmax, t_ymax = [float(x) for x in target_extents]
+    x_size, y_size, blocksize = int(target_x), int(target_y), int(mrf_blocksize)
+    res_x = (t_xmax - t_xmin) / x_size
+    res_y = (t_ymax - t_ymin) / y_size
+    cols, rows = -(-x_size // blocksize), -(-y_size // blocksize)
+    covered = [bytearray(cols) for _ in range(rows)]
+
+    def inner_blocks(start, stop, size, count):
+        # blocks entirely between two pixel positions; the last, partial block only needs to reach the edge
+        first = int(math.ceil(start / blocksize - 1e-6))
+        last = count if stop >= size - 1e-6 else int(math.floor(stop / blocksize + 1e-6))
+        return max(first, 0), min(last, count)
+
+    for tile in tiles:
+        tileInfo = tile_info.get(tile)
+        if tileInfo is None:
+            continue
+        s_xmin, s_ymax, s_xmax, s_ymin = [float(x) for x in tileInfo["extents"]]
+        if s_xmin >= s_xmax or s_ymin >= s_ymax:
+            continue
+        c0, c1 = inner_blocks((s_xmin - t_xmin) / res_x, (s_xmax - t_xmin) / res_x, x_size, cols)
+        r0, r1 = inner_blocks((t_ymax - s_ymax) / res_y, (t_ymax - s_ymin) / res_y, y_size, rows)
+        if c0 < c1:
+            for r in range(r0, r1):
+                covered[r][c0:c1] = b'\x01' * (c1 - c0)
+    missing = sum(row.count(0) for row in covered)
+    log_info_mssg("Granules cover {0} of {1} MRF blocks".format(rows * cols - missing, rows * cols))
+    return missing == 0
+
+def can_build_direct(tiles, vrt, target_x, target_y, mrf_blocksize, target_extents, nodata, merge):
+    """
+    Returns True if copying the mosaic VRT of the granules into the new MRF gives the same base level as inserting
+    them one by one: the granules cover every block, are at the target resolution and inside the target extents
+    (see coalesce_key), and gdalbuildvrt composites them the way the inserter would. The VRT skips nodata pixels
+    band by band, so with a nodata value this needs merge and single band granules; without one it needs
+    overwriting inserts, or merge without an alpha band.
+    Arguments:
+        tiles -- List of granules
+        vrt -- The mosaic VRT the MRF is created from
+        target_x ... target_extents -- Same as covers_extents
+        nodata, merge -- Same as run_mrf_insert
+    """
+    ds = gdal.Open(vrt)
+    if ds is None or (ds.RasterXSize, ds.RasterYSize) != (int(target_x), int(target_y)):
+        log_info_mssg("{0} is not at the MRF size, inserting granules".format(vrt))
+        return False
+    ds = None
+    t_xmin, t_ymin, t_xmax, t_ymax = [float(x) for x in target_extents]
+    target_res = ((t_xmax - t_xmin) / float(target_x), (t_ymax - t_ymin) / float(target_y))
+    keys = set(coalesce_key(tile, target_res, target_extents) for tile in tiles)
+    if None in keys or len(keys) != 1:
+        log_info_mssg("Granules need warping, cropping or splitting, or have different bands, inserting granules")
+        return False
+    bands = keys.pop()[0]
+    if (nodata != '' and not (merge and bands == 1)) or (nodata == '' and merge and bands == 4):
+        log_info_mssg("The mosaic VRT would not merge granules like inserts do, inserting granules")
+        return False
+    return covers_extents(tiles, target_x, target_y, mrf_blocksize, target_extents)
+
+def copy_window_task(window, vrt, mrf):
+    """
+    Copies a pixel window of the mosaic VRT into the MRF base level, all bands at once. Runs in a worker
+    process of build_direct; returns an error message, or None.
+    """
+    x0, y0, x1, y1 = window
+    src = gdal.Open(vrt)
+    dst = gdal.Open(mrf, gdal.GA_Update)
+    if src is None or dst is None:
+        return "Unable to open {0} and {1}: {2}".format(vrt, mrf, gdal.GetLastErrorMsg())
+    data = src.ReadRaster(x0, y0, x1 - x0, y1 - y0)
+    if data is None or dst.WriteRaster(x0, y0, x1 - x0, y1 - y0, data) != gdal.CE_None:
+        return "Unable to copy window {0} of {1}: {2}".format(window, vrt, gdal.GetLastErrorMsg())
+    dst.FlushCache()
+    return None
+
+def build_direct(vrt, mrf, mrf_blocksize, no_cpus):
+    """
+    Fills the base level of a new, empty MRF from the mosaic VRT of granules that cover it, in one pass.
+    Windows of DIRECT_WINDOW_BLOCKS x DIRECT_WINDOW_BLOCKS blocks are copied in row-major block order, by a
+    pool of worker processes with mrf_parallel, which compress and append every block exactly once, so the data
+    file holds no replaced tiles to clean up. Returns the number of windows that failed.
+    Arguments:
+        vrt -- The mosaic VRT the MRF was created from
+        mrf -- The new MRF
+        mrf_blocksize -- The block size of MRF tiles
+        no_cpus (int) -- Maximum number of worker processes, used with mrf_parallel
+    """
+    ds = gdal.Open(mrf)
+    x_size, y_size = ds.RasterXSize, ds.RasterYSize
+    ds = None
+    step = int(mrf_blocksize) * DIRECT_WINDOW_BLOCKS
+    windows = [(x, y, min(x + step, x_size), min(y + step, y_size))
+               for y in range(0, y_size, step) for x in range(0, x_size, step)]
+    workers = max(1, min(multiprocessing.cpu_count(), no_cpus, len(windows))) if mrf_parallel else 1
+    log_info_mssg_with_timestamp("Copying {0} into {1} in {2} windows with {3} workers".
+                                 format(vrt, mrf, len(windows), workers))
+
+    func = functools.partial(copy_window_task, vrt=vrt, mrf=mrf)
+    if workers > 1:
+        # the header is only mp_safe while the workers write, so the MRF is the same as a serial copy
+        set_mp_safe(mrf)
+        try:
+            with poolcontext(processes=workers) as pool:
+                failures = [error for error in pool.imap(func, windows) if error is not None]
+        finally:
+            set_mp_safe(mrf, False)
+    else:
+        failures = [error for error in map(func, windows) if error is not None]
+    for error in failures:
+        log_sig_err(error, sigevent_url)
+    return len(failures)
+
+def set_image_ullr(tile, ullr):
+    """
+    Assigns new corner coordinates to an image in place, like gdal_edit.py -a_ullr. Returns False on failure
+    Arguments:
+        tile -- Image to edit (e.g. a VRT)
+        ullr -- New extents as ulx, uly, lrx, lry
+    """
+    ulx, uly, lrx, lry = [float(x) for x in ullr]
+    ds = gdal.Open(tile, gdal.GA_Update)
+    if ds is None:
+        return False
+    ds.SetGeoTransform([ulx, (lrx - ulx) / ds.RasterXSize, 0, uly, 0, (lry - uly) / ds.RasterYSize])
+    ds = None
+    tile_info.invalidate(tile)
+    return True
 
 def split_across_antimeridian(tile, source_extents, antimeridian, xres, yres, working_dir):
     """
@@ -495,7 +1057,7 @@ def split_across_antimeridian(tile, source_extents, antimeridian, xres, yres, wo
         yres -- output y resolution
         working_dir -- Directory to use for temporary files
     """
-    temp_tile = working_dir + os.path.basename(tile) + '.temp.vrt'
+    temp_tile = scratch.path(working_dir, os.path.basename(tile) + '.temp.vrt')
     log_info_mssg("Splitting across antimeridian with " + temp_tile)
     ulx, uly, lrx, lry = source_extents
     if Decimal(lrx) <= Decimal(antimeridian):
@@ -519,34 +1081,21 @@ def split_across_antimeridian(tile, source_extents, antimeridian, xres, yres, wo
     cutline_right = cutline_template.replace('$values',cutline_values.format(Decimal(antimeridian), Decimal(uly), Decimal(new_lrx), Decimal(lry)))
 
     # Create VRT of input tile
-    gdalbuildvrt_command_list = ['gdalwarp', '-overwrite', '-of', 'VRT', '-tr', xres, yres, tile, temp_tile]
-    log_the_command(gdalbuildvrt_command_list)
-    gdalbuildvrt = subprocess.Popen(gdalbuildvrt_command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    insert_message = gdalbuildvrt.stdout.readlines()
-    err = False
-    for message in insert_message:
-        if 'ERROR' in str(message).upper():
-            log_sig_err("{0} in building VRT (gdalwarp) while processing {1}".format(message, tile), sigevent_url)
-            err = True
-        else:
-            log_info_mssg(str(message).strip())
-    returncode = gdalbuildvrt.wait()
-    if returncode != 0: 
-        log_sig_err('gdalwarp return code {0}'.format(returncode), sigevent_url)
-    if returncode != 0 or err:
+    log_info_mssg("gdal.Warp {0} -> {1} (VRT, -tr {2} {3})".format(tile, temp_tile, xres, yres))
+    temp = gdal.Warp(temp_tile, tile, format='VRT', xRes=float(xres), yRes=float(yres))
+    if temp is None:
+        log_sig_err("{0} in building VRT (gdalwarp) while processing {1}".format(gdal.GetLastErrorMsg(), tile), sigevent_url)
         return (None, None)
+    temp = None
+    tile_info.invalidate(temp_tile)
     tile = temp_tile
     tile_left = tile + ".left_cut.vrt"
     tile_right = tile + ".right_cut.vrt"
 
     if Decimal(source_extents[2]) <= Decimal(antimeridian):
         # modify input into >180 space if not already
-        gdal_edit_command_list = ['gdal_edit.py', tile, '-a_ullr', new_lrx, uly, ulx, lry]
-        log_the_command(gdal_edit_command_list)
-        gdal_edit = subprocess.Popen(gdal_edit_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        returncode = gdal_edit.wait()
-        if returncode != 0: 
-            log_sig_err('gdal_edit.py return code {0}'.format(returncode), sigevent_url)
+        if not set_image_ullr(tile, [new_lrx, uly, ulx, lry]):
+            log_sig_err('Unable to set bounds of {0}: {1}'.format(tile, gdal.GetLastErrorMsg()), sigevent_url)
 
     # Cut the input at the antimeridian into left and right halves
 
@@ -555,17 +1104,12 @@ def split_across_antimeridian(tile, source_extents, antimeridian, xres, yres, wo
         log_info_mssg("Skipping left_cut for granule because the resulting image would be < 1 pixel wide")
         tile_left = None
     else:
-        left_cut_command_list = ['gdalwarp', '-overwrite', '-of', 'VRT', '-crop_to_cutline', '-cutline', cutline_left, tile, tile_left]
-
-        log_the_command(left_cut_command_list)
-        left_cut = subprocess.Popen(left_cut_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        returncode = left_cut.wait()
-        left_cut_stderr = left_cut.stderr.read()
-
-        if len(left_cut_stderr) > 0:
-            log_sig_err(left_cut_stderr, sigevent_url)
-        if returncode != 0:
-            log_sig_err('left_cut (gdalwarp) return code {0}'.format(returncode), sigevent_url)
+        log_info_mssg("gdal.Warp {0} -> {1} (VRT, -crop_to_cutline)".format(tile, tile_left))
+        left_cut = gdal.Warp(tile_left, tile, format='VRT', cutlineDSName=cutline_left, cropToCutline=True)
+        if left_cut is None:
+            log_sig_err('left_cut (gdalwarp) failed: {0}'.format(gdal.GetLastErrorMsg()), sigevent_url)
+        left_cut = None
+        tile_info.invalidate(tile_left)
 
     if tile_right.count('.right_cut.vrt') > 1:
         # Something is wrong here; prevent going into a loop
@@ -576,24 +1120,15 @@ def split_across_antimeridian(tile, source_extents, antimeridian, xres, yres, wo
         log_info_mssg("Skipping right_cut for granule because the resulting image would be < 1 pixel wide")
         tile_right = None
     else:
-        right_cut_command_list = ['gdalwarp', '-overwrite', '-of', 'VRT', '-crop_to_cutline', '-cutline', cutline_right,
-                                  tile, tile_right]
-        log_the_command(right_cut_command_list)
-        right_cut = subprocess.Popen(right_cut_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        returncode = right_cut.wait()
-        right_cut_stderr = right_cut.stderr.read()
-        if len(right_cut_stderr) > 0:
-            log_sig_err(right_cut_stderr, sigevent_url)
-        if returncode != 0:
-            log_sig_err('right_cut (gdalwarp) return code {0}'.format(returncode), sigevent_url)
+        log_info_mssg("gdal.Warp {0} -> {1} (VRT, -crop_to_cutline)".format(tile, tile_right))
+        right_cut = gdal.Warp(tile_right, tile, format='VRT', cutlineDSName=cutline_right, cropToCutline=True)
+        if right_cut is None:
+            log_sig_err('right_cut (gdalwarp) failed: {0}'.format(gdal.GetLastErrorMsg()), sigevent_url)
+        right_cut = None
 
         # flip the origin longitude of the right half
-        gdal_edit_command_list = ['gdal_edit.py', tile_right, '-a_ullr', str(Decimal(antimeridian) * -1), uly, lrx, lry]
-        log_the_command(gdal_edit_command_list)
-        gdal_edit = subprocess.Popen(gdal_edit_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        returncode = gdal_edit.wait()
-        if returncode != 0:
-            log_sig_err('gdal_edit.py return code {0}'.format(returncode), sigevent_url)
+        if not set_image_ullr(tile_right, [str(Decimal(antimeridian) * -1), uly, lrx, lry]):
+            log_sig_err('Unable to set bounds of {0}: {1}'.format(tile_right, gdal.GetLastErrorMsg()), sigevent_url)
         print("Cut and edited tile_right extents: " + ",".join(get_image_extents(tile_right)))
 
     return (tile_left, tile_right)
@@ -617,10 +1152,13 @@ def crop_to_extents(tile, tile_extents, projection_extents, working_dir):
         lrx = xmax
     if float(lry) < float(ymin):
         lry = ymin
-    cut_tile = working_dir + os.path.basename(tile) + '._cut.vrt'
-    gdalwarp_command_list = ['gdalwarp', '-overwrite', '-of', 'VRT', '-te', ulx, lry, lrx, uly, tile, cut_tile]
-    log_the_command(gdalwarp_command_list)
-    subprocess.call(gdalwarp_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cut_tile = scratch.path(working_dir, os.path.basename(tile) + '._cut.vrt')
+    log_info_mssg("gdal.Warp {0} -> {1} (VRT, -te {2} {3} {4} {5})".format(tile, cut_tile, ulx, lry, lrx, uly))
+    cut = gdal.Warp(cut_tile, tile, format='VRT', outputBounds=[float(ulx), float(lry), float(lrx), float(uly)])
+    if cut is None:
+        log_sig_err("Unable to crop {0} to extents: {1}".format(tile, gdal.GetLastErrorMsg()), sigevent_url)
+    cut = None
+    tile_info.invalidate(cut_tile)
     return cut_tile
 
 @contextmanager
@@ -659,91 +1197,313 @@ class rw_lock:
         self.cond.notify()
         self.cond.release()
 
-lock = rw_lock() # used to ensure that gdal_merge doesn't happen at the same time as a parallel insert
+lock = rw_lock() # keeps clean_mrf from rewriting the data file while parallel workers are inserting
+
+def update_overviews(mrf, insert_method, windows):
+    """
+    Regenerates only the overview blocks that descend from the base level windows written by the inserts, level by
+    level, and leaves every other overview block in the data file untouched. Windows that an interrupted run inserted
+    but never patched are included. Each level is built in parallel stripes when mrf_parallel is set.
+    The MRF must not be open in an inserter.
+    Arguments:
+        mrf -- An existing MRF file
+        insert_method -- The resampling method to use without mrf_incremental_overviews, or if overview_resampling
+                         isn't supported by mrf_pyramid {Avg, NNb}
+        windows -- List of base level pixel windows (x0, y0, x1, y1) that were written
+    """
+    if partition is not None:
+        log_info_mssg("Partial MRF {0}, overviews are built when the partitions are combined".format(mrf))
+        return
+    windows = list(windows)
+    if journal is not None:
+        windows += journal.deferred_windows()
+    if len(windows) > 0:
+        sampling = overview_sampling or insert_method
+        workers = max(1, min(multiprocessing.cpu_count() - 1, mrf_cores)) if mrf_parallel else 1
+        if workers > 1:
+            set_mp_safe(mrf)
+        log_info_mssg_with_timestamp("Patching overviews for {} inserted windows in {} ({}, {} workers)".
+                                     format(len(windows), mrf, sampling, workers))
+        try:
+            with metrics.stage('patch_overviews'):
+                written = build_overviews(mrf, sampling, windows, workers)
+            log_info_mssg_with_timestamp("Wrote {} overview blocks in {}".format(written, mrf))
+        except (IOError, RuntimeError) as e:
+            log_sig_err("Unable to build overviews for {0}: {1}".format(mrf, e), sigevent_url)
+            return
+    if journal is not None:
+        journal.record_stage('patch_overviews')
+
+def serial_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
+                      target_extents, target_epsg, nodata, merge, working_dir):
+    """
+    Inserts tiles one after the other, then patches the overviews once over all the blocks that were written,
+    so overlapping tiles don't rebuild the same overview blocks repeatedly. Runs mrf_clean when mrf_maxsize is reached.
+    Arguments:
+        tiles ... working_dir: Same as mrf_insert
+    """
+    inserter = get_inserter(mrf, insert_method)
+    inserter.defer_overviews = True
+    errors = run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
+                            target_extents, target_epsg, nodata, merge, working_dir, max_size=mrf_maxsize)
+    touched = list(inserter.touched)
+    release_inserter(mrf)
+    update_overviews(mrf, insert_method, touched)
+    return errors
+
+def input_size(tile):
+    """
+    Returns the size in bytes of a tile to insert: the sizes of its granules for a mosaic VRT made by
+    coalesce_tiles, and the size of the file for other /vsi and local paths (0 if it cannot be found)
+    Arguments:
+        tile -- Tile to insert
+    """
+    if tile in mosaics:
+        return sum(input_size(member) for member in mosaics[tile])
+    if tile.startswith('/vsi'):
+        stats = gdal.VSIStatL(tile)
+        return 0 if stats is None else stats.size
+    try:
+        return os.stat(tile).st_size
+    except OSError:
+        return 0
 
 def parallel_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
                         target_extents, target_epsg, nodata, merge, working_dir, no_cpus):
     """
     Launches multiple workers each handling a fraction of the tiles to be merged into the final mrf file.
-    Also sets the mrf to be mp_safe to allow for simultaneous access. Generally 2-4 workers is ideal.
-    There can be some degredation in performance for large numbers of workers. We use the rw_lock to
-    synchronize access between the processes, since gdal_merge must be performed while no other process is running
-    mrf_insert. If mrf_maxsize is None, will run mrf_insert with max_size max(2 * total size of input tiles, 50GB).
+    Also sets the mrf to be mp_safe to allow for simultaneous access. Tiles are grouped into regions of MRF blocks
+    that no other region touches (see spatial_regions) and each region is a single task, so overlapping tiles are
+    always inserted and merged by the same worker without a global lock. Tasks are queued costliest first and
+    handed out one at a time, so idle workers pull the largest remaining region (LPT scheduling). no_cpus is a
+    maximum; fewer workers are started when there are fewer regions. Workers only write the base level; the
+    overviews covering all inserted blocks are patched once the pool has finished.
+    If mrf_maxsize is None, will run mrf_insert with max_size max(2 * total size of input tiles, 50GB).
     Otherwise uses mrf_maxsize.
 
     Arguments:
         tiles ... working_dir: Same as mrf_insert
-        no_cpus (int) -- Number of CPUs to run mrf_insert in parallel
+        no_cpus (int) -- Maximum number of CPUs to run mrf_insert in parallel
     """
 
     log_info_mssg("parallel_mrf_insert with mrf {}".format(mrf))
 
-    no_pools = min(multiprocessing.cpu_count() - 1, len(tiles), no_cpus)
+    regions = []
+    if len(tiles) > 1 and min(multiprocessing.cpu_count() - 1, no_cpus) > 1:
+        if target_y == '':
+            target_y = float(int(target_x)/2)
+        regions = spatial_regions(tiles, target_x, target_y, mrf_blocksize, target_extents, target_epsg, merge)
+
+    no_pools = min(multiprocessing.cpu_count() - 1, len(regions), no_cpus)
     log_info_mssg("no_pools for parallel mrf_insert is {} for mrf {}".format(no_pools, mrf))
 
-    if len(tiles) == 1 or no_pools == 1:
-        log_info_mssg("making serial call since not enough tiles or cores")
-        errors =  run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
-                                 target_extents, target_epsg, nodata, merge, working_dir, max_size=mrf_maxsize)
+    if no_pools <= 1:
+        log_info_mssg("making serial call since not enough tiles, disjoint regions or cores")
+        errors = serial_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
+                                   target_extents, target_epsg, nodata, merge, working_dir)
     else:
         if mrf_maxsize is None:
-            total_size = sum([os.stat(tile).st_size for tile in tiles])
+            total_size = sum([input_size(tile) for tile in tiles])
             max_size = max(2 * total_size, 50E9)
         else:
             max_size = mrf_maxsize
 
         log_info_mssg("making parallel call with length of tiles is {}, mrf is {}, max_size is {} bytes\n".format(len(tiles), mrf, max_size))
 
-        func = functools.partial(run_mrf_insert, mrf=mrf, insert_method = insert_method, \
+        func = functools.partial(run_mrf_insert_worker, mrf=mrf, insert_method = insert_method, \
                                  resize_resampling = resize_resampling, target_x = target_x, target_y = target_y, \
                                  mrf_blocksize = mrf_blocksize, target_extents = target_extents, target_epsg = target_epsg, \
                                  nodata = nodata, merge = merge, working_dir = working_dir, mp_safe=True, max_size=max_size)
 
-        with open(mrf) as f: # make mp_safe
-            data = f.read()
-            data = data.replace("<Raster>", "<Raster mp_safe=\"on\">")
-
-        with open(mrf, "w") as f: # overwrite mrf
-            f.write(data)
+        set_mp_safe(mrf)
 
-        log_info_mssg("Splitting list of length {} into chunks of size {}".format(len(tiles), len(tiles) // no_pools))
-
-        def chunks(l, n):
-            for i in range(0, len(l), n):
-                yield l[i:i+n]
-
-        random.shuffle(tiles) # shuffle tiles to avoid overlaps as much as possible
-        partition = chunks(tiles, len(tiles) // no_pools)
+        log_info_mssg("Queued {} regions for {} workers, estimated costs {}".format(len(regions), no_pools,
+                                                                                  [int(cost) for _, cost in regions]))
 
+        # one region per task, largest first; imap_unordered hands the next one to whichever worker is idle
+        results = []
         with poolcontext(processes=no_pools) as pool:
-            results = pool.map(func, partition, 1)
+            for result in pool.imap_unordered(func, [region_tiles for region_tiles, _ in regions], 1):
+                results.append(result)
+                log_info_mssg("mrf {} finished {} of {} regions".format(mrf, len(results), len(regions)))
 
-        log_info_mssg("mrf {} map finished, results are type {}, {}".format(mrf, type(results), results))
+        log_info_mssg("mrf {} map finished, errors are {}".format(mrf, [r[0] for r in results]))
 
-        errors = sum(results)
+        errors = sum([r[0] for r in results])
+        for r in results:
+            metrics.merge(r[2])
+
+        # overviews span partitions, so they are only patched here once every worker is done
+        release_inserter(mrf)
+        update_overviews(mrf, insert_method, [window for r in results for window in r[1]])
 
     log_info_mssg("Errors {}, mrf {}".format(errors, mrf))
 
     return errors
 
-def clean_mrf(data_filename): # cleans mrf files in place.
-    def index_name(mrf_name):
-        bname, ext = os.path.splitext(mrf_name)
-        return bname + os.extsep + "idx"
+def run_mrf_insert_worker(tiles, **kwargs):
+    """
+    Pool entry point for run_mrf_insert. Only the base level is written; returns the number of errors, the
+    list of base level windows that were inserted, so the parent can patch the overviews, and the worker's metrics.
+    Closes the worker's handle on the MRF once its tiles are inserted.
+    Arguments:
+        tiles -- List of tiles to insert
+        kwargs -- Remaining run_mrf_insert arguments
+    """
+    metrics.reset() # only report this worker's own stages
+    inserter = get_inserter(kwargs['mrf'], kwargs['insert_method'])
+    inserter.defer_overviews = True
+    errors = run_mrf_insert(tiles, **kwargs)
+    touched = list(inserter.touched)
+    release_inserter(kwargs['mrf'])
+    return errors, touched, metrics.stages
+
+def palettize_task(task, colors, fill, validate):
+    """
+    Pool worker for the palette stage: converts (or only validates) one granule with mrf_palette
+    Arguments:
+        task -- (position in alltiles, granule, output PNG or None to only validate)
+        colors, fill, validate -- As for mrf_palette.palettize
+    """
+    i, tile, output_tile = task
+    return i, palettize(tile, output_tile, colors, fill, validate)
 
-    bname, ext = os.path.splitext(data_filename)
-    target_path = bname + os.extsep + "tmp" + ext
+def encoded_scale_offset(band):
+    """
+    Returns the (scale, offset) of a band that is already encoded, or None
+    Arguments:
+        band -- Band 1 of a TIFF granule
+    """
+    scale, offset = band.GetScale(), band.GetOffset()
+    # gdalinfo only reports Offset and Scale when they aren't the defaults
+    if scale is not None and offset is not None and (scale != 1 or offset != 0):
+        return scale, offset
+    return None
 
-    mrf_status = subprocess.Popen(["mrf_clean.py", data_filename, target_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = mrf_status.communicate()
+def whole(value):
+    """
+    Scales and offsets are whole numbers unless given in the configuration
+    """
+    return int(value) if float(value).is_integer() else float(value)
 
-    log_info_mssg(out)
+EPNGStats = collections.namedtuple('EPNGStats', ['tile', 'encoding', 'minmax', 'error'])
 
-    if mrf_status.returncode != 0:
-        log_info_mssg("mrf_clean returned with status code {}".format(mrf_status.returncode))
+def epng_stats_task(task, threads):
+    """
+    Pool worker for the first pass of the EPNG stage: returns (position in alltiles, EPNGStats) with either the
+    (scale, offset) of a TIFF that is already encoded or the (minimum, maximum) of a TIFF to pack
+    Arguments:
+        task -- (position in alltiles, TIFF granule)
+        threads -- Number of threads reading the TIFF
+    """
+    i, tile = task
+    try:
+        ds = gdal.Open(tile)
+        if ds is None:
+            return i, EPNGStats(tile, None, None, gdal.GetLastErrorMsg())
+        encoding = encoded_scale_offset(ds.GetRasterBand(1))
+        ds = None
+        if encoding is not None:
+            return i, EPNGStats(tile, tuple(whole(v) for v in encoding), None, None)
+        return i, EPNGStats(tile, None, source_minmax(tile, threads=threads), None)
+    except RuntimeError as e:
+        return i, EPNGStats(tile, None, None, str(e))
+
+EPNGResult = collections.namedtuple('EPNGResult', ['tile', 'output', 'scale', 'offset', 'palette', 'error'])
+
+def encode_epng_task(task, working_dir, scale_offset, threads):
+    """
+    Pool worker for the EPNG stage: packs a TIFF with overtiffpacker unless it is already encoded, and converts it to
+    PNG. Returns (position in alltiles, EPNGResult) with the scale and offset of the encoding.
+    Arguments:
+        task -- (position in alltiles, TIFF granule)
+        working_dir -- Directory for the encoded TIFF and the PNG
+        scale_offset -- [scale, offset] shared by all the granules to pack with
+        threads -- Number of threads for the packer
+    """
+    i, tile = task
+    tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
+    output_tile = working_dir+tile_basename+'.png'
+    try:
+        ds = gdal.Open(tile)
+        if ds is None:
+            return i, EPNGResult(tile, None, None, None, False, gdal.GetLastErrorMsg())
+        band = ds.GetRasterBand(1)
+        palette = band.GetColorTable() is not None
+        encoding = encoded_scale_offset(band)
+        ds = None
+        if encoding is not None:
+            scale, offset = encoding
+            log_info_mssg("{0} is already an encoded TIFF".format(tile))
+        else: # Encode the TIFF file
+            encoded_tile = working_dir+tile_basename+'_encoded.tif'
+            log_info_mssg("{0} will be encoded as {1}".format(tile, encoded_tile))
+            scale, offset = pack(tile, encoded_tile, False, True, None, None, scale_offset, False, threads=threads)
+            tile = encoded_tile
+
+        # Convert the tile to PNG
+        log_info_mssg("Converting {0} to {1}".format(tile, output_tile))
+        png = gdal.Translate(output_tile, tile, format='PNG')
+        if png is None:
+            return i, EPNGResult(tile, None, None, None, palette, gdal.GetLastErrorMsg())
+        png = None
+    except (RuntimeError, AssertionError) as e:
+        return i, EPNGResult(tile, None, None, None, False, str(e))
+    return i, EPNGResult(task[1], output_tile, whole(scale), whole(offset), palette, None)
 
-    os.rename(target_path, data_filename)
-    os.rename(index_name(target_path), index_name(data_filename))
+def clean_mrf(data_filename): # cleans mrf files in place.
+    # the data file shrinks, so the next garbage check is measured from its new size
+    garbage_checks.pop(data_filename, None)
+    if mrf_dedup:
+        # also drops unreferenced bytes, so it replaces mrf_compact; the seeded empty tile is kept at the start
+        report = dedup_mrf(data_filename, prefix=mrf_empty_tile_bytes)
+        log_info_mssg("mrf_dedup {0}: {1}".format(data_filename, format_report(report)))
+        return
+
+    report = compact_mrf(data_filename, prefix=mrf_empty_tile_bytes)
+    log_info_mssg("mrf_compact {0}: {1}".format(data_filename, format_compaction(report)))
+
+def finish_mrf(data_filename, mrf_filename):
+    """
+    Final cleaning of the data file once all tiles are inserted: deduplication and/or compaction, with the tiles
+    rewritten in the mrf_layout order. Logs the resulting locality of neighboring tiles.
+    Arguments:
+        data_filename -- The MRF data file
+        mrf_filename -- The MRF header
+    """
+    if mrf_dedup:
+        report = dedup_mrf(data_filename, prefix=mrf_empty_tile_bytes)
+        log_info_mssg("mrf_dedup {0}: {1}".format(data_filename, format_report(report)))
+    # partial MRFs are concatenated by mrf_combine.py, which applies the layout to the combined MRF
+    layout = mrf_layout if partition is None else 'file'
+    # mrf_dedup already wrote the tiles in index order and without dead bytes
+    if layout != 'file' and not (mrf_dedup and layout == 'index'):
+        report = compact_mrf(data_filename, prefix=mrf_empty_tile_bytes, layout=layout, mrf_filename=mrf_filename)
+        log_info_mssg("mrf_compact {0} ({1} layout): {2}".format(data_filename, layout, format_compaction(report)))
+    elif not mrf_dedup:
+        report = compact_mrf(data_filename, prefix=mrf_empty_tile_bytes)
+        log_info_mssg("mrf_compact {0}: {1}".format(data_filename, format_compaction(report)))
+    log_info_mssg("mrf_layout {0}: {1}".format(mrf_filename, format_locality(MRFIndex(mrf_filename).locality())))
+
+garbage_checks = {} # data file -> size it must reach before its garbage ratio is measured again
+
+def needs_cleaning(data_filename, max_size):
+    """
+    Returns True when an MRF data file is larger than max_size and at least mrf_garbage_ratio of it is unreferenced
+    Arguments:
+        data_filename -- The MRF data file
+        max_size -- Data file size in bytes below which it is never cleaned
+    """
+    size = os.stat(data_filename).st_size
+    if size <= max(max_size, garbage_checks.get(data_filename, 0)):
+        return False
+    report = measure_garbage(data_filename, prefix=mrf_empty_tile_bytes)
+    if report.dead_bytes >= mrf_garbage_ratio * report.file_bytes:
+        return True
+    # even if everything appended from now on is garbage, the ratio can't be reached below this size
+    garbage_checks[data_filename] = size + (mrf_garbage_ratio * size - report.dead_bytes) / (1 - mrf_garbage_ratio)
+    log_info_mssg("not cleaning data file {0}, {1}".format(data_filename, format_compaction(report)))
+    return False
 
 def run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
                    target_extents, target_epsg, nodata, merge, working_dir, mp_safe=False, max_size=None):
@@ -772,7 +1532,6 @@ def run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, targe
     if target_y == '':
         target_y = float(int(target_x)/2)
     log_info_mssg("Inserting new tiles into " + mrf)
-    mrf_insert_command_list = ['mrf_insert', '-r', insert_method]
 
     should_lock = mp_safe
 
@@ -784,6 +1543,9 @@ def run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, targe
         return bname + os.extsep + get_extension(mrf_compression_type)
 
     for i, tile in enumerate(tiles):
+        source_tile = tile
+        source_errors = errors
+        granule_metrics = metrics.start()
         if should_lock:
             lock.down_read()
 
@@ -814,6 +1576,9 @@ def run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, targe
 
             errors += run_mrf_insert([cut_tile], mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
                                      target_extents, target_epsg, nodata, True, working_dir)
+            if journal is not None and errors == source_errors:
+                journal.record_tile(source_tile)
+            scratch.release(os.path.basename(source_tile))
             continue
 
         elif target_epsg in ['EPSG:4326','EPSG:3857'] and ((float(s_xmin) > float(s_xmax)) or
@@ -844,25 +1609,12 @@ def run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, targe
                                          mrf_blocksize, target_extents, target_epsg, nodata, True, working_dir)
             else:
                 log_sig_err("No tiles to insert after splitting across antimeridian", sigevent_url)
+            if journal is not None and errors == source_errors:
+                journal.record_tile(source_tile)
+            scratch.release(os.path.basename(source_tile))
             continue
 
-        if merge: # merge tile with existing imagery if true
-            if should_lock:
-                lock.up_read()
-                lock.down_write()
-
-            tile = gdalmerge(mrf, tile, [s_xmin, s_ymax, s_xmax, s_ymin], target_x, target_y, mrf_blocksize,
-                             t_xmin, t_ymin, t_xmax, t_ymax, nodata, resize_resampling, working_dir, target_epsg)
-            
-            if tile is None:
-                errors += 1
-                return errors
-
-            if should_lock:
-                lock.up_write()
-                lock.down_read()
-
-        vrt_tile = working_dir + os.path.basename(tile)+".vrt"
+        vrt_tile = scratch.path(working_dir, os.path.basename(tile)+".vrt")
 
         diff_res, ps = diff_resolution([tile, mrf])
 
@@ -871,79 +1623,50 @@ def run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, targe
             if resize_resampling == '':
                 resize_resampling = "near" # use nearest neighbor as default
 
-            tile_vrt_command_list = ['gdalwarp', '-of', 'VRT', '-r', resize_resampling, '-overwrite', '-tr',
-                                     str((Decimal(t_xmax)-Decimal(t_xmin))/Decimal(target_x)),
-                                     str((Decimal(t_ymin)-Decimal(t_ymax))/Decimal(target_y))]
+            tile_vrt_options = {'format': 'VRT', 'resampleAlg': resize_resampling,
+                                'xRes': float((Decimal(t_xmax)-Decimal(t_xmin))/Decimal(target_x)),
+                                'yRes': float((Decimal(t_ymin)-Decimal(t_ymax))/Decimal(target_y))}
 
             # build the vrt for the entire projection if we have one image that covers the entire projection
             # TODO ... not sure this is needed actually...
             if is_global_image(tile, t_xmin, t_ymin, t_xmax, t_ymax) and len(tiles) == 1:
-                tile_vrt_command_list.append('-te')
-                tile_vrt_command_list.append(t_xmin)
-                tile_vrt_command_list.append(t_ymin)
-                tile_vrt_command_list.append(t_xmax)
-                tile_vrt_command_list.append(t_ymax)
-
-            tile_vrt_command_list.append(tile)
-            tile_vrt_command_list.append(vrt_tile)
-            log_the_command(tile_vrt_command_list)
-            tile_vrt = subprocess.Popen(tile_vrt_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            returncode = tile_vrt.wait()
-            if returncode != 0:
-                log_sig_err('build tile VRT (gdalwarp) return code {0}'.format(returncode), sigevent_url)
-
-            if merge: # merge tile with existing imagery
-                if should_lock:
-                    lock.up_read()
-                    lock.down_write()
-
-                s_xmin, s_ymax, s_xmax, s_ymin = get_image_extents(vrt_tile) # get new extents
-                log_info_mssg("Image extents " + str(extents))
-                tile = gdalmerge(mrf, vrt_tile, [s_xmin, s_ymax, s_xmax, s_ymin], target_x, target_y, mrf_blocksize,
-                                 t_xmin, t_ymin, t_xmax, t_ymax, nodata, resize_resampling, working_dir, target_epsg)
-                if tile is None:
-                    errors += 1
-                    return errors
-                mrf_insert_command_list.append(tile)
-
-                if should_lock:
-                    lock.up_write()
-                    lock.down_read()
-
-            else:
-                mrf_insert_command_list.append(vrt_tile)
+                tile_vrt_options['outputBounds'] = [float(t_xmin), float(t_ymin), float(t_xmax), float(t_ymax)]
+
+            log_info_mssg("gdal.Warp {0} -> {1} {2}".format(tile, vrt_tile, tile_vrt_options))
+            tile_vrt = gdal.Warp(vrt_tile, tile, **tile_vrt_options)
+            if tile_vrt is None:
+                log_sig_err('build tile VRT (gdalwarp) failed: {0}'.format(gdal.GetLastErrorMsg()), sigevent_url)
+            tile_vrt = None
+            tile_info.invalidate(vrt_tile)
+            insert_tile = vrt_tile
         else:
-            mrf_insert_command_list.append(tile)
-
-        mrf_insert_command_list.append(mrf)
-        log_the_command(mrf_insert_command_list)
-
-        try:
-            mrf_insert = subprocess.Popen(mrf_insert_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            mrf_insert_command_list.pop()
-            mrf_insert_command_list.pop()
-        except OSError:
-            log_sig_exit('ERROR', "mrf_insert tool cannot be found.", sigevent_url)
-
-        insert_message = mrf_insert.stderr.readlines()
-        for message in insert_message:
-            if 'Access window out of range' in str(message):
-                log_sig_warn(str(message), sigevent_url)
-            elif 'ERROR' in str(message):
-                errors += 1
-                log_sig_err("mrf_insert {0}".format(message), sigevent_url)
-            else:
-                log_info_mssg(str(message).strip())
-        returncode = mrf_insert.wait()
-        if returncode != 0:
-            log_sig_err('mrf_insert return code {0}'.format(returncode), sigevent_url)
-
-        # Remove temporary merged files (if created)
-        if ".merge." in tile:
-            remove_file(tile)
+            insert_tile = tile
+
+        # merge composites the granule over the existing MRF blocks in memory, skipping nodata/transparent pixels
+        log_info_mssg_with_timestamp("Inserting {0} into {1} ({2}{3})".format(insert_tile, mrf, insert_method,
+                                                                              ", merge" if merge else ""))
+        # a mosaic only writes the pixels of its granules, not the gaps between them
+        members = mosaics.get(source_tile)
+        coverage = [get_image_extents(member) for member in members] if members else None
+        result = get_inserter(mrf, insert_method).insert(insert_tile, merge, float(nodata) if nodata != "" else None,
+                                                         coverage)
+        if result.status == OUTSIDE:
+            log_sig_warn(result.message, sigevent_url)
+        elif result.status == FAILED:
+            errors += 1
+            log_sig_err("mrf_insert {0}".format(result.message), sigevent_url)
+        else:
+            log_info_mssg(result.message)
+            if journal is not None:
+                for granule in members or [source_tile]:
+                    journal.record_tile(granule, result.window, get_inserter(mrf, insert_method).defer_overviews)
 
         # Remove the temporary (if created) vrt tile used to sort out differing resolutions of the tile and MRF
-        remove_file(vrt_tile)
+        scratch.remove(vrt_tile)
+        # and any other in-memory intermediates derived from this granule
+        scratch.release(os.path.basename(source_tile))
+        # granules that were cropped or split are counted by the recursive call that inserts the parts
+        metrics.stop('insert_granule', granule_metrics)
 
         # Commenting this out because I am not aware of any lingering VRT files that must be removed... and this causes
         # some issues if the input tile list had VRTs in it
@@ -957,12 +1680,13 @@ def run_mrf_insert(tiles, mrf, insert_method, resize_resampling, target_x, targe
             lock.up_read()
 
         if max_size is not None:
-            if os.stat(data_name(mrf)).st_size > max_size:
+            if needs_cleaning(data_name(mrf), max_size):
                 if should_lock:
                     lock.down_write()
-                if os.stat(data_name(mrf)).st_size > max_size:
+                if needs_cleaning(data_name(mrf), max_size):
                     log_info_mssg_with_timestamp("cleaning data file {} with size {}".
                                                  format(data_name(mrf), os.stat(data_name(mrf)).st_size))
+                    get_inserter(mrf, insert_method).close() # keeps pending overview windows, reopens after cleaning
                     clean_mrf(data_name(mrf))
                     log_info_mssg_with_timestamp("done cleaning data file {}. now has size {}".
                                                  format(data_name(mrf), os.stat(data_name(mrf)).st_size))
@@ -1165,6 +1889,27 @@ def create_vrt(basename, empty_tile, epsg, xmin, ymin, xmax, ymax):
     return empty_vrt_filename
 
 
+def log_the_command(command_list):
+    """
+    Sends a subprocess command to the log and counts it in the stage metrics
+    Arguments:
+        command_list -- list containing all elements of a subprocess command.
+    """
+    oe_utils.log_the_command(command_list)
+    metrics.count_subprocess()
+
+def get_extension(compression_type):
+    if compression_type in ['PNG', 'PPNG', 'EPNG', 'JPNG']:
+        return "ppg"
+    elif compression_type in ['JPG', 'JPEG']:
+        return "pjg"
+    elif compression_type in ['TIF', 'TIFF']:
+        return "ptf"
+    elif compression_type == 'LERC':
+        return "lrc"
+    else:
+        return None
+
 # call oe_utils' log_sig_err and keep track of errors if count_err is True
 def log_sig_err(mssg, sigevent_url, count_err=True):
     global errors
@@ -1177,996 +1922,1039 @@ def log_sig_err(mssg, sigevent_url, count_err=True):
 # Finished defining subroutines.  Begin main program.
 #-------------------------------------------------------------------------------
 
-# Define command line options and args.
-parser=OptionParser(version=versionNumber)
-parser.add_option('-c', '--configuration_filename',
-                  action='store', type='string', dest='configuration_filename',
-                  default='./mrfgen_configuration_file.xml',
-                  help='Full path of configuration filename.  Default:  ./mrfgen_configuration_file.xml')
-parser.add_option("-d", "--data_only", action="store_true", dest="data_only",
-                  default=False, help="Only output the MRF data, index, and header files")
-parser.add_option("-s", "--send_email", action="store_true", dest="send_email",
-                  default=False, help="Send email notification for errors and warnings.")
-parser.add_option('--email_server', action='store', type='string', dest='email_server',
-                  default='', help='The server where email is sent from (overrides configuration file value)')
-parser.add_option('--email_recipient', action='store', type='string', dest='email_recipient',
-                  default='', help='The recipient address for email notifications (overrides configuration file value)')
-parser.add_option('--email_sender', action='store', type='string', dest='email_sender',
-                  default='', help='The sender for email notifications (overrides configuration file value)')
-parser.add_option('--email_logging_level', action='store', type='string', dest='email_logging_level',
-                  default='ERROR', help='Logging level for email notifications: ERROR, WARN, or INFO.  Default: ERROR')
-
-# Read command line args.
-(options, args) = parser.parse_args()
-# Configuration filename.
-configuration_filename=options.configuration_filename
-# Send email.
-send_email=options.send_email
-# Email server.
-email_server=options.email_server
-# Email recipient
-email_recipient=options.email_recipient
-# Email sender.
-email_sender=options.email_sender
-# Data only.
-data_only = options.data_only
-# Email logging level
-logging_level = options.email_logging_level.upper()
-
-# Email metadata replaces sigevent_url
-if send_email:
-    sigevent_url = (email_server, email_recipient, email_sender, logging_level)
-else:
-    sigevent_url = ''
-
-# Get current time, which is written to a file as the previous cycle time.
-# Time format is "yyyymmdd.hhmmss.f".  Do this first to avoid any gap where tiles
-# may get passed over because they were created while this script is running.
-current_cycle_time = datetime.datetime.now().strftime("%Y%m%d.%H%M%S.%f")
-
-
-# Read XML configuration file.
-try:
-    # Open file.
-    config_file=open(configuration_filename, 'r')
-except IOError:
-    mssg=str().join(['Cannot read configuration file:  ',
-                     configuration_filename])
-    log_sig_exit('ERROR', mssg, sigevent_url)
-else:
-    # Get dom from XML file.
-    dom=xml.dom.minidom.parse(config_file)
-    # Parameter name.
-    parameter_name         =get_dom_tag_value(dom, 'parameter_name')
-    date_of_data           =get_dom_tag_value(dom, 'date_of_data')
-
-    # Define output basename for log, txt, vrt, .mrf, .idx and .ppg or .pjg
-    # Files get date_of_date added, links do not.
-    oe_utils.basename = basename = str().join([parameter_name, '_', date_of_data, '___', 'mrfgen_', current_cycle_time, '_', str(os.getpid())])
-
-    # Get default email server and recipient if not override
-    if email_server == '':
+def main(argv=None):
+    """
+    Runs mrfgen for one configuration file. Exits with status 0 on success and 1 if errors were encountered.
+    The module globals used by the subroutines above are reset first, so main can be called repeatedly
+    by a long running process (see mrfgen_batch.py).
+    Arguments:
+        argv -- Command line arguments, defaults to sys.argv[1:]
+    """
+    global sigevent_url, mrf_compression_type, mrf_maxsize, mrf_parallel, mrf_cores, overview_sampling
+    global mrf_dedup, mrf_empty_tile_bytes, mrf_garbage_ratio, mrf_layout
+    global errors, tile_info, journal, scratch, metrics, partition
+    # a previous run that exited in the middle of inserting may have left an MRF open and mosaic VRTs behind
+    release_inserter()
+    release_mosaics()
+    errors = 0
+    tile_info = TileInfo()
+    metrics = Metrics()
+    journal = None
+    scratch = ScratchSpace()
+    garbage_checks.clear()
+
+    # Define command line options and args.
+    parser=OptionParser(version=versionNumber)
+    parser.add_option('-c', '--configuration_filename',
+                      action='store', type='string', dest='configuration_filename',
+                      default='./mrfgen_configuration_file.xml',
+                      help='Full path of configuration filename.  Default:  ./mrfgen_configuration_file.xml')
+    parser.add_option("-d", "--data_only", action="store_true", dest="data_only",
+                      default=False, help="Only output the MRF data, index, and header files")
+    parser.add_option("-s", "--send_email", action="store_true", dest="send_email",
+                      default=False, help="Send email notification for errors and warnings.")
+    parser.add_option('--email_server', action='store', type='string', dest='email_server',
+                      default='', help='The server where email is sent from (overrides configuration file value)')
+    parser.add_option('--email_recipient', action='store', type='string', dest='email_recipient',
+                      default='', help='The recipient address for email notifications (overrides configuration file value)')
+    parser.add_option('--email_sender', action='store', type='string', dest='email_sender',
+                      default='', help='The sender for email notifications (overrides configuration file value)')
+    parser.add_option('--email_logging_level', action='store', type='string', dest='email_logging_level',
+                      default='ERROR', help='Logging level for email notifications: ERROR, WARN, or INFO.  Default: ERROR')
+    parser.add_option("--resume", action="store_true", dest="resume",
+                      default=False, help="Resume an interrupted run with the same configuration, skipping granules and stages that were completed")
+    parser.add_option('--partition', action='store', type='string', dest='partition',
+                      default='', help='Build partial MRF K of N (e.g. 2/4) from a spatial share of the granules, to be combined with mrf_combine.py')
+
+    # Read command line args.
+    (options, args) = parser.parse_args(argv)
+    # Configuration filename.
+    configuration_filename=options.configuration_filename
+    # Send email.
+    send_email=options.send_email
+    # Email server.
+    email_server=options.email_server
+    # Email recipient
+    email_recipient=options.email_recipient
+    # Email sender.
+    email_sender=options.email_sender
+    # Data only.
+    data_only = options.data_only
+    # Email logging level
+    logging_level = options.email_logging_level.upper()
+    # Resume an interrupted run.
+    resume = options.resume
+    # Partial MRF K of N of a distributed build.
+    partition = None
+    if options.partition != '':
         try:
-            email_server = get_dom_tag_value(dom, 'email_server')
+            partition = tuple(int(part) for part in options.partition.split('/'))
+            if len(partition) != 2 or not 1 <= partition[0] <= partition[1]:
+                raise ValueError
+        except ValueError:
+            parser.error('--partition must be K/N with 1 <= K <= N')
+
+    # Email metadata replaces sigevent_url
+    if send_email:
+        sigevent_url = (email_server, email_recipient, email_sender, logging_level)
+    else:
+        sigevent_url = ''
+
+    # Get current time, which is written to a file as the previous cycle time.
+    # Time format is "yyyymmdd.hhmmss.f".  Do this first to avoid any gap where tiles
+    # may get passed over because they were created while this script is running.
+    current_cycle_time = datetime.datetime.now().strftime("%Y%m%d.%H%M%S.%f")
+
+
+    # Read XML configuration file.
+    try:
+        # Open file.
+        config_file=open(configuration_filename, 'r')
+    except IOError:
+        mssg=str().join(['Cannot read configuration file:  ',
+                         configuration_filename])
+        log_sig_exit('ERROR', mssg, sigevent_url)
+    else:
+        # Get dom from XML file.
+        dom=xml.dom.minidom.parse(config_file)
+        # Parameter name.
+        parameter_name         =get_dom_tag_value(dom, 'parameter_name')
+        date_of_data           =get_dom_tag_value(dom, 'date_of_data')
+
+        # Define output basename for log, txt, vrt, .mrf, .idx and .ppg or .pjg
+        # Files get date_of_date added, links do not.
+        oe_utils.basename = basename = str().join([parameter_name, '_', date_of_data, '___', 'mrfgen_', current_cycle_time, '_', str(os.getpid())])
+
+        # Get default email server and recipient if not override
+        if email_server == '':
+            try:
+                email_server = get_dom_tag_value(dom, 'email_server')
+            except:
+                email_server = ''
+        if email_recipient == '':
+            try:
+                email_recipient = get_dom_tag_value(dom, 'email_recipient')
+            except:
+                email_recipient = ''
+        if email_sender == '':
+            try:
+                email_sender = get_dom_tag_value(dom, 'email_sender')
+            except:
+                email_sender = ''
+        if send_email:
+            sigevent_url = (email_server, email_recipient, email_sender, logging_level)
+            if email_recipient == '':
+                log_sig_err("No email recipient provided for notifications.", sigevent_url)
+
+        # for sub-daily imagery
+        try:
+            time_of_data = get_dom_tag_value(dom, 'time_of_data')
         except:
-            email_server = ''
-    if email_recipient == '':
+            time_of_data = ''
+        # Directories.
         try:
-            email_recipient = get_dom_tag_value(dom, 'email_recipient')
+            input_dir = get_dom_tag_value(dom, 'input_dir')
         except:
-            email_recipient = ''
-    if email_sender == '':
+            input_dir = None
+        output_dir = get_dom_tag_value(dom, 'output_dir')
+        try:
+            working_dir            =get_dom_tag_value(dom, 'working_dir')
+            working_dir = add_trailing_slash(check_abs_path(working_dir))
+        except: # use /tmp/ as default
+            working_dir            ='/tmp/'
         try:
-            email_sender = get_dom_tag_value(dom, 'email_sender')
+            logfile_dir = get_dom_tag_value(dom, 'logfile_dir')
+        except: #use working_dir if not specified
+            logfile_dir = working_dir
+        try:
+            mrf_name=get_dom_tag_value(dom, 'mrf_name')
         except:
-            email_sender = ''
-    if send_email:
-        sigevent_url = (email_server, email_recipient, email_sender, logging_level)
-        if email_recipient == '':
-            log_sig_err("No email recipient provided for notifications.", sigevent_url)
-
-    # for sub-daily imagery
-    try:
-        time_of_data = get_dom_tag_value(dom, 'time_of_data')
-    except:
-        time_of_data = ''
-    # Directories.
-    try:
-        input_dir = get_dom_tag_value(dom, 'input_dir')
-    except:
-        input_dir = None
-    output_dir = get_dom_tag_value(dom, 'output_dir')
-    try:
-        working_dir            =get_dom_tag_value(dom, 'working_dir')
-        working_dir = add_trailing_slash(check_abs_path(working_dir))
-    except: # use /tmp/ as default
-        working_dir            ='/tmp/'
-    try:
-        logfile_dir = get_dom_tag_value(dom, 'logfile_dir')
-    except: #use working_dir if not specified
-        logfile_dir = working_dir
-    try:
-        mrf_name=get_dom_tag_value(dom, 'mrf_name')
-    except:
-        # default to GIBS naming convention
-        mrf_name='{$parameter_name}%Y%j_.mrf'
-    # MRF specific parameters.
-    try:
-        mrf_empty_tile_filename=check_abs_path(get_dom_tag_value(dom, 'mrf_empty_tile_filename'))
-    except:
+            # default to GIBS naming convention
+            mrf_name='{$parameter_name}%Y%j_.mrf'
+        if partition is not None:
+            mrf_name = mrf_name.replace('.mrf', '_part{0}of{1}.mrf'.format(*partition))
+        # MRF specific parameters.
         try:
-            mrf_empty_tile_filename=lookupEmptyTile(get_dom_tag_value(dom, 'empty_tile'))
+            mrf_empty_tile_filename=check_abs_path(get_dom_tag_value(dom, 'mrf_empty_tile_filename'))
         except:
-            log_sig_warn("Empty tile was not found for " + parameter_name, sigevent_url)
-            mrf_empty_tile_filename = ''
-    try:
-        vrtnodata = get_dom_tag_value(dom, 'vrtnodata')
-    except:
-        vrtnodata = ""
-    mrf_blocksize          =get_dom_tag_value(dom, 'mrf_blocksize')
-    mrf_compression_type   =get_dom_tag_value(dom, 'mrf_compression_type')
-    try:
-        outsize = get_dom_tag_value(dom, 'outsize')
-        target_x, target_y = outsize.split(' ')
-    except:
-        outsize = ''
+            try:
+                mrf_empty_tile_filename=lookupEmptyTile(get_dom_tag_value(dom, 'empty_tile'))
+            except:
+                log_sig_warn("Empty tile was not found for " + parameter_name, sigevent_url)
+                mrf_empty_tile_filename = ''
         try:
-            target_x = get_dom_tag_value(dom, 'target_x')
+            vrtnodata = get_dom_tag_value(dom, 'vrtnodata')
         except:
-            target_x = '' # if no target_x then use rasterXSize and rasterYSize from VRT file
+            vrtnodata = ""
+        mrf_blocksize          =get_dom_tag_value(dom, 'mrf_blocksize')
+        mrf_compression_type   =get_dom_tag_value(dom, 'mrf_compression_type')
         try:
-            target_y = get_dom_tag_value(dom, 'target_y')
+            outsize = get_dom_tag_value(dom, 'outsize')
+            target_x, target_y = outsize.split(' ')
         except:
-            target_y = ''
-    # EPSG code projection.
-    try:
-        target_epsg = 'EPSG:' + str(get_dom_tag_value(dom, 'target_epsg'))
-    except:
-        target_epsg = 'EPSG:4326' # default to geographic
-    try:
-        if get_dom_tag_value(dom, 'source_epsg') == "detect":
-            source_epsg = "detect"
-        else:
-            source_epsg = 'EPSG:' + str(get_dom_tag_value(dom, 'source_epsg'))
-    except:
-        source_epsg = 'EPSG:4326' # default to geographic
+            outsize = ''
+            try:
+                target_x = get_dom_tag_value(dom, 'target_x')
+            except:
+                target_x = '' # if no target_x then use rasterXSize and rasterYSize from VRT file
+            try:
+                target_y = get_dom_tag_value(dom, 'target_y')
+            except:
+                target_y = ''
+        # EPSG code projection.
+        try:
+            target_epsg = 'EPSG:' + str(get_dom_tag_value(dom, 'target_epsg'))
+        except:
+            target_epsg = 'EPSG:4326' # default to geographic
+        try:
+            if get_dom_tag_value(dom, 'source_epsg') == "detect":
+                source_epsg = "detect"
+            else:
+                source_epsg = 'EPSG:' + str(get_dom_tag_value(dom, 'source_epsg'))
+        except:
+            source_epsg = 'EPSG:4326' # default to geographic
 
-    # Source extents.
-    try:
-        extents = get_dom_tag_value(dom, 'extents')
-    except:
-        extents = '-180,-90,180,90' # default to geographic
-    source_xmin, source_ymin, source_xmax, source_ymax = extents.split(',')
+        # Source extents.
+        try:
+            extents = get_dom_tag_value(dom, 'extents')
+        except:
+            extents = '-180,-90,180,90' # default to geographic
+        source_xmin, source_ymin, source_xmax, source_ymax = extents.split(',')
 
-    # Target extents.
-    try:
-        target_extents = get_dom_tag_value(dom, 'target_extents')
-    except:
-        if target_epsg == 'EPSG:3857':
-            target_extents = '-20037508.34,-20037508.34,20037508.34,20037508.34'
-        elif target_epsg in ['EPSG:3413','EPSG:3031']:
-            target_extents = '-4194304,-4194304,4194304,4194304'
-        else:
-            target_extents = '-180,-90,180,90'
-    target_xmin, target_ymin, target_xmax, target_ymax = target_extents.split(',')
+        # Target extents.
+        try:
+            target_extents = get_dom_tag_value(dom, 'target_extents')
+        except:
+            if target_epsg == 'EPSG:3857':
+                target_extents = '-20037508.34,-20037508.34,20037508.34,20037508.34'
+            elif target_epsg in ['EPSG:3413','EPSG:3031']:
+                target_extents = '-4194304,-4194304,4194304,4194304'
+            else:
+                target_extents = '-180,-90,180,90'
+        target_xmin, target_ymin, target_xmax, target_ymax = target_extents.split(',')
 
-    # Input files.
-    try:
-        input_files = get_input_files(dom)
-        empty_vrt = None
-        if input_files == '':
-            raise ValueError('No input files provided')
-    except:
-        if input_dir is None:
-            if mrf_empty_tile_filename != '':
+        # Input files.
+        try:
+            input_files = get_input_files(dom)
+            empty_vrt = None
+            if input_files == '':
+                raise ValueError('No input files provided')
+        except:
+            if input_dir is None:
+                if mrf_empty_tile_filename != '':
+                    input_files = None
+                    empty_vrt = create_vrt(add_trailing_slash(check_abs_path(working_dir))+basename, mrf_empty_tile_filename,
+                                           target_epsg, target_xmin, target_ymin, target_xmax, target_ymax)
+                else:
+                    log_sig_exit('ERROR', "<input_files> or <input_dir> or <mrf_empty_tile_filename> is required", sigevent_url)
+            else:
                 input_files = None
-                empty_vrt = create_vrt(add_trailing_slash(check_abs_path(working_dir))+basename, mrf_empty_tile_filename,
-                                       target_epsg, target_xmin, target_ymin, target_xmax, target_ymax)
+                empty_vrt = None
+        # overview levels
+        try:
+            overview_levels = get_dom_tag_value(dom, 'overview_levels').split(' ')
+            for level in overview_levels:
+                if level.isdigit() == False:
+                    log_sig_exit("ERROR", "'" + level + "' is not a valid overview value.", sigevent_url)
+            if len(overview_levels) > 1:
+                overview = int(overview_levels[1]) / int(overview_levels[0])
             else:
-                log_sig_exit('ERROR', "<input_files> or <input_dir> or <mrf_empty_tile_filename> is required", sigevent_url)
-        else:
-            input_files = None
-            empty_vrt = None
-    # overview levels
-    try:
-        overview_levels = get_dom_tag_value(dom, 'overview_levels').split(' ')
-        for level in overview_levels:
-            if level.isdigit() == False:
-                log_sig_exit("ERROR", "'" + level + "' is not a valid overview value.", sigevent_url)
-        if len(overview_levels) > 1:
-            overview = int(overview_levels[1]) / int(overview_levels[0])
-        else:
+                overview = 2
+        except:
+            overview_levels = ''
             overview = 2
-    except:
-        overview_levels = ''
-        overview = 2
-    # resampling method
-    try:
-        overview_resampling = get_dom_tag_value(dom, 'overview_resampling')
-    except:
-        overview_resampling = 'nearest'
-        # gdalwarp resampling method for resizing
-    try:
-        resize_resampling = get_dom_tag_value(dom, 'resize_resampling')
-        if resize_resampling == "none":
+        # resampling method
+        try:
+            overview_resampling = get_dom_tag_value(dom, 'overview_resampling')
+        except:
+            overview_resampling = 'nearest'
+            # gdalwarp resampling method for resizing
+        try:
+            resize_resampling = get_dom_tag_value(dom, 'resize_resampling')
+            if resize_resampling == "none":
+                resize_resampling = ''
+        except:
             resize_resampling = ''
-    except:
-        resize_resampling = ''
-    if resize_resampling != '' and target_x == '':
-        log_sig_exit('ERROR', "target_x or outsize must be provided for resizing", sigevent_url)
+        if resize_resampling != '' and target_x == '':
+            log_sig_exit('ERROR', "target_x or outsize must be provided for resizing", sigevent_url)
 
-    # gdalwarp resampling method for reprojection
-    try:
-        reprojection_resampling = get_dom_tag_value(dom, 'reprojection_resampling')
-    except:
-        reprojection_resampling = 'cubic' # default to cubic
-    # colormap
-    try:
-        colormap = get_dom_tag_value(dom, 'colormap')
-    except:
-        colormap = ''
-    # quality/precision
-    try:
-        quality_prec = get_dom_tag_value(dom, 'quality_prec')
-    except:
-        if mrf_compression_type.lower() == 'lerc':
-            quality_prec = '0.001' # default to standard floating point precision if LERC
-        else:
-            quality_prec = '80' # default to 80 quality for everything else
-    # z-levels
-    try:
-        zlevels = get_dom_tag_value(dom, 'mrf_z_levels')
-    except:
-        zlevels = ''
-        # z key
-    z = None
-    zkey_type = "string" # default to only string for now
-    try:
-        zkey = get_dom_tag_value(dom, 'mrf_z_key')
-    except:
-        zkey = ''
-        # noaddo, defaults to False
-    try:
-        if get_dom_tag_value(dom, 'mrf_noaddo') == "false":
+        # gdalwarp resampling method for reprojection
+        try:
+            reprojection_resampling = get_dom_tag_value(dom, 'reprojection_resampling')
+        except:
+            reprojection_resampling = 'cubic' # default to cubic
+        # colormap
+        try:
+            colormap = get_dom_tag_value(dom, 'colormap')
+        except:
+            colormap = ''
+        # quality/precision
+        try:
+            quality_prec = get_dom_tag_value(dom, 'quality_prec')
+        except:
+            if mrf_compression_type.lower() == 'lerc':
+                quality_prec = '0.001' # default to standard floating point precision if LERC
+            else:
+                quality_prec = '80' # default to 80 quality for everything else
+        # z-levels
+        try:
+            zlevels = get_dom_tag_value(dom, 'mrf_z_levels')
+        except:
+            zlevels = ''
+            # z key
+        z = None
+        zkey_type = "string" # default to only string for now
+        try:
+            zkey = get_dom_tag_value(dom, 'mrf_z_key')
+        except:
+            zkey = ''
+            # noaddo, defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_noaddo') == "false":
+                noaddo = False
+            else:
+                noaddo = True
+        except:
             noaddo = False
-        else:
-            noaddo = True
-    except:
-        noaddo = False
 
-    # mrf_cores (max number of cpu cores to run on if mrf_parallel is set, defaults to 4
-    try:
-        mrf_cores = int(get_dom_tag_value(dom, 'mrf_cores'))
-    except:
-        mrf_cores = 4 # multiprocessing.cpu_count()
+        # mrf_cores (max number of cpu cores to run on if mrf_parallel is set, defaults to 4
+        try:
+            mrf_cores = int(get_dom_tag_value(dom, 'mrf_cores'))
+        except:
+            mrf_cores = 4 # multiprocessing.cpu_count()
 
-    # mrf_parallel (run mrf_insert in parallel), defaults to False
-    try:
-        if get_dom_tag_value(dom, 'mrf_parallel') == "true":
-            mrf_parallel = True
-        else:
+        # mrf_parallel (run mrf_insert in parallel), defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_parallel') == "true":
+                mrf_parallel = True
+            else:
+                mrf_parallel = False
+        except:
             mrf_parallel = False
-    except:
-        mrf_parallel = False
 
-    # run the mrf_clean utility to reduce the size of the generated MRFs, defaults to mrf_parallel.
-    try:
-        if get_dom_tag_value(dom, 'mrf_clean') == "true":
-            mrf_clean = True
-        else:
-            mrf_clean = False
-    except:
-        if mrf_parallel:
-            mrf_clean = True
-        else:
-            mrf_clean = False
+        # run the mrf_clean utility to reduce the size of the generated MRFs, defaults to mrf_parallel.
+        try:
+            if get_dom_tag_value(dom, 'mrf_clean') == "true":
+                mrf_clean = True
+            else:
+                mrf_clean = False
+        except:
+            if mrf_parallel:
+                mrf_clean = True
+            else:
+                mrf_clean = False
 
-    # set a maximum size for the mrf before running mrf_clean. used to manage MRF sizes for mrf_parallel and mrf_noaddo
-    try:
-        mrf_maxsize = int(get_dom_tag_value(dom, 'mrf_maxsize'))
-    except:
-        mrf_maxsize = None
+        # set a maximum size for the mrf before running mrf_clean. used to manage MRF sizes for mrf_parallel and mrf_noaddo
+        try:
+            mrf_maxsize = int(get_dom_tag_value(dom, 'mrf_maxsize'))
+        except:
+            mrf_maxsize = None
 
-    # merge, defaults to False
-    try:
-        if get_dom_tag_value(dom, 'mrf_merge') == "false":
-            merge = False
-        else:
-            merge = True
-    except:
-        merge = False
-    # strict_palette, defaults to False
-    try:
-        if get_dom_tag_value(dom, 'mrf_strict_palette') == "false":
-            strict_palette = False
-        else:
-            strict_palette = True
-    except:
-        strict_palette = False
-    # mrf data
-    try:
-        mrf_data_scale = get_dom_tag_value(dom, 'mrf_data_scale')
-    except:
-        mrf_data_scale = ''
-    try:
-        mrf_data_offset = get_dom_tag_value(dom, 'mrf_data_offset')
-    except:
-        mrf_data_offset = ''
-    if mrf_data_scale != '' and mrf_data_offset == '':
-        log_sig_exit('ERROR', "<mrf_data_offset> is required if <mrf_data_scale> is set", sigevent_url)
-    if (mrf_data_scale == '' and mrf_data_offset != ''):
-        log_sig_exit('ERROR', "<mrf_data_scale> is required if <mrf_data_offset> is set", sigevent_url)
-    try:
-        mrf_data_units = get_dom_tag_value(dom, 'mrf_data_units')
-    except:
-        mrf_data_units = ''
-    try:
-        source_url = get_dom_tag_value(dom, 'source_url')
-    except:
-        if len(dom.getElementsByTagName('source_url')) > 0:
-            source_url = "NONE"
-        else:
-            source_url = ''
-    # Close file.
-    config_file.close()
-
-# Make certain each directory exists and has a trailing slash.
-if input_dir != None:
-    input_dir = add_trailing_slash(check_abs_path(input_dir))
-output_dir = add_trailing_slash(check_abs_path(output_dir))
-logfile_dir = add_trailing_slash(check_abs_path(logfile_dir))
-
-# Save script_dir
-script_dir = add_trailing_slash(os.path.dirname(os.path.abspath(__file__)))
-
-# Ensure that mrf_compression_type is uppercase.
-mrf_compression_type=mrf_compression_type.upper()
-
-# Verify logfile_dir first so that the log can be started.
-verify_directory_path_exists(logfile_dir, 'logfile_dir', sigevent_url)
-# Initialize log file.
-log_filename=str().join([logfile_dir, basename, '.log'])
-logging.basicConfig(filename=log_filename, level=logging.INFO)
-
-# Verify remaining directory paths.
-if input_dir != None:
-    verify_directory_path_exists(input_dir, 'input_dir', sigevent_url)
-verify_directory_path_exists(output_dir, 'output_dir', sigevent_url)
-verify_directory_path_exists(working_dir, 'working_dir', sigevent_url)
-
-# Make certain color map can be found
-if colormap != '' and '://' not in colormap:
-    colormap = check_abs_path(colormap)
-
-# Log all of the configuration information.
-log_info_mssg_with_timestamp(str().join(['config XML file:  ', configuration_filename]))
-                                      
-# Copy configuration file to working_dir (if it's not already there)
-# so that the MRF can be recreated if needed.
-if os.path.dirname(configuration_filename) != os.path.dirname(working_dir):
-    config_preexisting=glob.glob(configuration_filename)
-    if len(config_preexisting) > 0:
-        at_dest_filename=str().join([working_dir, configuration_filename])
-        at_dest_preexisting=glob.glob(at_dest_filename)
-        if len(at_dest_preexisting) > 0:
-            remove_file(at_dest_filename)
-        shutil.copy(configuration_filename, working_dir+"/"+basename+".configuration_file.xml")
-        log_info_mssg(str().join([
-                          'config XML file:  copied to     ', working_dir]))
-log_info_mssg(str().join(['config parameter_name:          ', parameter_name]))
-log_info_mssg(str().join(['config date_of_data:            ', date_of_data]))
-log_info_mssg(str().join(['config time_of_data:            ', time_of_data]))
-if input_files is not None:
-    log_info_mssg(str().join(['config input_files:             ', input_files]))
-if input_dir is not None:
-    log_info_mssg(str().join(['config input_dir:               ', input_dir]))
-if empty_vrt is not None:
-    log_info_mssg(str().join(['config empty_vrt:               ', empty_vrt]))
-log_info_mssg(str().join(['config output_dir:              ', output_dir]))
-log_info_mssg(str().join(['config working_dir:             ', working_dir]))
-log_info_mssg(str().join(['config logfile_dir:             ', logfile_dir]))
-log_info_mssg(str().join(['config mrf_name:                ', mrf_name]))
-log_info_mssg(str().join(['config mrf_empty_tile_filename: ',
-                          mrf_empty_tile_filename]))
-log_info_mssg(str().join(['config vrtnodata:               ', vrtnodata]))
-log_info_mssg(str().join(['config mrf_blocksize:           ', mrf_blocksize]))
-log_info_mssg(str().join(['config mrf_compression_type:    ',
-                          mrf_compression_type]))
-log_info_mssg(str().join(['config outsize:                 ', outsize]))
-log_info_mssg(str().join(['config target_x:                ', target_x]))
-log_info_mssg(str().join(['config target_y:                ', target_y]))
-log_info_mssg(str().join(['config target_epsg:             ', target_epsg]))
-log_info_mssg(str().join(['config source_epsg:             ', source_epsg]))
-log_info_mssg(str().join(['config extents:                 ', extents]))
-log_info_mssg(str().join(['config target_extents:          ', target_extents]))
-log_info_mssg(str().join(['config overview levels:         ', ' '.join(overview_levels)]))
-log_info_mssg(str().join(['config overview resampling:     ', overview_resampling]))
-log_info_mssg(str().join(['config reprojection resampling: ', reprojection_resampling]))
-log_info_mssg(str().join(['config resize resampling:       ', resize_resampling]))
-log_info_mssg(str().join(['config colormap:                ', colormap]))
-log_info_mssg(str().join(['config quality_prec:            ', quality_prec]))
-log_info_mssg(str().join(['config mrf_noaddo:              ', str(noaddo)]))
-log_info_mssg(str().join(['config mrf_merge:               ', str(merge)]))
-log_info_mssg(str().join(['config mrf_parallel:            ', str(mrf_parallel)]))
-log_info_mssg(str().join(['config mrf_cores:               ', str(mrf_cores)]))
-log_info_mssg(str().join(['config mrf_clean:               ', str(mrf_clean)]))
-log_info_mssg(str().join(['config mrf_maxsize:             ', str(mrf_maxsize)]))
-log_info_mssg(str().join(['config mrf_strict_palette:      ', str(strict_palette)]))
-log_info_mssg(str().join(['config mrf_z_levels:            ', zlevels]))
-log_info_mssg(str().join(['config mrf_z_key:               ', zkey]))
-log_info_mssg(str().join(['config mrf_data_scale:          ', mrf_data_scale]))
-log_info_mssg(str().join(['config mrf_data_offset:         ', mrf_data_offset]))
-log_info_mssg(str().join(['config mrf_data_units:          ', mrf_data_units]))
-log_info_mssg(str().join(['config source_url:              ', source_url]))
-log_info_mssg(str().join(['mrfgen current_cycle_time:      ', current_cycle_time]))
-log_info_mssg(str().join(['mrfgen basename:                ', basename]))
-
-# Verify that date is 8 characters.
-if len(date_of_data) != 8:
-    mssg='Format for <date_of_data> (in mrfgen XML config file) is:  yyyymmdd'
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-if time_of_data != '' and len(time_of_data) != 6:
-    mssg='Format for <time_of_data> (in mrfgen XML config file) is:  HHMMSS'
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-# Check if empty tile filename was specified.
-if len(mrf_empty_tile_filename) == 0:
-    log_info_mssg(str('Empty tile not specified, none will be used.'))
-    mrf_empty_tile_bytes=0
-else:
-    # Verify that the empty tile can be found.
-    mrf_empty_tile_existing=glob.glob(mrf_empty_tile_filename)
-    if len(mrf_empty_tile_existing) == 0:
-        mssg=str().join(['Specified empty tile file not found:  ', mrf_empty_tile_filename])
-        log_sig_exit('ERROR', mssg, sigevent_url)
+        # fraction of the data file that must be unreferenced before it is cleaned at mrf_maxsize, defaults to 0.2
+        try:
+            mrf_garbage_ratio = min(max(float(get_dom_tag_value(dom, 'mrf_garbage_ratio')), 0.0), 0.99)
+        except:
+            mrf_garbage_ratio = 0.2
 
-    # Verify that the empty tile image format is either PNG or JPEG.
-    mrf_empty_tile_what=imghdr.what(mrf_empty_tile_filename)
-    if mrf_empty_tile_what != 'png' and mrf_empty_tile_what != 'jpeg' and mrf_empty_tile_what != 'tiff' and mrf_empty_tile_what != 'lerc':
-        mssg='Empty tile image format must be either png, jpeg, tiff, or lerc.'
-        log_sig_exit('ERROR', mssg, sigevent_url)
+        # order of the tiles in the final data file: file (as inserted), index, hilbert or morton, defaults to file
+        try:
+            mrf_layout = get_dom_tag_value(dom, 'mrf_layout').lower()
+        except:
+            mrf_layout = 'file'
 
-    # Verify that the empty tile matches MRF compression type.
-    if mrf_empty_tile_what == 'png':
-        # Check the last 3 characters in case of PNG or PPNG or JPNG.
-        if mrf_compression_type[-3:len(mrf_compression_type)] != 'PNG':
-            mssg='Empty tile format does not match MRF compression type.'
-            log_sig_exit('ERROR', mssg, sigevent_url)
+        # store identical tiles once whenever the data file is cleaned, defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_dedup') == "true":
+                mrf_dedup = True
+            else:
+                mrf_dedup = False
+        except:
+            mrf_dedup = False
 
-    if mrf_empty_tile_what == 'jpeg':
-        # Check the first 2 characters in case of JPG or JPEG.
-        if mrf_compression_type.lower() not in ['jpeg', 'jpg', 'zen']:
-            mssg='Empty tile format does not match MRF compression type.'
-            log_sig_exit('ERROR', mssg, sigevent_url)
+        # copy granules that cover the target extents into the new MRF in one pass instead of inserting them, defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_direct') == "true":
+                mrf_direct = True
+            else:
+                mrf_direct = False
+        except:
+            mrf_direct = False
 
-    # Report empty tile size in bytes.
-    mrf_empty_tile_bytes=os.path.getsize(mrf_empty_tile_filename)
-    log_info_mssg(str().join(['Empty tile size is:             ',
-                              str(mrf_empty_tile_bytes), ' bytes.']))
+        # regenerate only the overview blocks under the inserted blocks instead of running gdaladdo, defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_incremental_overviews') == "true":
+                mrf_incremental_overviews = True
+            else:
+                mrf_incremental_overviews = False
+        except:
+            mrf_incremental_overviews = False
 
-##IS LOCK FILE NECESSARY?
-## Lock file indicates tile generation in progress.
-#lock=glob.glob(str().join([input_dir, '*lock*']))
-#if len(lock) > 0:
-#    mssg='Lock found.'
-#    log_sig_exit('INFO', mssg, sigevent_url)
+        # keep throwaway intermediates in /vsimem, up to mrf_vsimem_budget MB, defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_vsimem') == "true":
+                mrf_vsimem = True
+            else:
+                mrf_vsimem = False
+        except:
+            mrf_vsimem = False
+        try:
+            mrf_vsimem_budget = int(get_dom_tag_value(dom, 'mrf_vsimem_budget'))
+        except:
+            mrf_vsimem_budget = 1024
+        if mrf_vsimem:
+            scratch = ScratchSpace(mrf_vsimem_budget * 1024 * 1024)
 
-#-------------------------------------------------------------------------------
-# Organize output filenames.
-#-------------------------------------------------------------------------------
+        # number of input granules whose headers are read at once before processing, defaults to 8
+        try:
+            mrf_validate_threads = max(int(get_dom_tag_value(dom, 'mrf_validate_threads')), 1)
+        except:
+            mrf_validate_threads = 8
 
-# Change directory to working_dir.
-os.chdir(working_dir)
+        # maximum area in MRF blocks of a mosaic of granules inserted at once, defaults to 0 (each granule is inserted on its own)
+        try:
+            mrf_coalesce_blocks = max(int(get_dom_tag_value(dom, 'mrf_coalesce_blocks')), 0)
+        except:
+            mrf_coalesce_blocks = 0
 
-# transparency flag for custom color maps; default to False
-add_transparency = False
+        # merge, defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_merge') == "false":
+                merge = False
+            else:
+                merge = True
+        except:
+            merge = False
+        # strict_palette, defaults to False
+        try:
+            if get_dom_tag_value(dom, 'mrf_strict_palette') == "false":
+                strict_palette = False
+            else:
+                strict_palette = True
+        except:
+            strict_palette = False
+        # mrf data
+        try:
+            mrf_data_scale = get_dom_tag_value(dom, 'mrf_data_scale')
+        except:
+            mrf_data_scale = ''
+        try:
+            mrf_data_offset = get_dom_tag_value(dom, 'mrf_data_offset')
+        except:
+            mrf_data_offset = ''
+        if mrf_data_scale != '' and mrf_data_offset == '':
+            log_sig_exit('ERROR', "<mrf_data_offset> is required if <mrf_data_scale> is set", sigevent_url)
+        if (mrf_data_scale == '' and mrf_data_offset != ''):
+            log_sig_exit('ERROR', "<mrf_data_scale> is required if <mrf_data_offset> is set", sigevent_url)
+        try:
+            mrf_data_units = get_dom_tag_value(dom, 'mrf_data_units')
+        except:
+            mrf_data_units = ''
+        try:
+            source_url = get_dom_tag_value(dom, 'source_url')
+        except:
+            if len(dom.getElementsByTagName('source_url')) > 0:
+                source_url = "NONE"
+            else:
+                source_url = ''
+        # Close file.
+        config_file.close()
+
+    # Make certain each directory exists and has a trailing slash.
+    if input_dir != None:
+        input_dir = add_trailing_slash(check_abs_path(input_dir))
+    output_dir = add_trailing_slash(check_abs_path(output_dir))
+    logfile_dir = add_trailing_slash(check_abs_path(logfile_dir))
+
+    # Save script_dir
+    script_dir = add_trailing_slash(os.path.dirname(os.path.abspath(__file__)))
+
+    # Ensure that mrf_compression_type is uppercase.
+    mrf_compression_type=mrf_compression_type.upper()
+
+    # Verify logfile_dir first so that the log can be started.
+    verify_directory_path_exists(logfile_dir, 'logfile_dir', sigevent_url)
+    # Initialize log file.
+    log_filename=str().join([logfile_dir, basename, '.log'])
+    # drop the handler of a previous run in this process so each run logs to its own file
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+    logging.basicConfig(filename=log_filename, level=logging.INFO)
+
+    # Verify remaining directory paths.
+    if input_dir != None:
+        verify_directory_path_exists(input_dir, 'input_dir', sigevent_url)
+    verify_directory_path_exists(output_dir, 'output_dir', sigevent_url)
+    verify_directory_path_exists(working_dir, 'working_dir', sigevent_url)
+
+    # Make certain color map can be found
+    if colormap != '' and '://' not in colormap:
+        colormap = check_abs_path(colormap)
+
+    # Log all of the configuration information.
+    log_info_mssg_with_timestamp(str().join(['config XML file:  ', configuration_filename]))
+
+    # Copy configuration file to working_dir (if it's not already there)
+    # so that the MRF can be recreated if needed.
+    if os.path.dirname(configuration_filename) != os.path.dirname(working_dir):
+        config_preexisting=glob.glob(configuration_filename)
+        if len(config_preexisting) > 0:
+            at_dest_filename=str().join([working_dir, configuration_filename])
+            at_dest_preexisting=glob.glob(at_dest_filename)
+            if len(at_dest_preexisting) > 0:
+                remove_file(at_dest_filename)
+            shutil.copy(configuration_filename, working_dir+"/"+basename+".configuration_file.xml")
+            log_info_mssg(str().join([
+                              'config XML file:  copied to     ', working_dir]))
+    log_info_mssg(str().join(['config parameter_name:          ', parameter_name]))
+    log_info_mssg(str().join(['config date_of_data:            ', date_of_data]))
+    log_info_mssg(str().join(['config time_of_data:            ', time_of_data]))
+    if input_files is not None:
+        log_info_mssg(str().join(['config input_files:             ', input_files]))
+    if input_dir is not None:
+        log_info_mssg(str().join(['config input_dir:               ', input_dir]))
+    if empty_vrt is not None:
+        log_info_mssg(str().join(['config empty_vrt:               ', empty_vrt]))
+    log_info_mssg(str().join(['config output_dir:              ', output_dir]))
+    log_info_mssg(str().join(['config working_dir:             ', working_dir]))
+    log_info_mssg(str().join(['config logfile_dir:             ', logfile_dir]))
+    log_info_mssg(str().join(['config mrf_name:                ', mrf_name]))
+    log_info_mssg(str().join(['config mrf_empty_tile_filename: ',
+                              mrf_empty_tile_filename]))
+    log_info_mssg(str().join(['config vrtnodata:               ', vrtnodata]))
+    log_info_mssg(str().join(['config mrf_blocksize:           ', mrf_blocksize]))
+    log_info_mssg(str().join(['config mrf_compression_type:    ',
+                              mrf_compression_type]))
+    log_info_mssg(str().join(['config outsize:                 ', outsize]))
+    log_info_mssg(str().join(['config target_x:                ', target_x]))
+    log_info_mssg(str().join(['config target_y:                ', target_y]))
+    log_info_mssg(str().join(['config target_epsg:             ', target_epsg]))
+    log_info_mssg(str().join(['config source_epsg:             ', source_epsg]))
+    log_info_mssg(str().join(['config extents:                 ', extents]))
+    log_info_mssg(str().join(['config target_extents:          ', target_extents]))
+    log_info_mssg(str().join(['config overview levels:         ', ' '.join(overview_levels)]))
+    log_info_mssg(str().join(['config overview resampling:     ', overview_resampling]))
+    log_info_mssg(str().join(['config reprojection resampling: ', reprojection_resampling]))
+    log_info_mssg(str().join(['config resize resampling:       ', resize_resampling]))
+    log_info_mssg(str().join(['config colormap:                ', colormap]))
+    log_info_mssg(str().join(['config quality_prec:            ', quality_prec]))
+    log_info_mssg(str().join(['config mrf_noaddo:              ', str(noaddo)]))
+    log_info_mssg(str().join(['config mrf_merge:               ', str(merge)]))
+    log_info_mssg(str().join(['config mrf_parallel:            ', str(mrf_parallel)]))
+    log_info_mssg(str().join(['config mrf_cores:               ', str(mrf_cores)]))
+    log_info_mssg(str().join(['config mrf_clean:               ', str(mrf_clean)]))
+    log_info_mssg(str().join(['config mrf_maxsize:             ', str(mrf_maxsize)]))
+    log_info_mssg(str().join(['config mrf_garbage_ratio:       ', str(mrf_garbage_ratio)]))
+    log_info_mssg(str().join(['config mrf_layout:              ', mrf_layout]))
+    log_info_mssg(str().join(['config mrf_dedup:               ', str(mrf_dedup)]))
+    log_info_mssg(str().join(['config mrf_vsimem:              ', str(mrf_vsimem)]))
+    log_info_mssg(str().join(['config mrf_vsimem_budget:       ', str(mrf_vsimem_budget)]))
+    log_info_mssg(str().join(['config mrf_validate_threads:    ', str(mrf_validate_threads)]))
+    log_info_mssg(str().join(['config mrf_coalesce_blocks:     ', str(mrf_coalesce_blocks)]))
+    log_info_mssg(str().join(['config mrf_direct:              ', str(mrf_direct)]))
+    log_info_mssg(str().join(['config mrf_incremental_overviews: ', str(mrf_incremental_overviews)]))
+    log_info_mssg(str().join(['config mrf_strict_palette:      ', str(strict_palette)]))
+    log_info_mssg(str().join(['config mrf_z_levels:            ', zlevels]))
+    log_info_mssg(str().join(['config mrf_z_key:               ', zkey]))
+    log_info_mssg(str().join(['config mrf_data_scale:          ', mrf_data_scale]))
+    log_info_mssg(str().join(['config mrf_data_offset:         ', mrf_data_offset]))
+    log_info_mssg(str().join(['config mrf_data_units:          ', mrf_data_units]))
+    log_info_mssg(str().join(['config source_url:              ', source_url]))
+    log_info_mssg(str().join(['mrfgen current_cycle_time:      ', current_cycle_time]))
+    log_info_mssg(str().join(['mrfgen basename:                ', basename]))
+
+    # Verify that date is 8 characters.
+    if len(date_of_data) != 8:
+        mssg='Format for <date_of_data> (in mrfgen XML config file) is:  yyyymmdd'
+        log_sig_exit('ERROR', mssg, sigevent_url)
 
-# Declare scale, offset, and units
-scale = None
-offset = None
-units = None
+    if time_of_data != '' and len(time_of_data) != 6:
+        mssg='Format for <time_of_data> (in mrfgen XML config file) is:  HHMMSS'
+        log_sig_exit('ERROR', mssg, sigevent_url)
 
-# Get list of all tile filenames.
-alltiles = []
-if input_files is not None:
-    input_files = input_files.strip()
-    alltiles = input_files.split(',')
+    if mrf_layout not in ['file'] + LAYOUTS:
+        mssg = '<mrf_layout> must be one of: ' + ', '.join(['file'] + LAYOUTS)
+        log_sig_exit('ERROR', mssg, sigevent_url)
 
-if input_dir is not None:
-    if mrf_compression_type.lower() in ['jpeg', 'jpg', 'zen']:
-        alltiles = alltiles + glob.glob(str().join([input_dir, '*.jpg']))
-    if mrf_compression_type.lower() in ['png', 'ppng', 'zen']:
-        alltiles = alltiles + glob.glob(str().join([input_dir, '*.png']))
-    # check for tiffs
-    alltiles = alltiles + glob.glob(str().join([input_dir, '*.tif']))
-    alltiles = alltiles + glob.glob(str().join([input_dir, '*.tiff']))
-    # check for mrfs
-    alltiles = alltiles + glob.glob(str().join([input_dir, '*.mrf']))
-
-# Sanitize input in case there were extra spaces
-striptiles = []
-for tile in alltiles:
-    striptiles.append(tile.strip())
-alltiles = striptiles
-
-# Set compression type in case of TIFF
-if mrf_compression_type.lower() in ['jpeg', 'jpg', 'zen']:
-    tiff_compress = "JPEG"
-else: # Default to png
-    tiff_compress = "PNG"
-
-# Set the blocksize for gdal_translate (-co NAME=VALUE).
-blocksize=str().join(['BLOCKSIZE=', mrf_blocksize])
-
-# Sanity check to make sure all of the input files exist
-for i, tile in enumerate(alltiles):
-
-    if tile.startswith("/vsi"):
-        try:
-            img = gdal.Open(tile)
-            img = None
-        except:
-            log_info_mssg("Missing input file: " + tile)
-            log_sig_exit('ERROR', 'Invalid input files', sigevent_url)
+    # Check if empty tile filename was specified.
+    if len(mrf_empty_tile_filename) == 0:
+        log_info_mssg(str('Empty tile not specified, none will be used.'))
+        mrf_empty_tile_bytes=0
+    else:
+        # Verify that the empty tile can be found.
+        mrf_empty_tile_existing=glob.glob(mrf_empty_tile_filename)
+        if len(mrf_empty_tile_existing) == 0:
+            mssg=str().join(['Specified empty tile file not found:  ', mrf_empty_tile_filename])
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
-    elif not os.path.exists(tile):
-        log_info_mssg("Missing input file: " + tile)
-        log_sig_exit('ERROR', 'Invalid input files', sigevent_url)
+        # Verify that the empty tile image format is either PNG or JPEG.
+        mrf_empty_tile_what=imghdr.what(mrf_empty_tile_filename)
+        if mrf_empty_tile_what != 'png' and mrf_empty_tile_what != 'jpeg' and mrf_empty_tile_what != 'tiff' and mrf_empty_tile_what != 'lerc':
+            mssg='Empty tile image format must be either png, jpeg, tiff, or lerc.'
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
+        # Verify that the empty tile matches MRF compression type.
+        if mrf_empty_tile_what == 'png':
+            # Check the last 3 characters in case of PNG or PPNG or JPNG.
+            if mrf_compression_type[-3:len(mrf_compression_type)] != 'PNG':
+                mssg='Empty tile format does not match MRF compression type.'
+                log_sig_exit('ERROR', mssg, sigevent_url)
 
-# Filter out bad JPEGs
-goodtiles = []
-if mrf_compression_type.lower() in ['jpeg', 'jpg', 'zen']:
-    for i, tile in enumerate(alltiles):
-        if ".mrf" in tile or ".vrt" in tile:  # ignore MRFs and VRTs
-            goodtiles.append(tile)
-            continue
+        if mrf_empty_tile_what == 'jpeg':
+            # Check the first 2 characters in case of JPG or JPEG.
+            if mrf_compression_type.lower() not in ['jpeg', 'jpg', 'zen']:
+                mssg='Empty tile format does not match MRF compression type.'
+                log_sig_exit('ERROR', mssg, sigevent_url)
 
-        try:
-            img = gdal.Open(tile)
+        # Report empty tile size in bytes.
+        mrf_empty_tile_bytes=os.path.getsize(mrf_empty_tile_filename)
+        log_info_mssg(str().join(['Empty tile size is:             ',
+                                  str(mrf_empty_tile_bytes), ' bytes.']))
+
+    ##IS LOCK FILE NECESSARY?
+    ## Lock file indicates tile generation in progress.
+    #lock=glob.glob(str().join([input_dir, '*lock*']))
+    #if len(lock) > 0:
+    #    mssg='Lock found.'
+    #    log_sig_exit('INFO', mssg, sigevent_url)
+
+    #-------------------------------------------------------------------------------
+    # Organize output filenames.
+    #-------------------------------------------------------------------------------
+
+    # Change directory to working_dir.
+    os.chdir(working_dir)
+
+    if partition is not None:
+        if zlevels != '':
+            log_sig_exit('ERROR', '--partition is not supported with z-levels', sigevent_url)
+        log_info_mssg("Building partial MRF {0} of {1}".format(*partition))
+
+    # Journal of completed granules and stages, used to resume an interrupted run.
+    # Output files of a resumed run keep the basename of the run that created them.
+    journal = InsertJournal(str().join([working_dir, parameter_name, '_', date_of_data, time_of_data, '_mrfgen_journal.jsonl']))
+    config_fingerprint = fingerprint(configuration_filename)
+    if resume and zlevels != '':
+        log_sig_warn("--resume is not supported with z-levels, starting a new run", sigevent_url)
+        journal.reset(basename, config_fingerprint)
+    elif resume and journal.load(config_fingerprint):
+        if journal.has_stage('create') and not os.path.isfile(str().join([output_dir, journal.basename, '.mrf'])):
+            log_sig_warn("MRF from interrupted run not found, starting a new run", sigevent_url)
+            journal.reset(basename, config_fingerprint)
+        elif os.path.isfile(compacting_marker(str().join([output_dir, journal.basename, '.mrf']))):
+            log_sig_warn("MRF from interrupted run was being compacted, starting a new run", sigevent_url)
+            remove_file(compacting_marker(str().join([output_dir, journal.basename, '.mrf'])))
+            journal.reset(basename, config_fingerprint)
+        else:
+            basename = journal.basename
+            log_info_mssg(str().join(['Resuming run ', basename, ' with ', str(len(journal.tiles)), ' granules already inserted']))
+    else:
+        if resume:
+            log_sig_warn("No journal found for this configuration at " + journal.filename + ", starting a new run", sigevent_url)
+        journal.reset(basename, config_fingerprint)
+
+    # transparency flag for custom color maps; default to False
+    add_transparency = False
+
+    # Declare scale, offset, and units
+    scale = None
+    offset = None
+    units = None
+
+    # Get list of all tile filenames.
+    alltiles = []
+    if input_files is not None:
+        input_files = input_files.strip()
+        alltiles = input_files.split(',')
+
+    if input_dir is not None:
+        if mrf_compression_type.lower() in ['jpeg', 'jpg', 'zen']:
+            alltiles = alltiles + glob.glob(str().join([input_dir, '*.jpg']))
+        if mrf_compression_type.lower() in ['png', 'ppng', 'zen']:
+            alltiles = alltiles + glob.glob(str().join([input_dir, '*.png']))
+        # check for tiffs
+        alltiles = alltiles + glob.glob(str().join([input_dir, '*.tif']))
+        alltiles = alltiles + glob.glob(str().join([input_dir, '*.tiff']))
+        # check for mrfs
+        alltiles = alltiles + glob.glob(str().join([input_dir, '*.mrf']))
+
+    # Sanitize input in case there were extra spaces
+    striptiles = []
+    for tile in alltiles:
+        striptiles.append(tile.strip())
+    alltiles = striptiles
+
+    # Set compression type in case of TIFF
+    if mrf_compression_type.lower() in ['jpeg', 'jpg', 'zen']:
+        tiff_compress = "JPEG"
+    else: # Default to png
+        tiff_compress = "PNG"
+
+    # Set the blocksize for gdal_translate (-co NAME=VALUE).
+    blocksize=str().join(['BLOCKSIZE=', mrf_blocksize])
+
+    # Sanity check to make sure all of the input files exist and filter out bad JPEGs. The granules are
+    # probed concurrently and each one is checked as soon as its header has been read.
+    stage_metrics = metrics.start()
+    filter_jpegs = mrf_compression_type.lower() in ['jpeg', 'jpg', 'zen']
+    goodtiles = []
+    for tile, exists, tileInfo, error in probe_inputs(alltiles, mrf_validate_threads):
+        if not exists:
+            log_info_mssg("Missing input file: " + tile)
+            log_sig_exit('ERROR', 'Invalid input files', sigevent_url)
 
-            if img is None:
+        if filter_jpegs and ".mrf" not in tile and ".vrt" not in tile:  # ignore MRFs and VRTs
+            if error is not None:
+                log_sig_exit('ERROR', 'Failed to execute gdal.Open', sigevent_url)
+            if tileInfo is None or tileInfo['bands'] == 1:
                 log_sig_err("Bad JPEG tile detected: {0}".format(tile), sigevent_url)
                 continue
-        except RuntimeError as e:
-            log_sig_exit('ERROR', 'Failed to execute gdal.Open', sigevent_url)
-
-        if img.RasterCount == 1:
-            log_sig_err("Bad JPEG tile detected: {0}".format(tile), sigevent_url)
-            img = None
-            continue
-
-        img = None
 
         goodtiles.append(tile)
-
     alltiles = goodtiles
 
-# Convert RGBA PNGs to indexed paletted PNGs if requested
-if mrf_compression_type == 'PPNG' and colormap != '':
-    for i, tile in enumerate(alltiles):
-        temp_tile = None
-        tile_path = os.path.dirname(tile)
-        tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
-
-        # Check input PNGs/TIFFs if RGBA, then convert       
-        if tile.lower().endswith(('.png', '.tif', '.tiff')):
- 
-            gdalinfo_command_list = ['gdalinfo', '-json', tile]
-            log_the_command(gdalinfo_command_list)
-            gdalinfo = subprocess.Popen(gdalinfo_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            returncode = gdalinfo.wait()
-            if returncode != 0:
-                log_sig_err('gdalinfo return code {0}'.format(returncode), sigevent_url)
-            tileInfo = json.loads(gdalinfo.stdout.read())
-
-            has_palette = False
-            for band in tileInfo["bands"]:
-                has_palette |= (band["colorInterpretation"] == "Palette")
-
-            # Read gdal_info output
-            if not has_palette:
-
-                # Download tile locally for RgbPngToPalPng script
-                if tile.startswith("/vsi"):
-                    log_info_mssg("Downloading remote file " + tile)
-
-                    # Create the gdal_translate command.
-                    gdal_translate_command_list=['gdal_translate', '-q', '-co', 'WORLDFILE=YES',
-                                                 tile, working_dir+os.path.basename(tile)]
-
-                    # Log the gdal_translate command.
-                    log_the_command(gdal_translate_command_list)
-
-                    # Execute gdal_translate.
-                    subprocess.call(gdal_translate_command_list, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-
-                    # Replace with new tiles
-                    tile = working_dir+os.path.basename(tile)
-
-                if '.tif' in tile.lower():
-                    # Convert TIFF files to PNG
-                    log_info_mssg("Converting TIFF file " + tile + " to " + tiff_compress)
-
-                    # Create the gdal_translate command.
-                    gdal_translate_command_list=['gdal_translate', '-q', '-of', tiff_compress, '-co', 'WORLDFILE=YES',
-                                                 tile, working_dir+tile_basename+'.'+str(tiff_compress).lower()]
-                    # Log the gdal_translate command.
-                    log_the_command(gdal_translate_command_list)
-
-                    # Execute gdal_translate.
-                    subprocess.call(gdal_translate_command_list, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-
-                    # Replace with new tiles
-                    tile = working_dir+tile_basename+'.'+str(tiff_compress).lower()
-                    temp_tile = tile
-
-                log_info_mssg("Converting RGBA PNG to indexed paletted PNG")
-
-                output_tile = working_dir + tile_basename+'_indexed.png'
-                output_tile_path = os.path.dirname(output_tile)
-                output_tile_basename, output_tile_extension = os.path.splitext(os.path.basename(output_tile))
-
-                # Create the RgbPngToPalPng command.
-                if vrtnodata == "":
-                    fill = 0
+    metrics.stop('validate_inputs', stage_metrics)
+
+    # Convert RGBA PNGs to indexed paletted PNGs if requested. The colormap is parsed once and the
+    # granules are converted, and their palettes validated, by a pool of worker processes.
+    stage_metrics = metrics.start()
+    if mrf_compression_type == 'PPNG' and colormap != '':
+        tasks = []
+        for i, tile in enumerate(alltiles):
+            # Check input PNGs/TIFFs if RGBA, then convert
+            if tile.lower().endswith(('.png', '.tif', '.tiff')):
+                tileInfo = tile_info.get(tile)
+                if tileInfo is None:
+                    log_sig_err('Unable to read image metadata for {0}'.format(tile), sigevent_url)
+                    has_palette = False
                 else:
-                    fill = vrtnodata
-                RgbPngToPalPng_command_list=['/usr/bin/python3 ' + script_dir + 'RgbPngToPalPng.py -v -c ' + colormap +
-                                             ' -f ' + str(fill) + ' -o ' + output_tile + ' -i ' + tile]
-
-                # Log the RgbPngToPalPng command.
-                log_the_command(RgbPngToPalPng_command_list)
-
-                # Execute RgbPngToPalPng.
-                try:
-                    RgbPngToPalPng = subprocess.Popen(RgbPngToPalPng_command_list, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                except OSError:
-                    log_sig_exit('ERROR', "RgbPngToPalPng tool cannot be found.", sigevent_url)
-
-                RgbPngToPalPng.wait()
-                if RgbPngToPalPng.returncode != None:
-                    if  0 < RgbPngToPalPng.returncode < 255:
-                        mssg = "RgbPngToPalPng: " + str(RgbPngToPalPng.returncode) + " colors in image not found in color table"
-                        log_sig_warn(mssg, sigevent_url)
-                    if RgbPngToPalPng.returncode == 255:
-                        mssg = str(RgbPngToPalPng.stderr.readlines()[-1])
-                        log_sig_err("RgbPngToPalPng: " + mssg, sigevent_url, count_err=False)
-                    errors += RgbPngToPalPng.returncode
+                    has_palette = tileInfo["palette"]
 
-                if os.path.isfile(output_tile):
-                    mssg = output_tile + " created"
-                    try:
-                        log_info_mssg(mssg)
-                        # sigevent('INFO', mssg, sigevent_url)
-                    except urllib.error.URLError:
-                        print('sigevent service is unavailable')
-                    # Replace with new tiles
-                    alltiles[i] = output_tile
+                if not has_palette:
+                    tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
+                    tasks.append((i, tile, working_dir + tile_basename + '_indexed.png'))
+                    # add transparency flag for custom color map
+                    add_transparency = True
                 else:
-                    log_sig_err("RgbPngToPalPng failed to create {0}".format(output_tile), sigevent_url)
-
-                # Make a copy of world file
-                try:
-                    if os.path.isfile(tile_path+'/'+tile_basename+'.pgw'):
-                        shutil.copy(tile_path+'/'+tile_basename+'.pgw', output_tile_path+'/'+output_tile_basename+'.pgw')
-                    elif os.path.isfile(working_dir+'/'+tile_basename+'.wld'):
-                        shutil.copy(working_dir+'/'+tile_basename+'.wld', output_tile_path+'/'+output_tile_basename+'.pgw')
-                    else:
-                        log_info_mssg("World file does not exist for tile: {0}".format(tile))
-                except:
-                    log_sig_err("ERROR: " + mssg, sigevent_url)
-
-
-                # Save projection information for EPSG detection
-                try:
-                    if os.path.isfile(working_dir+'/'+tile_basename+'.png.aux.xml'):
-                        shutil.copy(working_dir+'/'+tile_basename+'.png.aux.xml', output_tile_path+'/'+output_tile_basename+'.png.aux.xml')
-                    else:
-                        log_info_mssg("Geolocation file does not exist for tile: " + tile)
-                except:
-                    log_sig_err("ERROR: " + mssg, sigevent_url)
-
-                # add transparency flag for custom color map
-                add_transparency = True
-            else:
-                log_info_mssg("Paletted image found for PPNG output, no palettization required")
-
-            # ONEARTH-348 - Validate the palette, but don't do anything about it yet
-            # For now, we won't enforce any issues, but will log issues validating imagery
-            if strict_palette:
-                oe_validate_palette_command_list=[script_dir + 'oe_validate_palette.py', '-v', '-c', colormap, '-i', alltiles[i]]
+                    log_info_mssg("Paletted image found for PPNG output, no palettization required")
+                    # ONEARTH-348 - Validate the palette, but don't do anything about it yet
+                    # For now, we won't enforce any issues, but will log issues validating imagery
+                    if strict_palette:
+                        tasks.append((i, tile, None))
 
-                # Log the oe_validate_palette.py command.
-                log_the_command(oe_validate_palette_command_list)
-
-                # Execute oe_validate_palette.py
-                try:
-                    oeValidatePalette = subprocess.Popen(oe_validate_palette_command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    oeValidatePalette.wait()
-
-                    if oeValidatePalette.returncode != None:
-                        if  oeValidatePalette.returncode != 0:
-                            mssg = "oe_validate_palette.py: Mismatching palette entries between the image and colormap; Resulting image may be invalid"
-                            log_sig_warn(mssg, sigevent_url)
+        if len(tasks) > 0:
+            try:
+                colors = read_colormap(colormap)
+            except (IOError, ValueError, SyntaxError) as e: # ParseError is a SyntaxError
+                log_sig_exit('ERROR', "Unable to read colormap {0}: {1}".format(colormap, e), sigevent_url)
+            fill = 0 if vrtnodata == "" else int(vrtnodata)
+            convert = functools.partial(palettize_task, colors=colors, fill=fill, validate=strict_palette)
+            workers = max(1, min(multiprocessing.cpu_count(), mrf_cores, len(tasks)))
+            log_info_mssg("Converting {0} images to indexed paletted PNGs with {1} workers".format(len(tasks), workers))
+            with poolcontext(workers) as pool:
+                for i, report in pool.imap(convert, tasks):
+                    if report.error is not None:
+                        log_sig_err("mrf_palette: {0}".format(report.error), sigevent_url)
+                        continue
+                    if len(report.missing) > 0:
+                        mssg = "mrf_palette: {0} colors in {1} not found in color table: {2}".format(
+                            len(report.missing), report.tile, ' '.join(','.join(str(v) for v in color) for color in report.missing[:10]))
+                        log_sig_warn(mssg, sigevent_url)
+                        errors += len(report.missing)
+                    if report.output is not None:
+                        log_info_mssg(report.output + " created")
+                        # Replace with new tiles
+                        alltiles[i] = report.output
+                    if report.mismatches:
+                        mssg = "mrf_palette: Mismatching palette entries between the image {0} and colormap; Resulting image may be invalid".format(report.tile)
+                        log_sig_warn(mssg, sigevent_url)
 
-                except OSError:
-                    log_sig_warn("Error executing oe_validate_palette.py", sigevent_url)
+    metrics.stop('palette', stage_metrics)
 
+    # Create VRTs with the target EPSG for input images if the source EPSG is different or is to be detected:
+    stage_metrics = metrics.start()
+    if source_epsg == "detect" or source_epsg != target_epsg:
+        log_info_mssg("source EPSG != target EPSG or source EPSG is to be detected; Creating VRTs for each input tile in target EPSG")
 
-        # remove tif temp tiles
-        if temp_tile != None:
-            remove_file(temp_tile)
-            remove_file(temp_tile+'.aux.xml')
-            remove_file(temp_tile.split('.')[0]+'.wld')
+        alltiles = reproject_tiles(alltiles, source_epsg, target_epsg, working_dir, mrf_cores)
 
-# Create VRTs with the target EPSG for input images if the source EPSG is different or is to be detected:
-if source_epsg == "detect" or source_epsg != target_epsg:
-    log_info_mssg("source EPSG != target EPSG or source EPSG is to be detected; Creating VRTs for each input tile in target EPSG")
+    metrics.stop('reproject', stage_metrics)
 
-    for i, tile in enumerate(alltiles):
-        temp_tile = None
-        tile_path = os.path.dirname(tile)
-        tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
-        tile_vrt = os.path.join(working_dir, tile_basename + "_reproject.vrt")
-
-        if source_epsg == "detect":
-            s_epsg = get_image_epsg(tile)
+    # Create an encoded PNG from GeoTIFF. Granules are encoded concurrently by a pool of worker processes.
+    stage_metrics = metrics.start()
+    if mrf_compression_type == 'EPNG':
+        scale = 0
+        offset = 0
+        units = mrf_data_units
+        if mrf_data_scale != '' and mrf_data_offset != '':
+            scale_offset = [float(mrf_data_scale), float(mrf_data_offset)]
         else:
-            s_epsg = source_epsg
-
-        if not s_epsg:
-            # if EPSG can't be determined, remove the tile
-            log_sig_warn(tile + " has undetectable EPSG", sigevent_url)
-            del alltiles[i]
-        elif s_epsg != target_epsg:
-            log_info_mssg("Creating VRT for input tile: " + tile)
-
-            # if the source and target EPSGs are not the same, create a VRT
+            scale_offset = None
+        # Check if input is TIFF
+        tasks = [(i, tile) for i, tile in enumerate(alltiles) if tile.lower().endswith(('.tif', '.tiff'))]
+        if len(tasks) > 0:
+            workers = max(1, min(multiprocessing.cpu_count(), mrf_cores, len(tasks)))
+            # the packer's threads share the cores left to each worker
+            threads = max(1, multiprocessing.cpu_count() // workers)
+            if scale_offset is None:
+                # every granule is packed with one scale and offset, from the range of values of all the granules
+                # that aren't encoded yet, or that of the granules that already are
+                encoded = {}
+                minmax = [float("inf"), float("-inf")]
+                with poolcontext(workers) as pool:
+                    for i, stats in pool.imap(functools.partial(epng_stats_task, threads=threads), tasks):
+                        if stats.error is not None:
+                            log_sig_err("EPNG statistics of {0} failed: {1}".format(stats.tile, stats.error), sigevent_url)
+                        elif stats.encoding is not None:
+                            encoded.setdefault(stats.encoding, []).append(stats.tile)
+                        else:
+                            minmax[0] = min(minmax[0], stats.minmax[0])
+                            minmax[1] = max(minmax[1], stats.minmax[1])
+                if len(encoded) > 1:
+                    mssg = "Input TIFFs have different scales and offsets: " + "; ".join(
+                        "Scale: {0}, Offset: {1} ({2} granules)".format(s, o, len(tiles)) for (s, o), tiles in sorted(encoded.items()))
+                    log_sig_exit('ERROR', mssg, sigevent_url)
+                if len(encoded) == 1:
+                    scale_offset = list(list(encoded.keys())[0])
+                elif minmax[0] <= minmax[1]:
+                    # as overtiffpacker computes them for a single TIFF
+                    poffset = math.floor(minmax[0])
+                    scale_offset = [math.floor((2 ** 24 - 1) / (minmax[1] - poffset)), poffset]
+                if scale_offset is not None:
+                    log_info_mssg("Packing TIFFs with Scale: {0}, Offset: {1}".format(*scale_offset))
+            log_info_mssg("Encoding {0} TIFFs as PNGs with {1} workers".format(len(tasks), workers))
+            encode = functools.partial(encode_epng_task, working_dir=working_dir, scale_offset=scale_offset, threads=threads)
+            encodings = {}
+            with poolcontext(workers) as pool:
+                for i, result in pool.imap(encode, tasks):
+                    if result.error is not None:
+                        log_sig_err("EPNG encoding of {0} failed: {1}".format(result.tile, result.error), sigevent_url)
+                        continue
+                    if result.palette:
+                        log_sig_warn("{0} contains a palette".format(result.tile), sigevent_url)
+                        mrf_compression_type = 'PPNG'
+                    log_info_mssg("{0}: Offset: {1}, Scale: {2}".format(result.tile, result.offset, result.scale))
+                    encodings.setdefault((result.scale, result.offset), []).append(result.tile)
+                    alltiles[i] = result.output
+            # every granule must be encoded the same way, or the values of the MRF would be meaningless: only TIFFs
+            # that came in encoded, with another scale and offset than the configured ones, can differ
+            if len(encodings) > 1:
+                mssg = "Input TIFFs have different scales and offsets: " + "; ".join(
+                    "Scale: {0}, Offset: {1} ({2} granules)".format(s, o, len(tiles)) for (s, o), tiles in sorted(encodings.items()))
+                log_sig_exit('ERROR', mssg, sigevent_url)
+            if len(encodings) == 1:
+                scale, offset = list(encodings.keys())[0]
+
+    metrics.stop('epng', stage_metrics)
+
+    #Look for ZenJPEG Output
+    stage_metrics = metrics.start()
+    if mrf_compression_type.lower() == 'zen':
+        # mrf_insert doesn't convert tiles automatically to ZenJPEG
+        # so we first convert each input tile individually into smaller "input" MRFs
+        # and then insert and transform them later just like normal tiles
+        for i, tile in enumerate(alltiles):
+            tile_path = os.path.dirname(tile)
+            tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
+            tile_mrf = os.path.join(working_dir, tile_basename + "_zen.mrf")
+
+            # Do the MRF creation from the input tile
+            gdal_translate_command_list=['gdal_translate', '-q', '-of', 'MRF', '-co', 'compress=JPEG', '-co', blocksize]    
+            gdal_translate_command_list.append('-co')
+            gdal_translate_command_list.append('QUALITY='+quality_prec)
+            gdal_translate_command_list.append(tile)
+            gdal_translate_command_list.append(tile_mrf)
+
+            # Log and execute gdal_translate to generate "input" ZenJPEG MRFs
+            log_the_command(gdal_translate_command_list)
+            gdal_translate_stderr_filename=str().join([working_dir, basename, '_gdal_translate_zen_stderr.txt'])
+            gdal_translate_stderr_file=open(gdal_translate_stderr_filename, 'w')
+            subprocess.call(gdal_translate_command_list, stderr=gdal_translate_stderr_file)
+            gdal_translate_stderr_file.close()
+            if os.path.getsize(gdal_translate_stderr_filename) == 0:
+                remove_file(gdal_translate_stderr_filename)
 
-            gdalwarp_command_list = ['gdalwarp', '-q', '-overwrite', '-of', 'vrt', '-s_srs', s_epsg, '-t_srs', target_epsg, tile, tile_vrt]
+            alltiles[i] = tile_mrf
 
-            # Log the gdalbuildvrt command.
-            log_the_command(gdalwarp_command_list)
+    metrics.stop('zen', stage_metrics)
 
-            # Capture stderr to record skipped .png files that are not valid PNG+World.
-            gdalwarp_stderr_filename = str().join([working_dir, basename, '_gdalwarp_stderr.txt'])
-            # Open stderr file for write.
-            gdalwarp_stderr_file = open(gdalwarp_stderr_filename, 'w+')
-
-            # ---------------------------------------------------------------------------
-            # Execute gdalwarp.
-            subprocess.call(gdalwarp_command_list, stderr=gdalwarp_stderr_file)
-            # ---------------------------------------------------------------------------
-
-            gdalwarp_stderr_file.seek(0)
-            gdalwarp_stderr = gdalwarp_stderr_file.read()
-            if "Error" in gdalwarp_stderr:
-                log_info_mssg(gdalwarp_stderr)
-                log_sig_err('ERROR', "Error creating VRT for input image", sigevent_url)
-                gdalwarp_stderr_file.close()
-                del alltiles[i]
-                continue
+    # sort
+    alltiles.sort()
 
-            # If we made it this far, the VRT was created successfully, so replace it in the input list
-            alltiles[i] = tile_vrt
+    # Write all tiles list to a file on disk.
+    all_tiles_filename=str().join([working_dir, basename, '_all_tiles.txt'])
+    try:
+        # Open file.
+        alltilesfile=open(all_tiles_filename, 'w')
+    except IOError:
+        mssg=str().join(['Cannot open for write:  ', all_tiles_filename])
+        log_sig_exit('ERROR', mssg, sigevent_url)
+    else:
+        # Write to file with line termination.
+        if len(alltiles) > 0:
+            for ndx in range(len(alltiles)):
+                alltilesfile.write(str().join([alltiles[ndx], '\n']))
+        elif empty_vrt is not None:
+            # Create a VRT for an empty input
+            alltilesfile.write("{0}\n".format(empty_vrt))
+        else:
+            mssg='No input tiles or empty VRT to process'
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
-# Create an encoded PNG from GeoTIFF
-if mrf_compression_type == 'EPNG':
-    scale = 0
-    offset = 0
-    units = mrf_data_units
-    for i, tile in enumerate(alltiles):
-        tile_path = os.path.dirname(tile)
-        tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
-        output_tile = working_dir+tile_basename+'.png'
-        # Check if input is TIFF
-        if tile.lower().endswith(('.tif', '.tiff')):
-            # NOTE: Did not convert to JSON parsing because of a lack of test data
-            # Get Scale and Offset from gdalinfo
-            gdalinfo_command_list = ['gdalinfo', tile]
-            log_the_command(gdalinfo_command_list)
-            gdalinfo = subprocess.Popen(gdalinfo_command_list,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            returncode = gdalinfo.wait()
-            if returncode != 0:
-                log_sig_err("gdalinfo return code {0}".format(returncode), sigevent_url)
-            gdalinfo_out = gdalinfo.stdout.readlines()
-            if "Color Table" in ''.join(gdalinfo_out):
-                log_sig_warn("{0} contains a palette".format(tile), sigevent_url)
-                mrf_compression_type = 'PPNG'
-            if "Offset:" in ''.join(gdalinfo_out) and "Scale:" in ''.join(gdalinfo_out):
-                log_info_mssg("{0} is already an encoded TIFF".format(tile))
-            else: # Encode the TIFF file
-                encoded_tile = working_dir+tile_basename+'_encoded.tif'
-                log_info_mssg("{0} will be encoded as {1}".format(tile, encoded_tile))
-                if mrf_data_scale != '' and mrf_data_offset != '':
-                    scale_offset = [float(mrf_data_scale), float(mrf_data_offset)]
-                else:
-                    scale_offset = None
-                pack(tile, encoded_tile, False, True, None, None, scale_offset, False)
-                tile = encoded_tile
-                gdalinfo_command_list = ['gdalinfo', tile]
-                log_the_command(gdalinfo_command_list)
-                gdalinfo = subprocess.Popen(gdalinfo_command_list,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                returncode = gdalinfo.wait()
-                if returncode != 0:
-                    log_sig_err("gdalinfo return code {0}".format(returncode), sigevent_url)
-                gdalinfo_out = gdalinfo.stdout.readlines()
-            log_info_mssg("Reading scale and offset from bands")
-            for line in gdalinfo_out:
-                if "Offset:" in str(line) and "Scale:" in str(line):
-                    offset,scale = str(line).strip().replace("Offset: ","").replace("Scale:","").split(",")
-                    log_info_mssg("Offset: " + offset + ", Scale: " + scale)
-                    scale = int(scale)
-                    offset = int(offset)
-            gdalinfo_stderr = gdalinfo.stderr.read()
-            if len(gdalinfo_stderr) > 0:
-                log_sig_err(gdalinfo_stderr, sigevent_url)
-
-            # Convert the tile to PNG
-            gdal_translate_command_list = ['gdal_translate', '-of', 'PNG', tile, output_tile]
-            log_the_command(gdal_translate_command_list)
-            gdal_translate = subprocess.Popen(gdal_translate_command_list,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            returncode = gdal_translate.wait()
-            gdal_translate_stderr = gdal_translate.stderr.read()
-            if len(gdal_translate_stderr) > 0:
-                log_sig_err(gdal_translate_stderr, sigevent_url)
-            if returncode != 0:
-                log_sig_err("gdal_translate return code {0}".format(returncode), sigevent_url)
-            alltiles[i] = output_tile
-
-#Look for ZenJPEG Output
-if mrf_compression_type.lower() == 'zen':
-    # mrf_insert doesn't convert tiles automatically to ZenJPEG
-    # so we first convert each input tile individually into smaller "input" MRFs
-    # and then insert and transform them later just like normal tiles
-    for i, tile in enumerate(alltiles):
-        tile_path = os.path.dirname(tile)
-        tile_basename, tile_extension = os.path.splitext(os.path.basename(tile))
-        tile_mrf = os.path.join(working_dir, tile_basename + "_zen.mrf")
+        # Close file.
+        alltilesfile.close()
+    # Send to log.
+    log_info_mssg(str().join(['all tiles:  ', str(len(alltiles))]))
+    log_info_mssg(all_tiles_filename)
 
-        # Do the MRF creation from the input tile
-        gdal_translate_command_list=['gdal_translate', '-q', '-of', 'MRF', '-co', 'compress=JPEG', '-co', blocksize]    
-        gdal_translate_command_list.append('-co')
-        gdal_translate_command_list.append('QUALITY='+quality_prec)
-        gdal_translate_command_list.append(tile)
-        gdal_translate_command_list.append(tile_mrf)
+    #-------------------------------------------------------------------------------
+    # Begin GDAL processing.
+    #-------------------------------------------------------------------------------
 
-        # Log and execute gdal_translate to generate "input" ZenJPEG MRFs
-        log_the_command(gdal_translate_command_list)
-        gdal_translate_stderr_filename=str().join([working_dir, basename, '_gdal_translate_zen_stderr.txt'])
-        gdal_translate_stderr_file=open(gdal_translate_stderr_filename, 'w')
-        subprocess.call(gdal_translate_command_list, stderr=gdal_translate_stderr_file)
-        gdal_translate_stderr_file.close()
-        if os.path.getsize(gdal_translate_stderr_filename) == 0:
-            remove_file(gdal_translate_stderr_filename)
-
-        alltiles[i] = tile_mrf
-
-# sort
-alltiles.sort()
-
-# Write all tiles list to a file on disk.
-all_tiles_filename=str().join([working_dir, basename, '_all_tiles.txt'])
-try:
-    # Open file.
-    alltilesfile=open(all_tiles_filename, 'w')
-except IOError:
-    mssg=str().join(['Cannot open for write:  ', all_tiles_filename])
-    log_sig_exit('ERROR', mssg, sigevent_url)
-else:
-    # Write to file with line termination.
-    if len(alltiles) > 0:
-        for ndx in range(len(alltiles)):
-            alltilesfile.write(str().join([alltiles[ndx], '\n']))
-    elif empty_vrt is not None:
-        # Create a VRT for an empty input
-        alltilesfile.write("{0}\n".format(empty_vrt))
+    # Convert date of the data into day of the year.  Requred for TWMS server.
+    doy=get_doy_string(date_of_data)
+    # Combine year and doy to conform to TWMS convention (yyyydoy).
+    doy=str().join([date_of_data[0:4], str(doy)])
+    # Send to log.
+    log_info_mssg(str().join(['doy:  ', doy]))
+
+    # The .mrf file is the XML component of the MRF format.
+    mrf_filename=str().join([output_dir, basename, '.mrf'])
+    # The .idx file is the index compnent of the MRF format.
+    idx_filename=str().join([output_dir, basename, '.idx'])
+
+    if mrf_compression_type in ['PNG', 'PPNG', 'EPNG']:
+        # Output filename.
+        out_filename=str().join([output_dir, basename, '.ppg'])
+    elif mrf_compression_type == 'JPNG':
+        # Output filename.
+        out_filename=str().join([output_dir, basename, '.pjp'])
+    elif mrf_compression_type in ['JPG', 'JPEG', 'ZEN']:
+        # Output filename.
+        out_filename=str().join([output_dir, basename, '.pjg'])
+    elif mrf_compression_type in ['TIF', 'TIFF']:
+        # Output filename.
+        out_filename=str().join([output_dir, basename, '.ptf'])
+    elif mrf_compression_type == 'LERC':
+        # Output filename.
+        out_filename=str().join([output_dir, basename, '.lrc'])
     else:
-        mssg='No input tiles or empty VRT to process'
+        mssg='Unrecognized compression type for MRF: ' + mrf_compression_type 
         log_sig_exit('ERROR', mssg, sigevent_url)
 
-    # Close file.
-    alltilesfile.close()
-# Send to log.
-log_info_mssg(str().join(['all tiles:  ', str(len(alltiles))]))
-log_info_mssg(all_tiles_filename)
+    # The .vrt file is the XML describing the virtual image mosaic layout.
+    vrt_filename=str().join([working_dir, basename, '.vrt'])
 
-#-------------------------------------------------------------------------------
-# Begin GDAL processing.
-#-------------------------------------------------------------------------------
+    # Make certain output files do not preexist.  GDAL has issues with that.
+    if not journal.has_stage('create'):
+        remove_file(mrf_filename)
+        remove_file(idx_filename)
+        remove_file(out_filename)
+        remove_file(vrt_filename)
 
-# Convert date of the data into day of the year.  Requred for TWMS server.
-doy=get_doy_string(date_of_data)
-# Combine year and doy to conform to TWMS convention (yyyydoy).
-doy=str().join([date_of_data[0:4], str(doy)])
-# Send to log.
-log_info_mssg(str().join(['doy:  ', doy]))
+    # Check if this is an MRF insert update, if not then regenerate a new MRF
+    mrf_list = []
+    if overview_resampling[:4].lower() == 'near' or overview_resampling.lower() == 'nnb':
+        insert_method = 'NearNB'
+    else:
+        insert_method = 'Avg'
+
+    # Resampling for the pyramid builder with mrf_incremental_overviews; None if only gdaladdo supports
+    # overview_resampling. Otherwise overviews are patched with insert_method, as mrf_insert -r does.
+    overview_sampling = sampling_method(overview_resampling) if mrf_incremental_overviews else None
+    if mrf_compression_type == 'PPNG' and overview_sampling == 'avg':
+        overview_sampling = 'mode' # averaging palette indices would produce unrelated colors
+
+    # With mrf_incremental_overviews, default overview levels are only regenerated under the inserted blocks, when the
+    # pyramid builder supports the resampling; its results can differ slightly from those of gdaladdo
+    incremental_overviews = mrf_incremental_overviews and overview_levels == '' and overview_sampling is not None
+
+    for tile in list(alltiles):
+        if '.mrf' in tile.lower() and '_zen.' not in tile:
+            mrf_list.append(tile)
+            alltiles.remove(tile)
+
+    # If more than one MRF, expected behavior is unknown... so exit
+    if len(mrf_list) > 1:
+        log_sig_exit('ERROR', "Multiple MRFs found in input list, expected behavior unknown", sigevent_url)
+    # Only be one MRF, so use that one
+    elif len(mrf_list) == 1:
+        mrf = mrf_list[0]
+        timeout = time.time() + 30 # 30 second timeout if MRF is still being generated
+
+        # Bail if a remote MRF is included in the input list.  Just can't handle this yet.
+        if mrf.startswith("/vsi"):
+            mssg='Cannot support a remote (i.e. /vsi...) MRF input'
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
-# The .mrf file is the XML component of the MRF format.
-mrf_filename=str().join([output_dir, basename, '.mrf'])
-# The .idx file is the index compnent of the MRF format.
-idx_filename=str().join([output_dir, basename, '.idx'])
+        while not os.path.isfile(mrf):
+            mssg=str().join([mrf, ' does not exist'])
+            if time.time() > timeout:
+                log_sig_exit('ERROR', mssg, sigevent_url)
+                break
+            log_sig_warn(mssg + ", waiting 5 seconds...", sigevent_url)
+            time.sleep(5)
+
+        # Check if zdb is used
+        if zlevels != '':
+            mrf, z, zdb_out, con = insert_zdb(mrf, zlevels, zkey, source_url, scale, offset, units)
+            if con:
+                con.commit()
+                con.close()
+                log_info_mssg("Successfully committed record to " + zdb_out)
+            else:
+                log_info_mssg("No ZDB record created")
+        else:
+            con = None
 
-def get_extension(compression_type):
-    if compression_type in ['PNG', 'PPNG', 'EPNG', 'JPNG']:
-        return "ppg"
-    elif compression_type in ['JPG', 'JPEG']:
-        return "pjg"
-    elif compression_type in ['TIF', 'TIFF']:
-        return "ptf"
-    elif compression_type == 'LERC':
-        return "lrc"
-    else:
-        return None
+        # Skip granules a resumed run already inserted
+        insert_tiles = journal.pending(alltiles)
+        if len(insert_tiles) < len(alltiles):
+            log_info_mssg("Skipping {0} granules inserted by the interrupted run".format(len(alltiles) - len(insert_tiles)))
+
+        with metrics.stage('insert'):
+            if mrf_coalesce_blocks > 0 and len(insert_tiles) > 1:
+                insert_tiles = coalesce_tiles(insert_tiles, target_x, target_y, mrf_blocksize,
+                                              [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg,
+                                              vrtnodata, merge, working_dir, mrf_coalesce_blocks)
+            if mrf_parallel:
+                parallel_mrf_insert(insert_tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
+                                     [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir, mrf_cores)
+            else:
+                serial_mrf_insert(insert_tiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
+                                  [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir)
+            release_inserter()
+            release_mosaics()
+
+        # Clean up
+        remove_file(all_tiles_filename)
+
+        # Exit here since we don't need to build an MRF from scratch
+        mssg=str().join(['MRF updated:  ', mrf])
+        log_info_mssg(mssg)
+        metrics.write(str().join([logfile_dir, basename, '_metrics']), basename)
+
+        # Exit mrfgen because we are done; keep the journal so a failed run can be resumed
+        if errors > 0:
+            print("{0} errors encountered".format(errors))
+            sys.exit(1)
+        else:
+            journal.remove()
+            sys.exit(0)
 
-if mrf_compression_type in ['PNG', 'PPNG', 'EPNG']:
-    # Output filename.
-    out_filename=str().join([output_dir, basename, '.ppg'])
-elif mrf_compression_type == 'JPNG':
-    # Output filename.
-    out_filename=str().join([output_dir, basename, '.pjp'])
-elif mrf_compression_type in ['JPG', 'JPEG', 'ZEN']:
-    # Output filename.
-    out_filename=str().join([output_dir, basename, '.pjg'])
-elif mrf_compression_type in ['TIF', 'TIFF']:
-    # Output filename.
-    out_filename=str().join([output_dir, basename, '.ptf'])
-elif mrf_compression_type == 'LERC':
-    # Output filename.
-    out_filename=str().join([output_dir, basename, '.lrc'])
-else:
-    mssg='Unrecognized compression type for MRF: ' + mrf_compression_type 
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-# The .vrt file is the XML describing the virtual image mosaic layout.
-vrt_filename=str().join([working_dir, basename, '.vrt'])
-
-# Make certain output files do not preexist.  GDAL has issues with that.
-remove_file(mrf_filename)
-remove_file(idx_filename)
-remove_file(out_filename)
-remove_file(vrt_filename)
-
-# Check if this is an MRF insert update, if not then regenerate a new MRF
-mrf_list = []
-if overview_resampling[:4].lower() == 'near' or overview_resampling.lower() == 'nnb':
-    insert_method = 'NearNB'
-else:
-    insert_method = 'Avg'
-
-for tile in list(alltiles):
-    if '.mrf' in tile.lower() and '_zen.' not in tile:
-        mrf_list.append(tile)
-        alltiles.remove(tile)
-
-# If more than one MRF, expected behavior is unknown... so exit
-if len(mrf_list) > 1:
-    log_sig_exit('ERROR', "Multiple MRFs found in input list, expected behavior unknown", sigevent_url)
-# Only be one MRF, so use that one
-elif len(mrf_list) == 1:
-    mrf = mrf_list[0]
-    timeout = time.time() + 30 # 30 second timeout if MRF is still being generated
-
-    # Bail if a remote MRF is included in the input list.  Just can't handle this yet.
-    if mrf.startswith("/vsi"):
-        mssg='Cannot support a remote (i.e. /vsi...) MRF input'
-        log_sig_exit('ERROR', mssg, sigevent_url)
+    # Else, no MRF so continue on with the rest of the processing...
 
-    while not os.path.isfile(mrf):
-        mssg=str().join([mrf, ' does not exist'])
-        if time.time() > timeout:
-            log_sig_exit('ERROR', mssg, sigevent_url)
-            break
-        log_sig_warn(mssg + ", waiting 5 seconds...", sigevent_url)
-        time.sleep(5)
 
-    # Check if zdb is used
+    # Use zdb index if z-levels are defined
     if zlevels != '':
-        mrf, z, zdb_out, con = insert_zdb(mrf, zlevels, zkey, source_url, scale, offset, units)
+        mrf_filename, idx_filename, out_filename, output_aux, output_vrt = get_mrf_names(out_filename, mrf_name,
+                                                                                         parameter_name, date_of_data,
+                                                                                         time_of_data)
+        mrf_filename = output_dir + mrf_filename
+        idx_filename = output_dir + idx_filename
+        out_filename = output_dir + out_filename
+        gdal_mrf_filename, z, zdb_out, con = insert_zdb(mrf_filename, zlevels, zkey, source_url, scale, offset, units)
+        # Commit database if successful
         if con:
             con.commit()
             con.close()
@@ -2175,476 +2963,507 @@ elif len(mrf_list) == 1:
             log_info_mssg("No ZDB record created")
     else:
         con = None
+        gdal_mrf_filename = mrf_filename
+
+
+    # Build the VRT and the empty MRF, unless a resumed run already did
+    stage_metrics = metrics.start()
+    direct = False
+    if not journal.has_stage('create'):
+        gdalbuildvrt_command_list=['gdalbuildvrt', '-q', '-input_file_list', all_tiles_filename]
+
+        # all tiles are now in the target_epsg because:
+        #   a) source_epsg == target_epsg
+        #       OR
+        #   b) source_epsg != target_epsg and we've fixed that by replacing the tile with a VRT
+
+        # Set the extents and EPSG based on the target since we know that that the EPSG of all tiles is the target EPSG
+        gdalbuildvrt_command_list.extend(['-te', target_xmin, target_ymin, target_xmax, target_ymax])
+        gdalbuildvrt_command_list.append('-a_srs')
+        gdalbuildvrt_command_list.append(target_epsg)
+
+        if target_x != '':
+            # set the output resolution if a target size has been provided
+            xres = repr(abs((float(target_xmax)-float(target_xmin))/float(target_x)))
+            if target_y != '':
+                yres = repr(abs((float(target_ymin)-float(target_ymax))/float(target_y)))
+            else:
+                yres = xres
+            log_info_mssg("x resolution: " + xres + ", y resolution: " + yres)
+            gdalbuildvrt_command_list.append('-resolution')
+            gdalbuildvrt_command_list.append('user')
+            gdalbuildvrt_command_list.append('-tr')
+            gdalbuildvrt_command_list.append(xres)
+            gdalbuildvrt_command_list.append(yres)
+
+        if vrtnodata != "":
+            # set the nodata values if provided
+            gdalbuildvrt_command_list.append('-vrtnodata')
+            gdalbuildvrt_command_list.append(vrtnodata)
+            gdalbuildvrt_command_list.append('-srcnodata')
+            gdalbuildvrt_command_list.append(vrtnodata)
+
+
+        # add VRT filename at the end
+        gdalbuildvrt_command_list.append(vrt_filename)
+        # Log the gdalbuildvrt command.
+        log_the_command(gdalbuildvrt_command_list)
+        # Capture stderr to record skipped .png files that are not valid PNG+World.
+        gdalbuildvrt_stderr_filename=str().join([working_dir, basename,
+                                                 '_gdalbuildvrt_stderr.txt'])
+        # Open stderr file for write.
+        gdalbuildvrt_stderr_file=open(gdalbuildvrt_stderr_filename, 'w')
+
+        #---------------------------------------------------------------------------
+        # Execute gdalbuildvrt.
+        subprocess.call(gdalbuildvrt_command_list, stderr=gdalbuildvrt_stderr_file)
+        #---------------------------------------------------------------------------
+
+        # use gdalwarp if resize with resampling method is declared
+        if resize_resampling != '':
+            if target_y == '':
+                target_y = str(int(target_x)/2)
+            gdal_warp_command_list = ['gdalwarp', '-of', 'VRT' ,'-r', resize_resampling, '-ts', str(target_x), str(target_y),
+                                      '-te', target_xmin, target_ymin, target_xmax, target_ymax, '-overwrite', vrt_filename,
+                                      vrt_filename.replace('.vrt','_resample.vrt')]
+            log_the_command(gdal_warp_command_list)
+            subprocess.call(gdal_warp_command_list, stderr=gdalbuildvrt_stderr_file)
+            vrt_filename = vrt_filename.replace('.vrt','_resample.vrt')
 
-    if mrf_parallel:
-        parallel_mrf_insert(alltiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
-                             [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir, mrf_cores)
-    else:
-        run_mrf_insert(alltiles, mrf, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
-                             [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir, max_size=mrf_maxsize)
-    
-    # Clean up
-    remove_file(all_tiles_filename)
+        # Close stderr file.
+        gdalbuildvrt_stderr_file.close()
 
-    # Exit here since we don't need to build an MRF from scratch
-    mssg=str().join(['MRF updated:  ', mrf])
-    log_info_mssg(mssg)
+        # Open stderr file for read.
+        try:
+            gdalbuildvrt_stderr_file=open(gdalbuildvrt_stderr_filename, 'r')
+            # Report skipped .png files that are not valid PNG+World.
+            gdalbuildvrt_stderr=gdalbuildvrt_stderr_file.readlines()
+            # Loop over all lines in file.
+            for ndx in range(len(gdalbuildvrt_stderr)):
+                # Get line number(s) where skipped files appear in the stderr file.
+                skipped=str(gdalbuildvrt_stderr[ndx]).find('Warning')
+                # If a line (including line 0) was found.
+                if skipped >= 0:
+                    mssg=str().join(['gdalbuildvrt ', str(gdalbuildvrt_stderr[ndx])])
+                    log_sig_warn(mssg, sigevent_url)
+            # Close file.
+            gdalbuildvrt_stderr_file.close()
+        except IOError:
+            mssg=str().join(['Cannot read:  ', gdalbuildvrt_stderr_filename])
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
-    # Exit mrfgen because we are done
-    if errors > 0:
-        print("{0} errors encountered".format(errors))
-        sys.exit(1)
-    else:
-        sys.exit(0)
+        # Clean up.
+        remove_file(all_tiles_filename)
+        # Check if vrt was created.
+        vrt_output=glob.glob(vrt_filename)
+        if len(vrt_output) == 0:
+            mssg=str().join(['Fail:  gdalbuildvrt',
+                             '  May indicate no georeferenced tiles found.',
+                             #'  May indicate unappropriate target_x.',
+                             '  Look at stderr file:  ',
+                             gdalbuildvrt_stderr_filename])
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
-# Else, no MRF so continue on with the rest of the processing...
-
-
-# Use zdb index if z-levels are defined
-if zlevels != '':
-    mrf_filename, idx_filename, out_filename, output_aux, output_vrt = get_mrf_names(out_filename, mrf_name,
-                                                                                     parameter_name, date_of_data,
-                                                                                     time_of_data)
-    mrf_filename = output_dir + mrf_filename
-    idx_filename = output_dir + idx_filename
-    out_filename = output_dir + out_filename
-    gdal_mrf_filename, z, zdb_out, con = insert_zdb(mrf_filename, zlevels, zkey, source_url, scale, offset, units)
-    # Commit database if successful
-    if con:
-        con.commit()
-        con.close()
-        log_info_mssg("Successfully committed record to " + zdb_out)
-    else:
-        log_info_mssg("No ZDB record created")
-else:
-    con = None
-    gdal_mrf_filename = mrf_filename
+        # Create mrf only if vrt was successful.
+        vrtf=get_modification_time(vrt_filename)
+        remove_file(gdalbuildvrt_stderr_filename)
+
+        # Set the compression type for gdal_translate (-co NAME=VALUE).
+        if mrf_compression_type == 'PNG' or mrf_compression_type == 'EPNG':
+            # Unpaletted PNG.
+            compress=str('COMPRESS=PNG')
+        elif mrf_compression_type == 'PPNG':
+            # Paletted PNG.
+            compress=str('COMPRESS=PPNG')
+        elif mrf_compression_type == 'JPNG':
+            # JPNG Blended Format
+            compress=str('COMPRESS=JPNG')
+        elif mrf_compression_type == 'JPG':
+            compress=str('COMPRESS=JPEG')
+        elif mrf_compression_type == 'JPEG':
+            compress=str('COMPRESS=JPEG')
+        elif mrf_compression_type == 'ZEN':
+            compress=str('COMPRESS=JPEG')
+        elif mrf_compression_type == 'TIFF' or mrf_compression_type == 'TIF':
+            compress=str('COMPRESS=TIF')
+        elif mrf_compression_type == 'LERC':
+            compress=str('COMPRESS=LERC')
+        else:
+            mssg='Unrecognized compression type for MRF.'
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
+        # Insert color map into VRT if provided
+        # TODO This could be problematic if we're overwriting with a different palette than what is in the imagery.
+        if colormap != '':
+            new_vrt_filename = vrt_filename.replace('.vrt','_newcolormap.vrt')
+            colormap2vrt_command_list=[script_dir+'colormap2vrt.py','--colormap',colormap,'--output',new_vrt_filename,'--merge',vrt_filename]
+            if add_transparency == True:
+                colormap2vrt_command_list.append('--transparent')
+            if send_email == True:
+                colormap2vrt_command_list.append('--send_email')
+            if email_server != '':
+                colormap2vrt_command_list.append('--email_server')
+                colormap2vrt_command_list.append(email_server)
+            if email_recipient != '':
+                colormap2vrt_command_list.append('--email_recipient')
+                colormap2vrt_command_list.append(email_recipient)
+            if email_sender != '':
+                colormap2vrt_command_list.append('--email_sender')
+                colormap2vrt_command_list.append(email_sender)
+            log_the_command(colormap2vrt_command_list)
+            colormap2vrt_stderr_filename=str().join([working_dir, basename,'_colormap2vrt_stderr.txt'])
+            colormap2vrt_stderr_file=open(colormap2vrt_stderr_filename, 'w+')
+            subprocess.call(colormap2vrt_command_list, stderr=colormap2vrt_stderr_file)
+            colormap2vrt_stderr_file.seek(0)
+            colormap2vrt_stderr = colormap2vrt_stderr_file.read()
+            log_info_mssg(colormap2vrt_stderr)
+            if "Error" in colormap2vrt_stderr:
+                log_sig_exit('ERROR', "Error executing colormap2vrt.py with colormap:" + colormap, sigevent_url)
+            colormap2vrt_stderr_file.close()
+            if os.path.isfile(new_vrt_filename):
+                remove_file(colormap2vrt_stderr_filename)
+                vrt_filename = new_vrt_filename
+
+        # Get input size.
+        dom=xml.dom.minidom.parse(vrt_filename)
+        rastersize_elements=dom.getElementsByTagName('VRTDataset')
+        x_size=rastersize_elements[0].getAttribute('rasterXSize') #width
+        y_size=rastersize_elements[0].getAttribute('rasterYSize') #height
+
+        if target_x == '':
+            log_info_mssg('x size and y size from VRT ' + x_size + "," + y_size)
+            exp=11 #minimum outsize 20480 for EPSG4326_2km
+            while int(10*(2**exp)) < int(x_size):
+                exp+=1
+            target_x=str(10*(2**exp))
+            log_info_mssg('Calculating target_x from VRT to ' + target_x)
+
+        # Only use new target size if different.
+        if target_x != x_size:
+            # Calculate output size of Y dimension and maintain aspect ratio.
+            if target_y == '':
+                target_y=str(int(float(target_x)*(float(y_size)/float(x_size))))
+                log_info_mssg('Calculating target_y ' + target_y)
+            if resize_resampling == '':
+                log_sig_warn("Target size ({0}x{1}) differs from input size ({2}x{3}), but <resize_resampling> flag has not been set.".
+                             format(target_x, target_y, x_size, y_size), sigevent_url)
+        else: #don't bother calculating y
+            if target_y == '':
+                target_y=y_size
+                log_info_mssg("Setting target_y from VRT to {0}".format(target_y))
+            elif target_y != y_size:
+                log_sig_warn("Target y size ({0}) differs from raster y size ({1})".format(target_y, y_size), sigevent_url)
+
+        # Granules that cover the whole MRF are copied into it as it is created, instead of inserted afterwards
+        if mrf_direct and zlevels == '' and partition is None and mrf_compression_type != 'ZEN':
+            direct = can_build_direct(alltiles, vrt_filename, target_x, target_y, mrf_blocksize,
+                                      [target_xmin, target_ymin, target_xmax, target_ymax], vrtnodata, merge)
+            log_info_mssg("Building the MRF directly from " + vrt_filename if direct else "Inserting granules into an empty MRF")
+
+
+        #-----------------------------------------------------------------------
+        # Seed the MRF data file (.ppg or .pjg) with a copy of the empty tile.
+        if mrf_empty_tile_filename != '' and (z is None or z == 0):
+            log_info_mssg('Seed the MRF data file with a copy of the empty tile.' )
+            log_info_mssg(str().join(['Copy ', mrf_empty_tile_filename,' to ', out_filename]))
+            shutil.copy(mrf_empty_tile_filename, out_filename)
+        #-----------------------------------------------------------------------
+
+        # Create the gdal_translate command.
+        gdal_translate_command_list=['gdal_translate', '-q', '-of', 'MRF', '-co', compress, '-co', blocksize,'-outsize', target_x, target_y]    
+        if compress in ["COMPRESS=JPEG", "COMPRESS=PNG", "COMPRESS=JPNG"]:
+            gdal_translate_command_list.append('-co')
+            gdal_translate_command_list.append('QUALITY='+quality_prec)
+        if compress == "COMPRESS=LERC":
+            # Default to V1 for Javascript decoding
+            gdal_translate_command_list.append('-co')
+            gdal_translate_command_list.append('OPTIONS="LERC_PREC=' + quality_prec + ' V1=ON DEFLATE=ON"')
+        if zlevels != '':
+            gdal_translate_command_list.append('-co')
+            gdal_translate_command_list.append('ZSIZE='+str(zlevels))
 
-gdalbuildvrt_command_list=['gdalbuildvrt', '-q', '-input_file_list', all_tiles_filename]
+        gdal_translate_command_list.append('-co')
+        gdal_translate_command_list.append('NOCOPY=true')
+        # use UNIFORM_SCALE if empty MRF, single input, noaddo, incremental_overviews or a partial MRF, so that
+        # partial MRFs all have the same index layout
+        uniform_scale = noaddo or len(alltiles) <= 1 or incremental_overviews or partition is not None
+        if uniform_scale:
+            gdal_translate_command_list.append('-co')
+            gdal_translate_command_list.append('UNIFORM_SCALE='+str(int(overview)))
+
+        # add ending parameters
+        gdal_translate_command_list.append(vrt_filename)
+        gdal_translate_command_list.append(gdal_mrf_filename)
+
+        # Log the gdal_translate command.
+        log_the_command(gdal_translate_command_list)
+        # Capture stderr.
+        gdal_translate_stderr_filename=str().join([working_dir, basename, '_gdal_translate_stderr.txt'])
+        # Open stderr file for write.
+        gdal_translate_stderr_file=open(gdal_translate_stderr_filename, 'w')
 
-# all tiles are now in the target_epsg because:
-#   a) source_epsg == target_epsg
-#       OR
-#   b) source_epsg != target_epsg and we've fixed that by replacing the tile with a VRT
+        #-----------------------------------------------------------------------
+        # Execute gdal_translate.
+        subprocess.call(gdal_translate_command_list, stderr=gdal_translate_stderr_file)
+        #-----------------------------------------------------------------------
+
+        # Close stderr file.
+        gdal_translate_stderr_file.close()
+
+        # Fill the base level from the VRT before the temporary VRTs are removed; the overviews that were
+        # created with UNIFORM_SCALE are built from it like after inserts, the others by gdaladdo below
+        if direct and os.path.isfile(mrf_filename):
+            with metrics.stage('direct_build'):
+                if build_direct(vrt_filename, gdal_mrf_filename, mrf_blocksize, mrf_cores) > 0:
+                    log_sig_warn("Direct build of {0} failed, inserting granules instead".format(mrf_filename), sigevent_url)
+                    direct = False
+            if direct and uniform_scale:
+                update_overviews(gdal_mrf_filename, insert_method, [(0, 0, int(target_x), int(target_y))])
+
+        # Copy vrt to output
+        if not data_only:
+            shutil.copy(vrt_filename, str().join([output_dir, basename, '.vrt']))
+
+        # Clean up temporary VRT files
+        for vrt in [v for v in glob.glob(str().join([working_dir, basename, '*.vrt'])) if (v not in alltiles)]:
+            remove_file(vrt)
 
-# Set the extents and EPSG based on the target since we know that that the EPSG of all tiles is the target EPSG
-gdalbuildvrt_command_list.extend(['-te', target_xmin, target_ymin, target_xmax, target_ymax])
-gdalbuildvrt_command_list.append('-a_srs')
-gdalbuildvrt_command_list.append(target_epsg)
+        # Check if MRF was created.
+        mrf_output=glob.glob(mrf_filename)
+        if len(mrf_output) == 0:
+            mssg=str().join(['Fail:  gdal_translate',
+                             ' Check gdal mrf driver plugin.',
+                             ' Check stderr file:  ',
+                             gdal_translate_stderr_filename])
+            log_sig_exit('ERROR', mssg, sigevent_url)
 
-if target_x != '':
-    # set the output resolution if a target size has been provided
-    xres = repr(abs((float(target_xmax)-float(target_xmin))/float(target_x)))
-    if target_y != '':
-        yres = repr(abs((float(target_ymin)-float(target_ymax))/float(target_y)))
+        journal.record_stage('create', target_x=target_x, target_y=target_y, vrtf=vrtf, direct=direct)
     else:
-        yres = xres
-    log_info_mssg("x resolution: " + xres + ", y resolution: " + yres)
-    gdalbuildvrt_command_list.append('-resolution')
-    gdalbuildvrt_command_list.append('user')
-    gdalbuildvrt_command_list.append('-tr')
-    gdalbuildvrt_command_list.append(xres)
-    gdalbuildvrt_command_list.append(yres)
-
-if vrtnodata != "":
-    # set the nodata values if provided
-    gdalbuildvrt_command_list.append('-vrtnodata')
-    gdalbuildvrt_command_list.append(vrtnodata)
-    gdalbuildvrt_command_list.append('-srcnodata')
-    gdalbuildvrt_command_list.append(vrtnodata)
-
-
-# add VRT filename at the end
-gdalbuildvrt_command_list.append(vrt_filename)
-# Log the gdalbuildvrt command.
-log_the_command(gdalbuildvrt_command_list)
-# Capture stderr to record skipped .png files that are not valid PNG+World.
-gdalbuildvrt_stderr_filename=str().join([working_dir, basename,
-                                         '_gdalbuildvrt_stderr.txt'])
-# Open stderr file for write.
-gdalbuildvrt_stderr_file=open(gdalbuildvrt_stderr_filename, 'w')
-
-#---------------------------------------------------------------------------
-# Execute gdalbuildvrt.
-subprocess.call(gdalbuildvrt_command_list, stderr=gdalbuildvrt_stderr_file)
-#---------------------------------------------------------------------------
-
-# use gdalwarp if resize with resampling method is declared
-if resize_resampling != '':
-    if target_y == '':
-        target_y = str(int(target_x)/2)
-    gdal_warp_command_list = ['gdalwarp', '-of', 'VRT' ,'-r', resize_resampling, '-ts', str(target_x), str(target_y),
-                              '-te', target_xmin, target_ymin, target_xmax, target_ymax, '-overwrite', vrt_filename,
-                              vrt_filename.replace('.vrt','_resample.vrt')]
-    log_the_command(gdal_warp_command_list)
-    subprocess.call(gdal_warp_command_list, stderr=gdalbuildvrt_stderr_file)
-    vrt_filename = vrt_filename.replace('.vrt','_resample.vrt')
-
-# Close stderr file.
-gdalbuildvrt_stderr_file.close()
-
-# Open stderr file for read.
-try:
-    gdalbuildvrt_stderr_file=open(gdalbuildvrt_stderr_filename, 'r')
-    # Report skipped .png files that are not valid PNG+World.
-    gdalbuildvrt_stderr=gdalbuildvrt_stderr_file.readlines()
-    # Loop over all lines in file.
-    for ndx in range(len(gdalbuildvrt_stderr)):
-        # Get line number(s) where skipped files appear in the stderr file.
-        skipped=str(gdalbuildvrt_stderr[ndx]).find('Warning')
-        # If a line (including line 0) was found.
-        if skipped >= 0:
-            mssg=str().join(['gdalbuildvrt ', str(gdalbuildvrt_stderr[ndx])])
-            log_sig_warn(mssg, sigevent_url)
-    # Close file.
-    gdalbuildvrt_stderr_file.close()
-except IOError:
-    mssg=str().join(['Cannot read:  ', gdalbuildvrt_stderr_filename])
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-# Clean up.
-remove_file(all_tiles_filename)
-# Check if vrt was created.
-vrt_output=glob.glob(vrt_filename)
-if len(vrt_output) == 0:
-    mssg=str().join(['Fail:  gdalbuildvrt',
-                     '  May indicate no georeferenced tiles found.',
-                     #'  May indicate unappropriate target_x.',
-                     '  Look at stderr file:  ',
-                     gdalbuildvrt_stderr_filename])
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-# Create mrf only if vrt was successful.
-vrtf=get_modification_time(vrt_filename)
-remove_file(gdalbuildvrt_stderr_filename)
-
-# Set the compression type for gdal_translate (-co NAME=VALUE).
-if mrf_compression_type == 'PNG' or mrf_compression_type == 'EPNG':
-    # Unpaletted PNG.
-    compress=str('COMPRESS=PNG')
-elif mrf_compression_type == 'PPNG':
-    # Paletted PNG.
-    compress=str('COMPRESS=PPNG')
-elif mrf_compression_type == 'JPNG':
-    # JPNG Blended Format
-    compress=str('COMPRESS=JPNG')
-elif mrf_compression_type == 'JPG':
-    compress=str('COMPRESS=JPEG')
-elif mrf_compression_type == 'JPEG':
-    compress=str('COMPRESS=JPEG')
-elif mrf_compression_type == 'ZEN':
-    compress=str('COMPRESS=JPEG')
-elif mrf_compression_type == 'TIFF' or mrf_compression_type == 'TIF':
-    compress=str('COMPRESS=TIF')
-elif mrf_compression_type == 'LERC':
-    compress=str('COMPRESS=LERC')
-else:
-    mssg='Unrecognized compression type for MRF.'
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-# Insert color map into VRT if provided
-# TODO This could be problematic if we're overwriting with a different palette than what is in the imagery.
-if colormap != '':
-    new_vrt_filename = vrt_filename.replace('.vrt','_newcolormap.vrt')
-    colormap2vrt_command_list=[script_dir+'colormap2vrt.py','--colormap',colormap,'--output',new_vrt_filename,'--merge',vrt_filename]
-    if add_transparency == True:
-        colormap2vrt_command_list.append('--transparent')
-    if send_email == True:
-        colormap2vrt_command_list.append('--send_email')
-    if email_server != '':
-        colormap2vrt_command_list.append('--email_server')
-        colormap2vrt_command_list.append(email_server)
-    if email_recipient != '':
-        colormap2vrt_command_list.append('--email_recipient')
-        colormap2vrt_command_list.append(email_recipient)
-    if email_sender != '':
-        colormap2vrt_command_list.append('--email_sender')
-        colormap2vrt_command_list.append(email_sender)
-    log_the_command(colormap2vrt_command_list)
-    colormap2vrt_stderr_filename=str().join([working_dir, basename,'_colormap2vrt_stderr.txt'])
-    colormap2vrt_stderr_file=open(colormap2vrt_stderr_filename, 'w+')
-    subprocess.call(colormap2vrt_command_list, stderr=colormap2vrt_stderr_file)
-    colormap2vrt_stderr_file.seek(0)
-    colormap2vrt_stderr = colormap2vrt_stderr_file.read()
-    log_info_mssg(colormap2vrt_stderr)
-    if "Error" in colormap2vrt_stderr:
-        log_sig_exit('ERROR', "Error executing colormap2vrt.py with colormap:" + colormap, sigevent_url)
-    colormap2vrt_stderr_file.close()
-    if os.path.isfile(new_vrt_filename):
-        remove_file(colormap2vrt_stderr_filename)
-        vrt_filename = new_vrt_filename
-
-# Get input size.
-dom=xml.dom.minidom.parse(vrt_filename)
-rastersize_elements=dom.getElementsByTagName('VRTDataset')
-x_size=rastersize_elements[0].getAttribute('rasterXSize') #width
-y_size=rastersize_elements[0].getAttribute('rasterYSize') #height
-
-if target_x == '':
-    log_info_mssg('x size and y size from VRT ' + x_size + "," + y_size)
-    exp=11 #minimum outsize 20480 for EPSG4326_2km
-    while int(10*(2**exp)) < int(x_size):
-        exp+=1
-    target_x=str(10*(2**exp))
-    log_info_mssg('Calculating target_x from VRT to ' + target_x)
-
-# Only use new target size if different.
-if target_x != x_size:
-    # Calculate output size of Y dimension and maintain aspect ratio.
-    if target_y == '':
-        target_y=str(int(float(target_x)*(float(y_size)/float(x_size))))
-        log_info_mssg('Calculating target_y ' + target_y)
-    if resize_resampling == '':
-        log_sig_warn("Target size ({0}x{1}) differs from input size ({2}x{3}), but <resize_resampling> flag has not been set.".
-                     format(target_x, target_y, x_size, y_size), sigevent_url)
-else: #don't bother calculating y
-    if target_y == '':
-        target_y=y_size
-        log_info_mssg("Setting target_y from VRT to {0}".format(target_y))
-    elif target_y != y_size:
-        log_sig_warn("Target y size ({0}) differs from raster y size ({1})".format(target_y, y_size), sigevent_url)
-
-
-#-----------------------------------------------------------------------
-# Seed the MRF data file (.ppg or .pjg) with a copy of the empty tile.
-if mrf_empty_tile_filename != '' and (z is None or z == 0):
-    log_info_mssg('Seed the MRF data file with a copy of the empty tile.' )
-    log_info_mssg(str().join(['Copy ', mrf_empty_tile_filename,' to ', out_filename]))
-    shutil.copy(mrf_empty_tile_filename, out_filename)
-#-----------------------------------------------------------------------
-
-# Create the gdal_translate command.
-gdal_translate_command_list=['gdal_translate', '-q', '-of', 'MRF', '-co', compress, '-co', blocksize,'-outsize', target_x, target_y]    
-if compress in ["COMPRESS=JPEG", "COMPRESS=PNG", "COMPRESS=JPNG"]:
-    gdal_translate_command_list.append('-co')
-    gdal_translate_command_list.append('QUALITY='+quality_prec)
-if compress == "COMPRESS=LERC":
-    # Default to V1 for Javascript decoding
-    gdal_translate_command_list.append('-co')
-    gdal_translate_command_list.append('OPTIONS="LERC_PREC=' + quality_prec + ' V1=ON DEFLATE=ON"')
-if zlevels != '':
-    gdal_translate_command_list.append('-co')
-    gdal_translate_command_list.append('ZSIZE='+str(zlevels))
-
-gdal_translate_command_list.append('-co')
-gdal_translate_command_list.append('NOCOPY=true')
-# use UNIFORM_SCALE if empty MRF, single input, or noaddo
-if noaddo or len(alltiles) <= 1:
-    gdal_translate_command_list.append('-co')
-    gdal_translate_command_list.append('UNIFORM_SCALE='+str(int(overview)))
-
-# add ending parameters
-gdal_translate_command_list.append(vrt_filename)
-gdal_translate_command_list.append(gdal_mrf_filename)
-
-# Log the gdal_translate command.
-log_the_command(gdal_translate_command_list)
-# Capture stderr.
-gdal_translate_stderr_filename=str().join([working_dir, basename, '_gdal_translate_stderr.txt'])
-# Open stderr file for write.
-gdal_translate_stderr_file=open(gdal_translate_stderr_filename, 'w')
-
-#-----------------------------------------------------------------------
-# Execute gdal_translate.
-subprocess.call(gdal_translate_command_list, stderr=gdal_translate_stderr_file)
-#-----------------------------------------------------------------------
-
-# Close stderr file.
-gdal_translate_stderr_file.close()
-
-# Copy vrt to output
-if not data_only:
-    shutil.copy(vrt_filename, str().join([output_dir, basename, '.vrt']))
-
-# Clean up temporary VRT files
-for vrt in [v for v in glob.glob(str().join([working_dir, basename, '*.vrt'])) if (v not in alltiles)]:
-    remove_file(vrt)
-
-# Check if MRF was created.
-mrf_output=glob.glob(mrf_filename)
-if len(mrf_output) == 0:
-    mssg=str().join(['Fail:  gdal_translate',
-                     ' Check gdal mrf driver plugin.',
-                     ' Check stderr file:  ',
-                     gdal_translate_stderr_filename])
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-# Get largest x,y dimension of MRF, usually x.
-try:
-    # Open file.
-    mrf_file=open(mrf_filename, 'r+')
-except IOError:
-    mssg=str().join(['Cannot read:  ', mrf_filename])
-    log_sig_exit('ERROR', mssg, sigevent_url)
-else:
+        create = journal.stages['create']
+        target_x, target_y, vrtf = create['target_x'], create['target_y'], create['vrtf']
+        direct = create.get('direct', False)
+        gdal_translate_stderr_filename=str().join([working_dir, basename, '_gdal_translate_stderr.txt'])
+        remove_file(all_tiles_filename)
+        log_info_mssg(str().join(['Resuming with existing MRF ', mrf_filename]))
+    metrics.stop('create', stage_metrics)
+
+    # Get largest x,y dimension of MRF, usually x.
     try:
-        dom=xml.dom.minidom.parse(mrf_file)
-    except:
-        mssg=str().join(['Cannot parse:  ', mrf_filename])
+        # Open file.
+        mrf_file=open(mrf_filename, 'r+')
+    except IOError:
+        mssg=str().join(['Cannot read:  ', mrf_filename])
         log_sig_exit('ERROR', mssg, sigevent_url)
-    # Raster
-    size_elements=dom.getElementsByTagName('Size')
-    sizeX=size_elements[0].getAttribute('x') #width
-    sizeY=size_elements[0].getAttribute('y') #height
-    sizeC=size_elements[0].getAttribute('c') #bands
-    sizeZ=size_elements[0].getAttribute('z') #bands
-    # Send to log.
-    log_info_mssg(str().join(['size of MRF:  ', sizeX, ' x ', sizeY]))
-
-    # Add mp_safe to Raster if using z levels
-    if zlevels != '':
-        mrf_file.seek(0)
-        lines = mrf_file.readlines()
-        for idx in range(0, len(lines)):
-            if '<Raster>' in str(lines[idx]):
-                lines[idx] = str(lines[idx]).replace('<Raster>','<Raster mp_safe="on">')
-                log_info_mssg("Set MRF mp_safe on")
-        mrf_file.seek(0)
-        mrf_file.truncate()
-        mrf_file.writelines(lines)
-
-    # Close file.
-    mrf_file.close()
-    # Get largest dimension, usually X.
-    actual_size=max([int(sizeX), int(sizeY)])
-
-# Insert if there are input tiles to process
-if len(alltiles) > 0:
-    if mrf_parallel:
-        parallel_mrf_insert(alltiles, gdal_mrf_filename, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
-                             [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir, mrf_cores)
     else:
-        run_mrf_insert(alltiles, gdal_mrf_filename, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
-                             [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir, max_size=mrf_maxsize)
-
-
-# Create pyramid only if idx (MRF index file) was successfully created.
-idxf=get_modification_time(idx_filename)
-compare_time=time.strftime('%Y%m%d.%H%M%S', time.localtime())
-old_stats=os.stat(idx_filename)
-if idxf >= vrtf:
-    remove_file(gdal_translate_stderr_filename)
-
-    # Run gdaladdo if noaddo==False, we have more than one tile, and we have none or >1 overviews
-    if (not noaddo) and (len(alltiles) > 1) and (overview_levels == '' or int(overview_levels[0]) > 1):
-        # Create the gdaladdo command.
-        gdaladdo_command_list=['gdaladdo', '-r', overview_resampling,
-                               str(gdal_mrf_filename)]
-        # Build out the list of gdaladdo pyramid levels (a.k.a. overviews).
-        if overview_levels == '':
-            overview=2
-            gdaladdo_command_list.append(str(overview))
-            exp=2
-            while (overview*int(mrf_blocksize)) < actual_size:
-                overview=2**exp
-                exp=exp+1
-                gdaladdo_command_list.append(str(overview))
-        else:
-            for overview in overview_levels:
+        try:
+            dom=xml.dom.minidom.parse(mrf_file)
+        except:
+            mssg=str().join(['Cannot parse:  ', mrf_filename])
+            log_sig_exit('ERROR', mssg, sigevent_url)
+        # Raster
+        size_elements=dom.getElementsByTagName('Size')
+        sizeX=size_elements[0].getAttribute('x') #width
+        sizeY=size_elements[0].getAttribute('y') #height
+        sizeC=size_elements[0].getAttribute('c') #bands
+        sizeZ=size_elements[0].getAttribute('z') #bands
+        # Send to log.
+        log_info_mssg(str().join(['size of MRF:  ', sizeX, ' x ', sizeY]))
+
+        # Add mp_safe to Raster if using z levels
+        if zlevels != '':
+            mrf_file.seek(0)
+            lines = mrf_file.readlines()
+            for idx in range(0, len(lines)):
+                if '<Raster>' in str(lines[idx]):
+                    lines[idx] = str(lines[idx]).replace('<Raster>','<Raster mp_safe="on">')
+                    log_info_mssg("Set MRF mp_safe on")
+            mrf_file.seek(0)
+            mrf_file.truncate()
+            mrf_file.writelines(lines)
+
+        # Close file.
+        mrf_file.close()
+        # Get largest dimension, usually X.
+        actual_size=max([int(sizeX), int(sizeY)])
+
+    # Insert if there are input tiles to process, skipping those a resumed run already inserted
+    # A partial MRF only gets its share of the tiles; the empty MRF above was built from all of them
+    share = alltiles
+    if direct:
+        log_info_mssg("Granules were copied into the MRF when it was created, skipping inserts")
+        share = []
+    elif partition is not None:
+        share = partition_tiles(alltiles, partition[0], partition[1], target_x, target_y, mrf_blocksize,
+                                [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, merge)
+    insert_tiles = journal.pending(share)
+    if len(insert_tiles) < len(share):
+        log_info_mssg("Skipping {0} granules inserted by the interrupted run".format(len(share) - len(insert_tiles)))
+    if len(insert_tiles) > 0 or journal.deferred_windows():
+        with metrics.stage('insert'):
+            if mrf_coalesce_blocks > 0 and len(insert_tiles) > 1:
+                insert_tiles = coalesce_tiles(insert_tiles, target_x, target_y, mrf_blocksize,
+                                              [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg,
+                                              vrtnodata, merge, working_dir, mrf_coalesce_blocks)
+            if mrf_parallel:
+                parallel_mrf_insert(insert_tiles, gdal_mrf_filename, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
+                                     [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir, mrf_cores)
+            else:
+                serial_mrf_insert(insert_tiles, gdal_mrf_filename, insert_method, resize_resampling, target_x, target_y, mrf_blocksize,
+                                  [target_xmin, target_ymin, target_xmax, target_ymax], target_epsg, vrtnodata, merge, working_dir)
+            release_inserter()
+            release_mosaics()
+
+
+    # Create pyramid only if idx (MRF index file) was successfully created.
+    stage_metrics = metrics.start()
+    idxf=get_modification_time(idx_filename)
+    compare_time=time.strftime('%Y%m%d.%H%M%S', time.localtime())
+    old_stats=os.stat(idx_filename)
+    if idxf >= vrtf:
+        remove_file(gdal_translate_stderr_filename)
+
+        # Run gdaladdo if noaddo==False, we have more than one tile, and we have none or >1 overviews.
+        # With incremental_overviews the levels were created with UNIFORM_SCALE and only the blocks under the
+        # inserted tiles were regenerated after the inserts (see update_overviews).
+        if journal.has_stage('gdaladdo'):
+            log_info_mssg("Overviews were built by the interrupted run, skipping gdaladdo")
+        elif incremental_overviews:
+            log_info_mssg("Overviews were updated from the inserted blocks, skipping gdaladdo")
+        elif partition is not None:
+            log_info_mssg("Partial MRF, overviews are built when the partitions are combined, skipping gdaladdo")
+        elif (not noaddo) and (len(alltiles) > 1) and (overview_levels == '' or int(overview_levels[0]) > 1):
+            # Create the gdaladdo command.
+            gdaladdo_command_list=['gdaladdo', '-r', overview_resampling,
+                                   str(gdal_mrf_filename)]
+            # Build out the list of gdaladdo pyramid levels (a.k.a. overviews).
+            if overview_levels == '':
+                overview=2
                 gdaladdo_command_list.append(str(overview))
-        # Log the gdaladdo command.
-        log_the_command(gdaladdo_command_list)
-        # Capture stderr.
-        gdaladdo_stderr_filename=str().join([working_dir, basename,
-                                             '_gdaladdo_stderr.txt'])
-        # Open stderr file for write.
-        gdaladdo_stderr_file=open(gdaladdo_stderr_filename, 'w')
-
-        #-------------------------------------------------------------------
-        # Execute gdaladdo.
-        gdaladdo_process = subprocess.Popen(gdaladdo_command_list, stdout=subprocess.PIPE, stderr=gdaladdo_stderr_file)
-        out, err = gdaladdo_process.communicate()
-        log_info_mssg(out)
-        if gdaladdo_process.returncode != 0:
-            log_sig_err("gdaladdo return code {0}".format(gdaladdo_process.returncode), sigevent_url)
-        #-------------------------------------------------------------------
+                exp=2
+                while (overview*int(mrf_blocksize)) < actual_size:
+                    overview=2**exp
+                    exp=exp+1
+                    gdaladdo_command_list.append(str(overview))
+            else:
+                for overview in overview_levels:
+                    gdaladdo_command_list.append(str(overview))
+            # Log the gdaladdo command.
+            log_the_command(gdaladdo_command_list)
+            # Capture stderr.
+            gdaladdo_stderr_filename=str().join([working_dir, basename,
+                                                 '_gdaladdo_stderr.txt'])
+            # Open stderr file for write.
+            gdaladdo_stderr_file=open(gdaladdo_stderr_filename, 'w')
+
+            #-------------------------------------------------------------------
+            # Execute gdaladdo.
+            gdaladdo_process = subprocess.Popen(gdaladdo_command_list, stdout=subprocess.PIPE, stderr=gdaladdo_stderr_file)
+            out, err = gdaladdo_process.communicate()
+            log_info_mssg(out)
+            if gdaladdo_process.returncode != 0:
+                log_sig_err("gdaladdo return code {0}".format(gdaladdo_process.returncode), sigevent_url)
+            #-------------------------------------------------------------------
+
+            # Close stderr file.
+            gdaladdo_stderr_file.close()
+
+            # Update previous cycle time only if gdaladdo was successful.
+            addf=get_modification_time(idx_filename)
+            new_stats=os.stat(idx_filename)
+
+            # Check for gdaladdo success by checking time stamp and file size.
+            if gdaladdo_process.returncode == -11:
+                log_sig_exit('ERROR', 'Unsuccessful:  gdaladdo   Segmentation fault', sigevent_url)
+            elif (addf >= compare_time) or (new_stats.st_size >= old_stats.st_size):
+                remove_file(gdaladdo_stderr_filename)
+                journal.record_stage('gdaladdo')
+            else:
+                log_info_mssg(str().join(['addf = ',str(addf)]))
+                log_info_mssg(str().join(['compare_time = ',str(compare_time)]))
+                log_info_mssg('addf should be >= compare_time')
+                log_info_mssg(str().join(['new_stats.st_size = ',
+                                          str(new_stats.st_size)]))
+                log_info_mssg(str().join(['old_stats.st_size = ',
+                                          str(old_stats.st_size)]))
+                log_info_mssg('new_stats.st_size should be >= old_stats.st_size')
+                mssg=str().join(['Unsuccessful:  gdaladdo   Errors: ', str(err)])
+                log_sig_exit('ERROR', mssg, sigevent_url)
+    else:
+        log_info_mssg(str().join(['idxf = ',str(idxf)]))
+        log_info_mssg(str().join(['vrtf = ',str(vrtf)]))
+        log_info_mssg('idxf should be >= vrtf')
+        mssg = mrf_filename + ' already exists'
+        log_sig_exit('ERROR', mssg, sigevent_url)
+    metrics.stop('gdaladdo', stage_metrics)
+
+    if (mrf_clean or mrf_dedup or mrf_layout != 'file') and journal.has_stage('mrf_clean'):
+        log_info_mssg("mrf_clean was run by the interrupted run, skipping")
+    elif mrf_clean or mrf_dedup or mrf_layout != 'file':
+        log_info_mssg("running {} on data file {}".format("mrf_dedup" if mrf_dedup else "mrf_compact", out_filename))
+        with metrics.stage('mrf_clean'):
+            finish_mrf(out_filename, mrf_filename)
+        journal.record_stage('mrf_clean')
+
+    # Rename MRFs
+    if mrf_name != '':
+        output_mrf, output_idx, output_data, output_aux, output_vrt = get_mrf_names(out_filename, mrf_name, parameter_name, date_of_data, time_of_data)
+        if (output_dir+output_mrf) != mrf_filename:
+            log_info_mssg(str().join(['Moving ',mrf_filename, ' to ', output_dir+output_mrf]))
+            shutil.move(mrf_filename, output_dir+output_mrf)
+        if (output_dir+output_data) != out_filename:
+            log_info_mssg(str().join(['Moving ',out_filename, ' to ', output_dir+output_data]))
+            shutil.move(out_filename, output_dir+output_data)
+        if (output_dir+output_idx) != idx_filename:
+            log_info_mssg(str().join(['Moving ',idx_filename, ' to ', output_dir+output_idx]))
+            shutil.move(idx_filename, output_dir+output_idx)
+        if data_only == False:
+            if os.path.isfile(mrf_filename+".aux.xml"):
+                log_info_mssg(str().join(['Moving ',mrf_filename+".aux.xml", ' to ', working_dir+output_aux]))
+                shutil.move(mrf_filename+".aux.xml", working_dir+output_aux)
+            if os.path.isfile(str().join([output_dir, basename, '.vrt'])):
+                log_info_mssg(str().join(['Moving ',str().join([output_dir, basename, '.vrt']), ' to ', working_dir+output_vrt]))
+                shutil.move(str().join([output_dir, basename, '.vrt']), working_dir+output_vrt)
+        mrf_filename = output_dir+output_mrf
+        out_filename = output_dir+output_data
+
+    # Leave only MRF data, index, and header files
+    if data_only:
+        remove_file(log_filename)
+        remove_file(output_dir+"/"+basename+".mrf.aux.xml")
+        remove_file(working_dir+"/"+basename+".configuration_file.xml")
+
+    # Remove temp tiles
+    working_dir_files = glob.glob(working_dir+"/*")
+    for tilename in (alltiles):
+        if os.path.normpath(tilename) in working_dir_files:
+            if tiff_compress != None:
+                remove_file(tilename+'.aux.xml')
+            if '_indexed.' in tilename:
+                remove_file(tilename.rsplit('.',1)[0]+'.pgw')
+            # Remove intermediary zen MRF files
+            if mrf_compression_type.lower() == 'zen':
+                if '_zen.' in tilename:
+                    for zen_file in glob.iglob(os.path.splitext(tilename)[0]+'*'):
+                        remove_file(zen_file)
+
+    # Write the stage metrics next to the log, unless only the MRF files are wanted
+    if not data_only:
+        metrics.write(str().join([logfile_dir, basename, '_metrics']), basename)
 
-        # Close stderr file.
-        gdaladdo_stderr_file.close()
+    # Send to log.
+    mssg=str().join(['MRF created:  ', out_filename])
+    try:
+        log_info_mssg(mssg)
+        # sigevent('INFO', mssg, sigevent_url)
+    except urllib.error.URLError:
+        None
+    if errors > 0:
+        print("{0} errors encountered".format(errors))
+        sys.exit(1)
+    else:
+        journal.remove()
+        sys.exit(0)
 
-        # Update previous cycle time only if gdaladdo was successful.
-        addf=get_modification_time(idx_filename)
-        new_stats=os.stat(idx_filename)
 
-        # Check for gdaladdo success by checking time stamp and file size.
-        if gdaladdo_process.returncode == -11:
-            log_sig_exit('ERROR', 'Unsuccessful:  gdaladdo   Segmentation fault', sigevent_url)
-        elif (addf >= compare_time) or (new_stats.st_size >= old_stats.st_size):
-            remove_file(gdaladdo_stderr_filename)
-        else:
-            log_info_mssg(str().join(['addf = ',str(addf)]))
-            log_info_mssg(str().join(['compare_time = ',str(compare_time)]))
-            log_info_mssg('addf should be >= compare_time')
-            log_info_mssg(str().join(['new_stats.st_size = ',
-                                      str(new_stats.st_size)]))
-            log_info_mssg(str().join(['old_stats.st_size = ',
-                                      str(old_stats.st_size)]))
-            log_info_mssg('new_stats.st_size should be >= old_stats.st_size')
-            mssg=str().join(['Unsuccessful:  gdaladdo   Errors: ', str(err)])
-            log_sig_exit('ERROR', mssg, sigevent_url)
-else:
-    log_info_mssg(str().join(['idxf = ',str(idxf)]))
-    log_info_mssg(str().join(['vrtf = ',str(vrtf)]))
-    log_info_mssg('idxf should be >= vrtf')
-    mssg = mrf_filename + ' already exists'
-    log_sig_exit('ERROR', mssg, sigevent_url)
-
-if mrf_clean:
-    log_info_mssg("running mrf_clean on data file {}".format(out_filename))
-    clean_mrf(out_filename)
-
-# Rename MRFs
-if mrf_name != '':
-    output_mrf, output_idx, output_data, output_aux, output_vrt = get_mrf_names(out_filename, mrf_name, parameter_name, date_of_data, time_of_data)
-    if (output_dir+output_mrf) != mrf_filename:
-        log_info_mssg(str().join(['Moving ',mrf_filename, ' to ', output_dir+output_mrf]))
-        shutil.move(mrf_filename, output_dir+output_mrf)
-    if (output_dir+output_data) != out_filename:
-        log_info_mssg(str().join(['Moving ',out_filename, ' to ', output_dir+output_data]))
-        shutil.move(out_filename, output_dir+output_data)
-    if (output_dir+output_idx) != idx_filename:
-        log_info_mssg(str().join(['Moving ',idx_filename, ' to ', output_dir+output_idx]))
-        shutil.move(idx_filename, output_dir+output_idx)
-    if data_only == False:
-        if os.path.isfile(mrf_filename+".aux.xml"):
-            log_info_mssg(str().join(['Moving ',mrf_filename+".aux.xml", ' to ', working_dir+output_aux]))
-            shutil.move(mrf_filename+".aux.xml", working_dir+output_aux)
-        if os.path.isfile(str().join([output_dir, basename, '.vrt'])):
-            log_info_mssg(str().join(['Moving ',str().join([output_dir, basename, '.vrt']), ' to ', working_dir+output_vrt]))
-            shutil.move(str().join([output_dir, basename, '.vrt']), working_dir+output_vrt)
-    mrf_filename = output_dir+output_mrf
-    out_filename = output_dir+output_data
-
-# Leave only MRF data, index, and header files
-if data_only:
-    remove_file(log_filename)
-    remove_file(output_dir+"/"+basename+".mrf.aux.xml")
-    remove_file(working_dir+"/"+basename+".configuration_file.xml")
-
-# Remove temp tiles
-working_dir_files = glob.glob(working_dir+"/*")
-for tilename in (alltiles):
-    if os.path.normpath(tilename) in working_dir_files:
-        if tiff_compress != None:
-            remove_file(tilename+'.aux.xml')
-        if '_indexed.' in tilename:
-            remove_file(tilename.rsplit('.',1)[0]+'.pgw')
-        # Remove intermediary zen MRF files
-        if mrf_compression_type.lower() == 'zen':
-            if '_zen.' in tilename:
-                for zen_file in glob.iglob(os.path.splitext(tilename)[0]+'*'):
-                    remove_file(zen_file)
-
-# Send to log.
-mssg=str().join(['MRF created:  ', out_filename])
-try:
-    log_info_mssg(mssg)
-    # sigevent('INFO', mssg, sigevent_url)
-except urllib.error.URLError:
-    None
-if errors > 0:
-    print("{0} errors encountered".format(errors))
-    sys.exit(1)
-else:
-    sys.exit(0)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Runs mrfgen for many configuration files from long running worker processes.
+#
+# Each worker imports mrfgen (and GDAL) once and then calls mrfgen.main for one
+# configuration file after another, so the per-run startup cost is only paid
+# once per worker. Configuration files can be given on the command line (files
+# or directories of *.xml files), or picked up from a queue directory with
+# --queue: new files are moved to <queue>/processing while they run and then to
+# <queue>/done or <queue>/failed. A worker that dies (e.g. a GDAL crash or an
+# out of memory kill) fails its configuration and is replaced by a new one.
+#
+# Example:
+#
+#  mrfgen_batch.py -w 4 /mrfgen/configs/
+#  mrfgen_batch.py -w 4 --queue /mrfgen/queue --interval 10
+#
+
+import argparse
+import collections
+import glob
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import time
+import mrfgen
+
+# seconds between checks that the workers are alive while waiting for results
+POLL_SECONDS = 5
+
+
+def find_configs(paths):
+    """
+    Returns the configuration files in a list of files and directories (*.xml, sorted by name)
+    """
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            configs.extend(sorted(glob.glob(os.path.join(path, '*.xml'))))
+        else:
+            configs.append(path)
+    return configs
+
+
+def run_config(config, mrfgen_args):
+    """
+    Runs mrfgen for one configuration file in this process and returns (config, exit status, seconds)
+    Arguments:
+        config -- The mrfgen configuration file
+        mrfgen_args -- Additional mrfgen command line arguments (e.g. ['--resume'])
+    """
+    start = time.time()
+    cwd = os.getcwd()
+    try:
+        mrfgen.main(['-c', config] + mrfgen_args)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        print("mrfgen failed for {0}: {1}".format(config, e))
+        status = 1
+    finally:
+        os.chdir(cwd) # mrfgen changes to the working_dir of each run
+    return (config, status, time.time() - start)
+
+
+def worker(index, tasks, results, mrfgen_args):
+    # Not a Pool worker: mrfgen starts its own pools when mrf_parallel is set, which daemonic processes can't do
+    for config in iter(tasks.get, None):
+        results.put((index, run_config(config, mrfgen_args)))
+
+
+class BatchRunner:
+    """
+    Hands configuration files to a fixed set of mrfgen worker processes, one at a time per worker, so that the
+    configuration of a worker that dies is known and can be failed.
+    Arguments:
+        workers -- Number of worker processes; 1 runs every configuration in this process
+        mrfgen_args -- Additional mrfgen command line arguments
+    """
+    def __init__(self, workers, mrfgen_args):
+        self.mrfgen_args = mrfgen_args
+        self.backlog = collections.deque()
+        self.processes = []
+        self.tasks = []
+        self.running = [] # (config, start time) of each worker, or None when it is idle
+        self.finished = []
+        if workers > 1:
+            self.results = multiprocessing.Queue()
+            for i in range(workers):
+                self.processes.append(None)
+                self.tasks.append(None)
+                self.running.append(None)
+                self.start_worker(i)
+
+    def start_worker(self, i):
+        self.tasks[i] = multiprocessing.Queue()
+        self.processes[i] = multiprocessing.Process(target=worker, args=(i, self.tasks[i], self.results,
+                                                                         self.mrfgen_args))
+        self.processes[i].start()
+
+    def submit(self, config):
+        if self.processes:
+            self.backlog.append(config)
+            self.dispatch()
+        else:
+            self.finished.append(run_config(config, self.mrfgen_args))
+
+    def dispatch(self):
+        for i in range(len(self.processes)):
+            if self.running[i] is None and self.backlog:
+                self.running[i] = (self.backlog.popleft(), time.time())
+                self.tasks[i].put(self.running[i][0])
+
+    def receive(self, timeout=None):
+        """
+        Records one result from the workers; returns False if none arrived within timeout (0 doesn't wait)
+        """
+        try:
+            i, result = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+        except queue.Empty:
+            return False
+        self.running[i] = None
+        self.finished.append(result)
+        return True
+
+    def check_workers(self):
+        """
+        Fails the configuration of every worker that died and starts a new worker in its place
+        """
+        for i, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            while self.receive(): # results it sent before dying
+                pass
+            if self.running[i] is not None:
+                config, start = self.running[i]
+                print("mrfgen worker for {0} died with exit code {1}".format(config, process.exitcode))
+                self.finished.append((config, process.exitcode or 1, time.time() - start))
+                self.running[i] = None
+            process.join()
+            self.start_worker(i)
+
+    def collect(self, block=False):
+        """
+        Returns the (config, status, seconds) results that are available; with block, waits for all pending runs
+        """
+        while self.backlog or any(running is not None for running in self.running):
+            if not self.receive(POLL_SECONDS if block else 0):
+                self.check_workers()
+                if not block:
+                    break
+            self.dispatch()
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def report(results):
+    failed = 0
+    for config, status, seconds in results:
+        print("{0} {1} ({2:.1f}s)".format("FAILED" if status else "OK", config, seconds))
+        failed += status != 0
+    return failed
+
+
+def run_queue(runner, queue_dir, interval):
+    """
+    Runs the configuration files that appear in queue_dir until interrupted
+    """
+    queue_dir = os.path.abspath(queue_dir)
+    for subdir in ('processing', 'done', 'failed'):
+        os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+    while True:
+        for config in find_configs([queue_dir]):
+            claimed = os.path.join(queue_dir, 'processing', os.path.basename(config))
+            try:
+                os.rename(config, claimed) # another batch process may have claimed it first
+            except OSError:
+                continue
+            runner.submit(claimed)
+        for config, status, seconds in runner.collect():
+            report([(config, status, seconds)])
+            if os.path.dirname(config) == os.path.join(queue_dir, 'processing'):
+                shutil.move(config, os.path.join(queue_dir, 'failed' if status else 'done', os.path.basename(config)))
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs mrfgen for many configuration files from persistent workers.')
+    parser.add_argument('configs', nargs='*', help='Configuration files, or directories of *.xml configuration files')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Number of mrfgen worker processes.  Default: 1')
+    parser.add_argument('-q', '--queue', dest='queue',
+                        help='Queue directory to watch for new configuration files, instead of a list of files')
+    parser.add_argument('-i', '--interval', dest='interval', type=float, default=5,
+                        help='Seconds between scans of the queue directory.  Default: 5')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Pass --resume to mrfgen')
+    parser.add_argument('-d', '--data_only', dest='data_only', action='store_true',
+                        help='Pass --data_only to mrfgen')
+    args = parser.parse_args()
+    if not args.configs and not args.queue:
+        parser.error('Configuration files or --queue are required')
+
+    mrfgen_args = []
+    if args.resume:
+        mrfgen_args.append('--resume')
+    if args.data_only:
+        mrfgen_args.append('--data_only')
+
+    runner = BatchRunner(args.workers, mrfgen_args)
+    try:
+        for config in find_configs(args.configs):
+            runner.submit(os.path.abspath(config))
+        if args.queue:
+            run_queue(runner, args.queue, args.interval)
+        failed = report(runner.collect(block=True))
+    except KeyboardInterrupt:
+        failed = 1
+    finally:
+        runner.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,15 +31,217 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+#
+# Packs a single band GeoTIFF of up to Float32 values into 3 byte bands (24 bit
+# integers after applying a new scale and offset) and, if there is nodata, an
+# alpha band, for encoded PNG (EPNG) MRFs.
+#
+# The source is read once, in windows aligned to its GeoTIFF blocks. Each window
+# is converted to float32 once and all the packed bands and the alpha mask are
+# computed from it. Windows are read and packed by a pool of threads (GDAL and
+# NumPy release the GIL), each with its own handle on the source, and written in
+# order by the calling thread to an output with the same block size. The window
+# size is chosen so that the windows in flight stay under a memory ceiling.
+#
+# Overviews are packed the same way, window by window, from the overviews of the
+# source. Alternatively they can be derived from the packed base level with
+# nearest neighbor resampling, without reading the source again.
+#
+# Example:
+#
+#  overtiffpacker.py -g -t 8 sst.tif sst_packed.tif
+#  overtiffpacker.py -g -M 2048 --overviews-from-packed sst.tif sst_packed.tif
+#
+
 import argparse
+import collections
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 from osgeo import gdal, gdalconst
 from gdalconst import *
 import numpy as np
-import numpy.ma as ma
 import math
 
+# pixels read and packed per window, rounded to whole source blocks
+WINDOW_PIXELS = 1 << 22
+
+# memory used per pixel of a window being packed: the source values (up to float64), their float32 copy,
+# the nodata mask, the int32 packed values, a shifted copy and the packed bands
+BYTES_PER_PIXEL = 32
+
+# default ceiling, in MB, for the memory of the windows being packed
+MAX_MEMORY = 1024
+
+
+def window_pixels(max_memory, threads):
+    """
+    Returns the number of pixels per window that keeps the windows in flight under max_memory MB
+    Arguments:
+        max_memory -- Memory ceiling in MB
+        threads -- Number of threads packing windows; run_windows keeps up to two windows per thread
+    """
+    return max(1, min(WINDOW_PIXELS, (max_memory << 20) // (BYTES_PER_PIXEL * 2 * threads)))
+
+
+def block_windows(band, window_pixels=WINDOW_PIXELS):
+    """
+    Returns (xoff, yoff, xsize, ysize) windows covering a band, made of whole blocks of the band
+    Arguments:
+        band -- GDAL band
+        window_pixels -- Approximate number of pixels per window
+    """
+    block_x, block_y = band.GetBlockSize()
+    blocks_x = max(1, min(int(math.ceil(band.XSize / float(block_x))), window_pixels // (block_x * block_y)))
+    blocks_y = max(1, window_pixels // (block_x * blocks_x * block_y))
+    window_x, window_y = block_x * blocks_x, block_y * blocks_y
+    return [(x, y, min(window_x, band.XSize - x), min(window_y, band.YSize - y))
+            for y in range(0, band.YSize, window_y) for x in range(0, band.XSize, window_x)]
+
+
+def creation_options(band):
+    # write with the block size of the source, so that each window covers whole output blocks
+    block_x, block_y = band.GetBlockSize()
+    if block_x < band.XSize and block_x % 16 == 0 and block_y % 16 == 0:
+        return ['TILED=YES', 'BLOCKXSIZE=%d' % block_x, 'BLOCKYSIZE=%d' % block_y]
+    return ['BLOCKYSIZE=%d' % block_y]
+
+
+def run_windows(infile, windows, work, threads, overview=None):
+    """
+    Reads band 1 of infile in windows with a pool of threads and yields (window, work(data)) in window order.
+    At most two windows per thread are read ahead of the caller.
+    Arguments:
+        infile -- Source dataset
+        windows -- List of (xoff, yoff, xsize, ysize)
+        work -- Function applied to each window's array, in the worker thread
+        threads -- Number of threads
+        overview -- Read this overview of band 1 instead of the band itself
+    """
+    local = threading.local()
+
+    def read(window):
+        # GDAL datasets can't be shared between threads, so each thread opens its own
+        if getattr(local, 'ds', None) is None:
+            local.ds = gdal.Open(infile, GA_ReadOnly)
+        band = local.ds.GetRasterBand(1)
+        if overview is not None:
+            band = band.GetOverview(overview)
+        xoff, yoff, xsize, ysize = window
+        return work(band.ReadAsArray(xoff, yoff, xsize, ysize))
+
+    pool = ThreadPool(max(1, min(threads, len(windows))))
+    try:
+        pending = collections.deque()
+        for window in windows:
+            pending.append((window, pool.apply_async(read, (window,))))
+            if len(pending) >= 2 * threads:
+                window, result = pending.popleft()
+                yield window, result.get()
+        while pending:
+            window, result = pending.popleft()
+            yield window, result.get()
+    finally:
+        pool.terminate()
+
+
+def window_minmax(data, nodata):
+    """
+    Returns the minimum and maximum of the values of a window that aren't nodata
+    """
+    data = data.astype(np.float32)
+    valid = np.ones(data.shape, dtype=bool)
+    for value in nodata:
+        valid &= data != value
+    if not valid.any():
+        return float("inf"), float("-inf")
+    return float(data[valid].min()), float(data[valid].max())
+
+
+def pack_window(data, scale, offset, nodata, pscale, poffset, numbands, noverifydata):
+    """
+    Returns the packed bands of a window of source values: 3 bytes of the scaled 24 bit value, from the least
+    significant, and with nodata an alpha band that is 0 where the value is nodata and 255 elsewhere
+    Arguments:
+        data -- Window of band 1 of the source
+        scale, offset -- Scale and offset of the source band, or None
+        nodata -- List of nodata values, compared after applying scale and offset
+        pscale, poffset -- The packing scale and offset
+        numbands -- 3, or 4 with an alpha band
+        noverifydata -- Skip checking that the packed values fit in 24 bits
+    """
+    data = data.astype(np.float32)
+    if scale is not None:
+        np.multiply(data, scale, data)
+    if offset is not None:
+        np.add(data, offset, data)
+
+    valid = np.ones(data.shape, dtype=bool)
+    for value in nodata:
+        valid &= data != value
+    data[~valid] = poffset
+    np.subtract(data, poffset, data)
+    if not noverifydata:
+        assert (data < 0).sum() == 0, "The offset must be less than the minimum value in the data."
+    np.multiply(data, pscale, data)
+    if not noverifydata:
+        assert (data >= 2 ** 24).sum() == 0, "The scale must make the values fall between 0 and 2^24"
+    packed = data.astype(np.int32)
+
+    bands = [((packed >> (8 * i)) & 0xff).astype(np.uint8) for i in range(3)]
+    if numbands == 4:
+        bands.append(np.where(valid, 255, 0).astype(np.uint8))
+    return bands
+
+
+def source_minmax(infile, rawnodata=None, threads=None, max_memory=MAX_MEMORY):
+    """
+    Returns the (minimum, maximum) of band 1 of infile that pack computes its scale and offset from
+    Arguments:
+        infile -- The source GeoTIFF
+        rawnodata -- Nodata values to leave out, or None to use the statistics of the source
+        threads -- Number of threads reading windows, defaults to the number of CPUs
+        max_memory -- Ceiling in MB for the memory of the windows being read
+    """
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+
+    print("Getting statistics in source data...")
+    tiffds = gdal.Open(infile, GA_ReadOnly)
+    if rawnodata is None:
+        tiffstats = tiffds.GetRasterBand(1).GetStatistics(0, 1)
+        return tiffstats[0], tiffstats[1]
+
+    nodata = [float(value) for value in rawnodata]
+    windows = block_windows(tiffds.GetRasterBand(1), window_pixels(max_memory, threads))
+    minmax = [float("inf"), float("-inf")]
+    for window, (thismin, thismax) in run_windows(infile, windows, lambda data: window_minmax(data, nodata), threads):
+        minmax[0] = min(minmax[0], thismin)
+        minmax[1] = max(minmax[1], thismax)
+    return tuple(minmax)
+
+
+def pack(infile, outfile, calcscaleoffset=False, forgibs=False, minmax=None, rawnodata = None, scaleoffset=None, noverifydata=False,
+         threads=None, max_memory=MAX_MEMORY, overviews_from_packed=False):
+    """
+    Packs band 1 of infile into outfile; see the description above. Returns the packing (scale, offset).
+    Arguments:
+        infile -- The source GeoTIFF
+        outfile -- The packed GeoTIFF to create
+        calcscaleoffset -- Only compute the packing scale and offset
+        forgibs -- Set the nodata value of the packed bands to 0, for mrfgen
+        minmax -- Minimum and maximum values to compute the scale and offset from, or None to get them from the data
+        rawnodata -- Nodata values to use instead of the source's nodata value
+        scaleoffset -- Packing (scale, offset) to use instead of computing them
+        noverifydata -- Skip checking that the offset and scale keep the values within 0 and 2^24
+        threads -- Number of threads reading and packing windows, defaults to the number of CPUs
+        max_memory -- Ceiling in MB for the memory of the windows being packed
+        overviews_from_packed -- Build the overviews from the packed base level (nearest neighbor) instead of
+                                 packing the overviews of the source
+    """
+    if threads is None:
+        threads = multiprocessing.cpu_count()
 
-def pack(infile, outfile, calcscaleoffset=False, forgibs=False, minmax=None, rawnodata = None, scaleoffset=None, noverifydata=False):
     # Get metadata information
     tiffds = gdal.Open(infile, GA_ReadOnly)
     projection = tiffds.GetProjection()
@@ -61,7 +263,8 @@ def pack(infile, outfile, calcscaleoffset=False, forgibs=False, minmax=None, raw
 
     # Create new raster
     ptiffraster = gdal.GetDriverByName("GTiff").Create(outfile, tiffds.RasterXSize, tiffds.RasterYSize, numbands,
-                                                       GDT_Byte, ['COMPRESS=LZW', 'BIGTIFF=YES'])
+                                                       GDT_Byte, ['COMPRESS=LZW', 'BIGTIFF=YES'] +
+                                                       creation_options(tiffds.GetRasterBand(1)))
     ptiffraster.SetProjection(projection)
     ptiffraster.SetGeoTransform(geotransform)
     ptiffraster.SetMetadata(metadata)
@@ -70,32 +273,14 @@ def pack(infile, outfile, calcscaleoffset=False, forgibs=False, minmax=None, raw
     for i in range(tiffds.GetRasterBand(1).GetOverviewCount()):
         overviewlist.append(tiffds.GetRasterBand(1).XSize / tiffds.GetRasterBand(1).GetOverview(i).XSize + 1)
 
-    ptiffraster.BuildOverviews(overviewlist=overviewlist)
+    if not overviews_from_packed:
+        ptiffraster.BuildOverviews(overviewlist=overviewlist)
+
+    pixels = window_pixels(max_memory, threads)
+    windows = block_windows(tiffds.GetRasterBand(1), pixels)
 
-    print("Getting statistics in source data...")
     if minmax is None:
-        if rawnodata is not None:
-            minmax = [float("inf"), float("-inf")]
-            stride = 5
-
-            for j in range(0, tiffds.GetRasterBand(1).YSize, stride):
-                if (tiffds.GetRasterBand(1).YSize - j) < stride:
-                    stride = tiffds.GetRasterBand(1).YSize % stride
-                mask = np.zeros((stride, tiffds.GetRasterBand(1).XSize))
-                tiffdsa = tiffds.GetRasterBand(1).ReadAsArray(xoff=0, yoff=j, win_xsize=tiffds.GetRasterBand(1).XSize,
-                                                              win_ysize=stride).astype(np.float32)
-                for k in range(len(rawnodata)):
-                    mask[tiffdsa == nodata[k]] = 1
-                masktiffdsa = ma.MaskedArray(tiffdsa, mask)
-                thismin = np.amin(masktiffdsa)
-                thismax = np.amax(masktiffdsa)
-                if thismin < minmax[0]:
-                    minmax[0] = thismin
-                if thismax > minmax[1]:
-                    minmax[1] = thismax
-        else:
-            tiffstats = tiffds.GetRasterBand(1).GetStatistics(0, 1)
-            minmax = (tiffstats[0], tiffstats[1])
+        minmax = source_minmax(infile, rawnodata, threads, max_memory)
 
     poffset = math.floor(minmax[0])
     pscale = math.floor((2 ** 24 - 1) / (minmax[1] - poffset))
@@ -106,43 +291,15 @@ def pack(infile, outfile, calcscaleoffset=False, forgibs=False, minmax=None, raw
     print("New offset is %f" % poffset)
 
     if calcscaleoffset:
-        return
+        return pscale, poffset
 
-    print("Reading in source data...")
+    print("Reading in source data and writing %d bands with %d threads..." % (numbands, threads))
+    work = lambda data: pack_window(data, scale, offset, nodata, pscale, poffset, numbands, noverifydata)
+    for (xoff, yoff, xsize, ysize), bands in run_windows(infile, windows, work, threads):
+        for i, data in enumerate(bands):
+            ptiffraster.GetRasterBand(i + 1).WriteArray(data, xoff=xoff, yoff=yoff)
 
     for i in range(1, numbands + 1):
-        print("Writing band %d data..." % i)
-        stride = 5
-        for j in range(0, tiffds.GetRasterBand(1).YSize, stride):
-            if (tiffds.GetRasterBand(1).YSize - j) < stride:
-                stride = tiffds.GetRasterBand(1).YSize % stride
-            tiffdsa = tiffds.GetRasterBand(1).ReadAsArray(xoff=0, yoff=j, win_xsize=tiffds.GetRasterBand(1).XSize,
-                                                          win_ysize=stride).astype(np.float32)
-
-            if scale is not None:
-                np.multiply(tiffdsa, scale, tiffdsa)
-            if offset is not None:
-                np.add(tiffdsa, offset, tiffdsa)
-
-            if i <= 3:
-                for k in range(len(nodata)):
-                    tiffdsa[tiffdsa == nodata[k]] = poffset
-                np.subtract(tiffdsa, poffset, tiffdsa)
-                if not noverifydata:
-                    assert (tiffdsa < 0).sum() == 0, "The offset must be less than the minimum value in the data."
-                np.multiply(tiffdsa, pscale, tiffdsa)
-                if not noverifydata:
-                    assert (tiffdsa >= 2 ** 24).sum() == 0, "The scale must make the values fall between 0 and 2^24"
-                tiffdsa = tiffdsa.astype(np.int32)
-                np.right_shift(tiffdsa, (i - 1) * 8, tiffdsa)
-                np.bitwise_and(tiffdsa, 0x000000ff, tiffdsa)
-            if i == 4:
-                nodatadsa = np.empty(tiffdsa.shape)
-                np.ndarray.fill(nodatadsa, 0x000000ff)
-                for k in range(len(nodata)):
-                    nodatadsa[tiffdsa == nodata[k]] = 0
-                tiffdsa = nodatadsa
-            ptiffraster.GetRasterBand(i).WriteArray(tiffdsa, xoff=0, yoff=j)
         ptiffraster.GetRasterBand(i).SetScale(pscale)
         ptiffraster.GetRasterBand(i).SetOffset(poffset)
         if len(nodata) != 0:  # Write nodata for every band if there is nodata information
@@ -151,37 +308,32 @@ def pack(infile, outfile, calcscaleoffset=False, forgibs=False, minmax=None, raw
                 ptiffraster.GetRasterBand(i).SetNoDataValue(0)
         ptiffraster.FlushCache()
 
-    for j in range(len(overviewlist)):
-        tiffdsa = tiffds.GetRasterBand(1).GetOverview(j).ReadAsArray().astype(np.float32)
+    if overviews_from_packed:
+        # the bytes of a packed value can't be averaged separately, so only nearest neighbor keeps them valid
+        if len(overviewlist) > 0:
+            print("Building overviews from the packed data...")
+            ptiffraster.BuildOverviews('NEAREST', overviewlist)
+        ptiffraster.FlushCache()
+        return pscale, poffset
 
-        if scale is not None:
-            np.multiply(tiffdsa, scale, tiffdsa)
-        if offset is not None:
-            np.add(tiffdsa, offset, tiffdsa)
+    # overviews are made of averaged source values, which may not fit exactly; they were never verified
+    work = lambda data: pack_window(data, scale, offset, nodata, pscale, poffset, numbands, True)
+    for j in range(len(overviewlist)):
+        print("Writing overview %d data..." % j)
+        overview_windows = block_windows(tiffds.GetRasterBand(1).GetOverview(j), pixels)
+        for (xoff, yoff, xsize, ysize), bands in run_windows(infile, overview_windows, work, threads, overview=j):
+            for i, data in enumerate(bands):
+                ptiffraster.GetRasterBand(i + 1).GetOverview(j).WriteArray(data, xoff=xoff, yoff=yoff)
 
         for i in range(1, numbands + 1):
-            if i <= 3:
-                np.subtract(tiffdsa, poffset, tiffdsa)
-                np.multiply(tiffdsa, pscale, tiffdsa)
-                tiffdsa = tiffdsa.astype(np.int32)
-                np.right_shift(tiffdsa, (i - 1) * 8, tiffdsa)
-                np.bitwise_and(tiffdsa, 0x000000ff, tiffdsa)
-            if i == 4:
-                nodatadsa = np.empty(tiffdsa.shape)
-                np.ndarray.fill(nodatadsa, 0x000000ff)
-                for k in range(len(nodata)):
-                    nodatadsa[tiffdsa == nodata[k]] = 0
-                tiffdsa = nodatadsa
-            print("Writing band %d, overview %d data..." % (i, j))
-            ptiffraster.GetRasterBand(i).GetOverview(j).WriteArray(tiffdsa)
             ptiffraster.GetRasterBand(i).GetOverview(j).SetScale(pscale)
             ptiffraster.GetRasterBand(i).GetOverview(j).SetOffset(poffset)
             if len(nodata) != 0:
                 ptiffraster.GetRasterBand(i).GetOverview(j).SetNoDataValue(nodata[0])
                 if forgibs:
-                    ptiffraster.GetRasterBand(i).SetNoDataValue(0)
-            ptiffraster.FlushCache()
-
+                    ptiffraster.GetRasterBand(i).GetOverview(j).SetNoDataValue(0)
+        ptiffraster.FlushCache()
+    return pscale, poffset
 
 def main():
     parser = argparse.ArgumentParser(
@@ -200,9 +352,16 @@ def main():
                        help='The minimum and maximum values for scale and offset)')
     group.add_argument('-s', '--scaleoffset', dest='scaleoffset', type=float, nargs=2,
                        help='The scale and offset values, computed automatically if not specified. Note: offset is also scaled.')
+    parser.add_argument('-t', '--threads', dest='threads', type=int,
+                        help='Number of threads reading and packing the source.  Default: the number of CPUs')
+    parser.add_argument('-M', '--max-memory', dest='max_memory', type=int, default=MAX_MEMORY,
+                        help='Memory ceiling in MB for the data being packed at once.  Default: %d' % MAX_MEMORY)
+    parser.add_argument('--overviews-from-packed', dest='overviews_from_packed', action='store_true',
+                        help='Build the overviews from the packed base level (nearest neighbor) instead of packing the source overviews')
     args = parser.parse_args()
 
-    pack(args.tiff, args.ptiff, args.calcscaleoffset, args.forgibs, args.minmax, args.nodata, args.scaleoffset, args.noverifydata)
+    pack(args.tiff, args.ptiff, args.calcscaleoffset, args.forgibs, args.minmax, args.nodata, args.scaleoffset, args.noverifydata,
+         args.threads, args.max_memory, args.overviews_from_packed)
 
 
 if __name__ == "__main__":
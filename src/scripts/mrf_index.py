@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Reads and writes MRF index (.idx) files as NumPy arrays.
+#
+# An index is a sequence of 16 byte records, a big-endian 64 bit data file
+# offset followed by a 64 bit tile size; a size of 0 means there is no tile.
+# Indexes are memory mapped as structured arrays, so multi-GB indexes can be
+# queried without reading them. MRFIndex adds level/row/col addressing from the
+# Size, PageSize and Rsets elements of the MRF XML: levels are stored full
+# resolution first, each level as z slices of rows of columns of band pages.
+#
+# Example:
+#
+#  mrf_index.py output.mrf
+#  mrf_index.py --histogram output.mrf
+#  mrf_index.py --locality output.mrf
+#
+
+import argparse
+import collections
+import os
+import sys
+import xml.dom.minidom
+import numpy as np
+
+IDX_DTYPE = np.dtype([('offset', '>u8'), ('size', '>u8')])
+RECORD_SIZE = IDX_DTYPE.itemsize
+
+# Tile grid of one level; start is the position of its first record in the index
+Level = collections.namedtuple('Level', ['width', 'height', 'cols', 'rows', 'start', 'count'])
+
+# Byte distances between the data of horizontally and vertically neighboring tiles of a level;
+# contiguous pairs can be read with a single range request
+Locality = collections.namedtuple('Locality', ['pairs', 'mean_distance', 'median_distance', 'contiguous'])
+
+# Orders in which the tiles of each level can be laid out in the data file
+LAYOUTS = ['index', 'hilbert', 'morton']
+
+
+def index_name(filename):
+    """
+    Returns the index file belonging to an MRF header or data file
+    """
+    bname, ext = os.path.splitext(filename)
+    return bname + os.extsep + "idx"
+
+
+def index_dtype(little_endian=False):
+    return IDX_DTYPE.newbyteorder('<') if little_endian else IDX_DTYPE
+
+
+def open_index(idx_filename, mode='r', little_endian=False):
+    """
+    Returns a memory map of an index file as (offset, size) records
+    Arguments:
+        idx_filename -- The .idx file
+        mode -- 'r' for read only, 'r+' to update records in place
+        little_endian -- The index was written little-endian (not the MRF default)
+    """
+    if os.path.getsize(idx_filename) == 0:
+        return np.zeros(0, dtype=index_dtype(little_endian))
+    return np.memmap(idx_filename, dtype=index_dtype(little_endian), mode=mode)
+
+
+def make_records(offsets, sizes):
+    """
+    Returns an array of index records built from sequences of offsets and sizes
+    """
+    records = np.zeros(len(sizes), dtype=IDX_DTYPE)
+    records['offset'] = offsets
+    records['size'] = sizes
+    return records
+
+
+def write_index(idx_filename, records):
+    """
+    Writes a complete index. It is written next to idx_filename and renamed over it, so readers
+    see either the old index or the new one.
+    Arguments:
+        idx_filename -- The .idx file
+        records -- Array of IDX_DTYPE records
+    """
+    tmp_filename = idx_filename + os.extsep + "tmp"
+    with open(tmp_filename, 'wb') as f:
+        np.asarray(records, dtype=IDX_DTYPE).tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filename, idx_filename)
+
+
+def create_index(idx_filename, count):
+    """
+    Creates an index of count empty records and returns it mapped for update
+    """
+    with open(idx_filename, 'wb') as f:
+        f.truncate(count * RECORD_SIZE)
+    return open_index(idx_filename, 'r+')
+
+
+def read_layout(mrf_filename):
+    """
+    Returns the levels of an MRF and its number of z slices and band pages, from its XML header
+    """
+    dom = xml.dom.minidom.parse(mrf_filename)
+    raster = dom.getElementsByTagName('Raster')[0]
+    size = raster.getElementsByTagName('Size')[0]
+    width, height = int(size.getAttribute('x')), int(size.getAttribute('y'))
+    depth = int(size.getAttribute('z') or 1)
+    bands = int(size.getAttribute('c') or 1)
+    page_x = page_y = 512
+    page_bands = bands
+    pages = raster.getElementsByTagName('PageSize')
+    if pages:
+        page_x = int(pages[0].getAttribute('x') or page_x)
+        page_y = int(pages[0].getAttribute('y') or page_y)
+        page_bands = int(pages[0].getAttribute('c') or bands)
+    band_pages = -(-bands // page_bands)
+
+    scale = 0
+    rsets = dom.getElementsByTagName('Rsets')
+    if rsets and rsets[0].getAttribute('model') in ('', 'uniform'):
+        scale = int(float(rsets[0].getAttribute('scale') or 2))
+
+    levels = []
+    start = 0
+    while True:
+        cols, rows = -(-width // page_x), -(-height // page_y)
+        count = cols * rows * depth * band_pages
+        levels.append(Level(width, height, cols, rows, start, count))
+        start += count
+        # overviews continue down to a single tile, like GDAL builds them
+        if scale < 2 or (cols == 1 and rows == 1):
+            break
+        width, height = -(-width // scale), -(-height // scale)
+    return levels, depth, band_pages
+
+
+def spread_bits(v):
+    # inserts a zero bit above each of the low 31 bits of v
+    v = v & 0x7FFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+def morton_keys(rows, cols):
+    """
+    Returns the Morton (Z-order) curve position of every cell of a rows x cols grid
+    """
+    y, x = np.meshgrid(np.arange(rows, dtype=np.int64), np.arange(cols, dtype=np.int64), indexing='ij')
+    return spread_bits(x) | (spread_bits(y) << 1)
+
+
+def hilbert_keys(rows, cols):
+    """
+    Returns the Hilbert curve position of every cell of a rows x cols grid
+    """
+    n = 1
+    while n < max(rows, cols):
+        n *= 2
+    y, x = np.meshgrid(np.arange(rows, dtype=np.int64), np.arange(cols, dtype=np.int64), indexing='ij')
+    d = np.zeros_like(x)
+    s = n // 2
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so that the curve continues from where it left off
+        rotate = ry == 0
+        flip = rotate & (rx == 1)
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(rotate, y, x), np.where(rotate, x, y)
+        s //= 2
+    return d
+
+
+def layout_order(levels, depth, band_pages, layout):
+    """
+    Returns the record numbers of an index in the order their tiles are placed by a layout. Levels keep their
+    index order; within a level the z slices are placed one after the other, each along the layout's curve.
+    Arguments:
+        levels, depth, band_pages -- As returned by read_layout
+        layout -- One of LAYOUTS: index (row-major), hilbert or morton
+    """
+    order = []
+    for lvl in levels:
+        if layout == 'index':
+            cells = np.arange(lvl.rows * lvl.cols, dtype=np.int64)
+        else:
+            keys = hilbert_keys(lvl.rows, lvl.cols) if layout == 'hilbert' else morton_keys(lvl.rows, lvl.cols)
+            cells = np.argsort(keys.ravel(), kind='stable')
+        z = np.arange(depth, dtype=np.int64)[:, np.newaxis, np.newaxis]
+        band = np.arange(band_pages, dtype=np.int64)[np.newaxis, np.newaxis, :]
+        positions = lvl.start + band + band_pages * (cells[np.newaxis, :, np.newaxis] + lvl.rows * lvl.cols * z)
+        order.append(positions.ravel())
+    return np.concatenate(order)
+
+
+def format_locality(locality):
+    return ("{0} neighbor pairs: mean distance {1:.0f} bytes, median {2:.0f} bytes, {3:.1f}% contiguous".
+            format(locality.pairs, locality.mean_distance, locality.median_distance,
+                   100.0 * locality.contiguous / locality.pairs if locality.pairs else 0))
+
+
+class MRFIndex:
+    """
+    The index of an MRF, addressed by level, row and column.
+    Arguments:
+        mrf_filename -- The MRF XML header; the index is the .idx file next to it
+        mode -- 'r' for read only, 'r+' to update records in place
+        little_endian -- The index was written little-endian (not the MRF default)
+    """
+    def __init__(self, mrf_filename, mode='r', little_endian=False):
+        self.levels, self.depth, self.band_pages = read_layout(mrf_filename)
+        self.filename = index_name(mrf_filename)
+        self.records = open_index(self.filename, mode, little_endian)
+
+    def position(self, level, row, col, z=0, band=0):
+        """
+        Returns the record number of a tile; level 0 is full resolution. row, col, z and band may be arrays.
+        """
+        lvl = self.levels[level]
+        if np.any(np.asarray(row) >= lvl.rows) or np.any(np.asarray(col) >= lvl.cols):
+            raise IndexError("Tile row/col outside of level {0} ({1} rows, {2} columns)".format(level, lvl.rows, lvl.cols))
+        return lvl.start + band + self.band_pages * (col + lvl.cols * (row + lvl.rows * z))
+
+    def record(self, position):
+        """
+        Returns the (offset, size) stored at a record number
+        """
+        record = self.records[position]
+        return int(record['offset']), int(record['size'])
+
+    def tile(self, level, row, col, z=0, band=0):
+        """
+        Returns the (offset, size) of a tile
+        """
+        return self.record(self.position(level, row, col, z, band))
+
+    def level_records(self, level):
+        """
+        Returns a view of the records of a level with shape (z, rows, cols, band pages)
+        """
+        lvl = self.levels[level]
+        return self.records[lvl.start:lvl.start + lvl.count].reshape(self.depth, lvl.rows, lvl.cols, self.band_pages)
+
+    def empty_tiles(self, level=None):
+        """
+        Returns the number of records without a tile, in one level or the whole index
+        """
+        records = self.records if level is None else self.level_records(level)
+        return int(np.count_nonzero(records['size'] == 0))
+
+    def bytes_per_level(self):
+        """
+        Returns the total tile size of each level
+        """
+        sizes = np.asarray(self.records['size'], dtype=np.int64)
+        return [int(sizes[lvl.start:lvl.start + lvl.count].sum()) for lvl in self.levels]
+
+    def size_histogram(self, bins=10):
+        """
+        Returns (counts, bin edges) of the sizes of the tiles that exist
+        """
+        sizes = self.records['size']
+        return np.histogram(sizes[sizes > 0].astype(np.int64), bins=bins)
+
+    def locality(self, level=None):
+        """
+        Returns the Locality of the tiles of one level, or of all levels together. Pairs where either tile is
+        missing, or both records point at the same tile, are left out.
+        """
+        distances = []
+        contiguous = 0
+        for i in (range(len(self.levels)) if level is None else [level]):
+            records = self.level_records(i)
+            offsets = records['offset'].astype(np.int64)
+            sizes = records['size'].astype(np.int64)
+            # right neighbors along axis 2 (cols), lower neighbors along axis 1 (rows)
+            for a, b in (((slice(None), slice(None), slice(None, -1)), (slice(None), slice(None), slice(1, None))),
+                         ((slice(None), slice(None, -1)), (slice(None), slice(1, None)))):
+                offset_a, offset_b, size_a, size_b = offsets[a], offsets[b], sizes[a], sizes[b]
+                pairs = (size_a > 0) & (size_b > 0) & ~((offset_a == offset_b) & (size_a == size_b))
+                distances.append(np.abs(offset_b - offset_a)[pairs])
+                contiguous += int(np.count_nonzero(pairs & ((offset_a + size_a == offset_b) | (offset_b + size_b == offset_a))))
+        distances = np.concatenate(distances) if distances else np.zeros(0, dtype=np.int64)
+        if len(distances) == 0:
+            return Locality(0, 0.0, 0.0, 0)
+        return Locality(len(distances), float(distances.mean()), float(np.median(distances)), contiguous)
+
+    def write(self, positions, offsets, sizes):
+        """
+        Updates records in place; the index must be opened with mode 'r+'
+        Arguments:
+            positions -- Record numbers, e.g. from position()
+            offsets -- Data file offsets
+            sizes -- Tile sizes, 0 for no tile
+        """
+        self.records['offset'][positions] = offsets
+        self.records['size'][positions] = sizes
+
+    def flush(self):
+        if isinstance(self.records, np.memmap):
+            self.records.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarizes the index of an MRF.')
+    parser.add_argument('mrf', help='MRF header file; the .idx next to it is read')
+    parser.add_argument('-l', '--little_endian', dest='little_endian', action='store_true',
+                        help='The index is little endian instead of big endian')
+    parser.add_argument('--histogram', dest='histogram', action='store_true',
+                        help='Also print a histogram of the tile sizes')
+    parser.add_argument('--locality', dest='locality', action='store_true',
+                        help='Also print the byte distances between neighboring tiles of each level')
+    args = parser.parse_args()
+
+    index = MRFIndex(args.mrf, little_endian=args.little_endian)
+    expected = index.levels[-1].start + index.levels[-1].count
+    if len(index.records) != expected:
+        print("Warning: {0} has {1} records, the MRF header describes {2}".format(index.filename, len(index.records), expected))
+    print("{0:>5} {1:>7} {2:>7} {3:>10} {4:>10} {5:>14}".format('level', 'rows', 'cols', 'tiles', 'empty', 'bytes'))
+    for i, (lvl, level_bytes) in enumerate(zip(index.levels, index.bytes_per_level())):
+        print("{0:>5} {1:>7} {2:>7} {3:>10} {4:>10} {5:>14}".format(i, lvl.rows, lvl.cols, lvl.count,
+                                                                    index.empty_tiles(i), level_bytes))
+    if args.locality:
+        for i in range(len(index.levels)):
+            print("level {0}: {1}".format(i, format_locality(index.locality(i))))
+    if args.histogram:
+        counts, edges = index.size_histogram()
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            print("{0:>10.0f} - {1:>10.0f} bytes: {2}".format(low, high, count))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
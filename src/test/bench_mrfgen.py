@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Throughput benchmarks for mrfgen.py
+#
+# Generates synthetic granules (geographic and polar, RGBA and paletted,
+# antimeridian crossing) with NumPy and GDAL, runs mrfgen on them in serial,
+# mrf_parallel and merge configurations and reports granules/s, MB/s and the
+# per-stage times from the mrfgen metrics file. Nothing is downloaded.
+#
+# Example:
+#
+#  python3 bench_mrfgen.py -c 1,2,4 -o bench_mrfgen_results.json
+#  python3 bench_mrfgen.py -c 1,2,4 -b bench_mrfgen_baseline.json
+#
+
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+import numpy as np
+from osgeo import gdal, osr
+
+# name, target EPSG, granule kind, antimeridian crossing, number of granules, granule size (pixels)
+SCENARIOS = [
+    ('geo_rgba_small', '4326', 'rgba', False, 64, 256),
+    ('geo_rgba_large', '4326', 'rgba', False, 8, 2048),
+    ('geo_paletted', '4326', 'paletted', False, 32, 512),
+    ('antimeridian_rgba', '4326', 'rgba', True, 16, 512),
+    ('polar_rgba', '3413', 'rgba', False, 32, 512),
+    ('polar_paletted', '3413', 'paletted', False, 32, 512),
+]
+
+EXTENTS = {'4326': (-180, -90, 180, 90), '3413': (-4194304, -4194304, 4194304, 4194304)}
+
+TARGET_X = 16384
+BLOCKSIZE = 512
+
+CONFIG_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<mrfgen_configuration>
+ <date_of_data>20200101</date_of_data>
+ <parameter_name>{name}</parameter_name>
+ <input_dir>{input_dir}</input_dir>
+ <output_dir>{output_dir}</output_dir>
+ <working_dir>{working_dir}</working_dir>
+ <logfile_dir>{working_dir}</logfile_dir>
+ <mrf_empty_tile_filename>{empty_tile}</mrf_empty_tile_filename>
+ <mrf_blocksize>{blocksize}</mrf_blocksize>
+ <mrf_compression_type>{compression}</mrf_compression_type>
+ <overview_resampling>nearest</overview_resampling>
+ <resize_resampling>near</resize_resampling>
+ <target_x>{target_x}</target_x>
+ <target_y>{target_y}</target_y>
+ <source_epsg>{epsg}</source_epsg>
+ <target_epsg>{epsg}</target_epsg>
+ <target_extents>{extents}</target_extents>
+ <vrtnodata>0</vrtnodata>
+ <mrf_nocopy>true</mrf_nocopy>
+ <mrf_merge>{merge}</mrf_merge>
+ <mrf_parallel>{parallel}</mrf_parallel>
+ <mrf_cores>{cores}</mrf_cores>
+</mrfgen_configuration>
+"""
+
+
+def make_granule(filename, kind, epsg, ulx, uly, size, res, rng):
+    """
+    Writes a synthetic PNG granule with a world file: a noisy gradient with a nodata (transparent) corner,
+    so merges have pixels to skip
+    """
+    y, x = np.mgrid[0:size, 0:size]
+    data = ((x + y) * 255 // (2 * size) + rng.integers(0, 16, (size, size))).astype(np.uint8)
+    data[:size // 4, :size // 4] = 0
+    bands = [data] if kind == 'paletted' else [data, np.roll(data, size // 3, axis=1), 255 - data,
+                                                 np.where(data == 0, 0, 255).astype(np.uint8)]
+    mem = gdal.GetDriverByName('MEM').Create('', size, size, len(bands), gdal.GDT_Byte)
+    mem.SetGeoTransform([ulx, res, 0, uly, 0, -res])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(epsg))
+    mem.SetProjection(srs.ExportToWkt())
+    for i, band in enumerate(bands):
+        mem.GetRasterBand(i + 1).WriteArray(band)
+    if kind == 'paletted':
+        colors = gdal.ColorTable()
+        colors.SetColorEntry(0, (0, 0, 0, 0))
+        for i in range(1, 256):
+            colors.SetColorEntry(i, (i, 255 - i, (i * 7) % 256, 255))
+        mem.GetRasterBand(1).SetRasterColorTable(colors)
+    gdal.GetDriverByName('PNG').CreateCopy(filename, mem, 0, ['WORLDFILE=YES'])
+    mem = None
+    return size * size * len(bands)
+
+
+def make_granules(input_dir, epsg, kind, antimeridian, count, size, seed=0):
+    """
+    Writes count granules at random pixel-aligned positions on the target grid; returns their uncompressed bytes
+    """
+    xmin, ymin, xmax, ymax = EXTENTS[epsg]
+    res = (xmax - xmin) / float(TARGET_X)
+    rows = int(round((ymax - ymin) / res))
+    rng = np.random.default_rng(seed) if hasattr(np.random, 'default_rng') else None
+    if rng is None: # numpy < 1.17
+        rng = np.random.RandomState(seed)
+        rng.integers = rng.randint
+    total = 0
+    for i in range(count):
+        if antimeridian: # straddle the antimeridian by a random amount
+            col = TARGET_X - int(rng.integers(size // 8, size - size // 8))
+        else:
+            col = int(rng.integers(0, TARGET_X - size))
+        row = int(rng.integers(0, rows - size))
+        total += make_granule(os.path.join(input_dir, 'granule_{0:04d}.png'.format(i)), kind, epsg,
+                              xmin + col * res, ymax - row * res, size, res, rng)
+    return total
+
+
+def make_empty_tile(filename):
+    mem = gdal.GetDriverByName('MEM').Create('', BLOCKSIZE, BLOCKSIZE, 4, gdal.GDT_Byte)
+    gdal.GetDriverByName('PNG').CreateCopy(filename, mem, 0)
+    mem = None
+
+
+def read_stages(working_dir):
+    """
+    Returns the wall time of each stage from the metrics file mrfgen wrote, if any
+    """
+    for metrics_file in glob.glob(os.path.join(working_dir, '*_metrics.json')):
+        with open(metrics_file) as f:
+            return dict((name, stage['wall_seconds']) for name, stage in json.load(f)['stages'].items())
+    return {}
+
+
+def run_case(mrfgen, base_dir, scenario, mode, cores, input_dir, empty_tile):
+    """
+    Runs mrfgen once in a fresh output and working directory and returns its wall time, exit status and stage times
+    """
+    name, epsg, kind, antimeridian, count, size = scenario
+    run_dir = os.path.join(base_dir, 'run_{0}_{1}_{2}'.format(name, mode, cores))
+    output_dir = os.path.join(run_dir, 'output_dir')
+    working_dir = os.path.join(run_dir, 'working_dir')
+    os.makedirs(output_dir)
+    os.makedirs(working_dir)
+    xmin, ymin, xmax, ymax = EXTENTS[epsg]
+    target_y = int(round(TARGET_X * (ymax - ymin) / float(xmax - xmin)))
+    config = os.path.join(run_dir, 'config.xml')
+    with open(config, 'w') as f:
+        f.write(CONFIG_TEMPLATE.format(name=name, input_dir=input_dir, output_dir=output_dir, working_dir=working_dir,
+                                       empty_tile=empty_tile, blocksize=BLOCKSIZE,
+                                       compression='PPNG' if kind == 'paletted' else 'PNG',
+                                       target_x=TARGET_X, target_y=target_y, epsg=epsg,
+                                       extents=','.join(str(v) for v in EXTENTS[epsg]),
+                                       merge='true' if mode.startswith('merge') else 'false',
+                                       parallel='true' if mode.endswith('parallel') else 'false', cores=cores))
+    start = time.time()
+    process = subprocess.run([mrfgen, '-c', config], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+    wall = time.time() - start
+    if process.returncode != 0:
+        print(process.stdout)
+    return wall, process.returncode, read_stages(working_dir)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change in wall time against a baseline and returns the number of regressions beyond tolerance
+    """
+    previous = dict(((r['scenario'], r['mode'], r['cores']), r) for r in baseline['results'])
+    regressions = 0
+    for r in results:
+        old = previous.get((r['scenario'], r['mode'], r['cores']))
+        if old is None or old['wall_seconds'] <= 0:
+            continue
+        change = r['wall_seconds'] / old['wall_seconds'] - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print("{0:<20} {1:<15} {2:>5} {3:>+8.1%}{4}".format(r['scenario'], r['mode'], r['cores'], change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-o', '--output', action='store', type='string', dest='outfile', default='bench_mrfgen_results.json',
+                      help='Specify JSON output file (default is bench_mrfgen_results.json)')
+    parser.add_option('-b', '--baseline', action='store', type='string', dest='baseline',
+                      help='Compare against a previous results file')
+    parser.add_option('-t', '--tolerance', action='store', type='float', dest='tolerance', default=0.2,
+                      help='Slowdown against the baseline reported as a regression (default is 0.2, i.e. 20%)')
+    parser.add_option('-c', '--cores', action='store', type='string', dest='cores', default='',
+                      help='Comma-separated core counts for the parallel modes (default is 2 and all cores)')
+    parser.add_option('-s', '--scenario', action='append', type='choice', dest='scenarios',
+                      choices=[s[0] for s in SCENARIOS], help='Scenario to run (default is all of them)')
+    parser.add_option('-m', '--mode', action='append', type='choice', dest='modes',
+                      choices=['serial', 'parallel', 'merge', 'merge_parallel'], help='Mode to run (default is all of them)')
+    parser.add_option('--mrfgen', action='store', type='string', dest='mrfgen', default='mrfgen',
+                      help='mrfgen command to benchmark (default is mrfgen)')
+    parser.add_option('--keep', action='store_true', dest='keep', help='Keep the generated granules and MRFs')
+    (options, args) = parser.parse_args()
+
+    if options.cores:
+        core_counts = [int(c) for c in options.cores.split(',')]
+    else:
+        core_counts = sorted(set([2, multiprocessing.cpu_count()]))
+    scenarios = [s for s in SCENARIOS if not options.scenarios or s[0] in options.scenarios]
+    modes = options.modes or ['serial', 'parallel', 'merge', 'merge_parallel']
+
+    base_dir = tempfile.mkdtemp(prefix='bench_mrfgen_')
+    empty_tile = os.path.join(base_dir, 'empty.png')
+    make_empty_tile(empty_tile)
+    results = []
+    try:
+        for scenario in scenarios:
+            name, epsg, kind, antimeridian, count, size = scenario
+            input_dir = os.path.join(base_dir, 'input_' + name) + '/'
+            os.makedirs(input_dir)
+            nbytes = make_granules(input_dir, epsg, kind, antimeridian, count, size)
+            for mode in modes:
+                for cores in (core_counts if mode.endswith('parallel') else [1]):
+                    wall, status, stages = run_case(options.mrfgen, base_dir, scenario, mode, cores, input_dir, empty_tile)
+                    result = {'scenario': name, 'mode': mode, 'cores': cores, 'granules': count,
+                              'megabytes': nbytes / 1e6, 'wall_seconds': wall, 'status': status,
+                              'granules_per_second': count / wall, 'mb_per_second': nbytes / 1e6 / wall,
+                              'stages': stages}
+                    results.append(result)
+                    print("{0:<20} {1:<15} {2:>5} cores {3:>8.1f}s {4:>8.1f} granules/s {5:>8.1f} MB/s{6}".format(
+                        name, mode, cores, wall, result['granules_per_second'], result['mb_per_second'],
+                        '' if status == 0 else '  FAILED'))
+                    if stages:
+                        print('    ' + ', '.join('{0} {1:.1f}s'.format(stage, seconds) for stage, seconds in
+                                                 sorted(stages.items(), key=lambda s: -s[1]) if seconds >= 0.05))
+    finally:
+        if options.keep:
+            print('Leaving benchmark data in ' + base_dir)
+        else:
+            shutil.rmtree(base_dir)
+
+    with open(options.outfile, 'w') as f:
+        json.dump({'host': {'cpus': multiprocessing.cpu_count(), 'gdal': gdal.__version__, 'numpy': np.__version__},
+                   'results': results}, f, indent=2, sort_keys=True)
+    print('\nStoring benchmark results in "{0}"'.format(options.outfile))
+
+    failed = len([r for r in results if r['status'] != 0])
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        print('\nChange in wall time against ' + options.baseline)
+        failed += compare(results, baseline, options.tolerance)
+    sys.exit(1 if failed else 0)
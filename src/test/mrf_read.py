@@ -38,8 +38,7 @@ from optparse import OptionParser
 from xml.dom import minidom
 import os
 import sys
-import struct
-import math
+from mrf_index import MRFIndex
 
 versionNumber = '1.0'
     
@@ -159,122 +158,66 @@ if tile == None and str(options.tilematrix) == "None":
     else:
         size = options.size
     
-if options.endian == True:
-    data_type = '<q'
-else:
-    data_type = '>q'
-  
 if str(options.zlevel) == "None":
-    z = -1
-    z_size = None
+    z = 0
     if mrf_z:
         print("Error: z-level must be specified for this input")
         exit(1)
 else:
     z = options.zlevel
-    z_size = mrf_z
     if options.verbose:
-        print("Using z-level:" + str(z) + " and MRF z-size:" + str(z_size))
-    if z >= z_size:
+        print("Using z-level:" + str(z) + " and MRF z-size:" + str(mrf_z))
+    if z >= mrf_z:
         print("Error: Specified z-level is greater than the maximum size")
         exit(1)
-    
-w = int(math.ceil(float(mrf_x)/512))
-h = int(math.ceil(float(mrf_y)/512))
-if z >= 0:
-    len_base = w * h * z_size
-    low = z_size
-else:
-    len_base = w * h
-    low = 1
-idx_size = os.path.getsize(index)
-len_tiles = idx_size/16
+
+mrf_index = MRFIndex(input, little_endian=options.endian)
+levels = mrf_index.levels
 
 if options.verbose:
-    print("Number of tiles " + str(len_tiles))
+    print("Number of tiles " + str(len(mrf_index.records)))
     print("\n--Pyramid structure--")
-
-levels = []
-rows = []
-cols = []
-
-levels.append(0)
-rows.append(h)
-cols.append(w)
-
-while len_base > low:
-    levels.append(len_base)
-    w = int(math.ceil(w / 2.0))
-    h = int(math.ceil(h / 2.0))
-    if z >= 0:
-        len_base = w * h * z_size
-    else:
-        len_base = w * h
-    rows.append(h)
-    cols.append(w)
-    
-if z >= 0:
-    levels.append(1*z_size)
-else:
-    levels.append(1)
-
-if options.verbose:   
-    for idx, val in enumerate(levels):
-        if idx > 0: 
-            print("Level " + str(len(levels)-idx-1) + ": " + str(levels[idx]) + " tiles, " + str(rows[idx-1]) + " rows, " + str(cols[idx-1]) + " columns")
+    for level in reversed(range(len(levels))):
+        print("Level " + str(len(levels)-level-1) + ": " + str(levels[level].count) + " tiles, " + str(levels[level].rows) + " rows, " + str(levels[level].cols) + " columns")
     print("\n")
 
 if options.tilematrix != None:
     if options.tilerow == None or options.tilecol == None:
         parser.error('tilerow and tilecol not provided. --tilecol INT and --tilerow INT must be specified when using MRF file.')
-    tilematrix = options.tilematrix + 2
-    level = levels[len(levels)-tilematrix]
-    row = rows[len(levels)-tilematrix]
-    col = cols[len(levels)-tilematrix]
-    
+    # tilematrix 0 is the coarsest level, which is the last one in the index
+    level = len(levels) - 1 - options.tilematrix
+    row = levels[level].rows
+    col = levels[level].cols
+
     if options.verbose:
         message = "Looking up tilematrix level:" + str(options.tilematrix) + ", tile row:" + str(options.tilerow) + ", tile col:" + str(options.tilecol)
-        if z >= 0:
+        if mrf_z:
             message = message + ", z-level:" + str(z)
         print(message)
         print("Level contains " + str(row) + " rows, " + str(col) + " columns")
-    
+
     if (options.tilerow) > row-1:
         print("Tile row exceeds the maximum (" + str(row-1) + ") for this level")
         exit(1)
     if (options.tilecol) > col-1:
         print("Tile col exceeds the maximum (" + str(col-1) + ") for this level")
         exit(1)
-      
-    level_start = 0
-    for idx, val in enumerate(levels):
-        if levels[idx-1]==level:
-            break
-        level_start+=val
-    tile = ((options.tilerow) * col) + options.tilecol + level_start
-    if z >= 0:
-        level_size = (levels[len(levels)-tilematrix+1]/z_size)
-        tile = tile + (z * level_size) 
-    
+
+    tile = mrf_index.position(level, options.tilerow, options.tilecol, z)
+
     if options.verbose:
-        print("Tiles for level begin at: " + str(level_start+1))
+        print("Tiles for level begin at: " + str(levels[level].start+1))
         print("Using tile: " + str(tile+1))
-    
-if index != None and tile != None:
+
+if tile != None:
     if options.verbose:
         print("\nReading " + index)
-    idx = open(index, 'rb')
-    
-    idx.seek(16*tile)
-    byte = idx.read(16)
-    offset = struct.unpack(data_type, byte[0:8])[0]
-    size = struct.unpack(data_type, byte[8:16])[0]
-    idx.close() 
-    
-    if options.verbose: 
+    offset, size = mrf_index.record(tile)
+
+    if options.verbose:
         print("Read from index at offset " + str(16*tile) + " for 16 bytes")
         print("Got data file offset " + str(offset) + ", size " + str(size))
-   
+
 
 if options.verbose:
     print("\nReading " + datafile)   
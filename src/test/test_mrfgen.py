@@ -22,10 +22,14 @@ import sys
 import unittest2 as unittest
 import xmlrunner
 import filecmp
+import glob
+import json
 import shutil
+import struct
 import datetime
 import sqlite3
-from osgeo import gdal
+from osgeo import gdal, osr
+from mrf_index import MRFIndex, hilbert_keys, open_index
 from optparse import OptionParser
 from io import StringIO
 from oe_test_utils import DebuggingServerThread, make_dir_tree, mrfgen_run_command as run_command
@@ -1513,6 +1517,569 @@ class TestMRFGeneration_mixed_projections(unittest.TestCase):
         else:
             print("Leaving test results in : " + self.staging_area)
 
+class TestMRFGeneration_resume(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config8.xml")
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'mixed_projections')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/sst2019231_.mrf")
+        self.output_img = os.path.join(self.staging_area, "output_dir/sst2019231_.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp8.png")
+
+        # Leave a journal from a run with a different configuration, which --resume must not pick up
+        self.journal = os.path.join(self.staging_area, "working_dir/sst_20190819_mrfgen_journal.jsonl")
+        with open(self.journal, 'w') as f:
+            f.write('{"basename": "sst_20190819___mrfgen_stale", "config": "stale", "event": "start"}\n')
+            f.write('{"event": "stage", "stage": "create", "target_x": "2048", "target_y": "1024", "vrtf": "0"}\n')
+
+        # generate MRF
+        print("mrfgen -c " + test_config + " --resume")
+        run_command("mrfgen -c " + test_config + " --resume")
+
+    def test_generate_mrf_resume(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # The journal is removed once the run succeeds
+        self.assertFalse(os.path.isfile(self.journal), "Journal was not removed after a successful run")
+
+        # Convert and compare MRF
+        mrf = gdal.Open(self.output_mrf)
+        driver = gdal.GetDriverByName("PNG")
+        img = driver.CreateCopy(self.output_img, mrf, 0 )
+
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue(filecmp.cmp(self.output_img, self.compare_img), "Output image does not match")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_batch(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config8.xml")
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'mixed_projections')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/sst2019231_.mrf")
+        self.output_img = os.path.join(self.staging_area, "output_dir/sst2019231_.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp8.png")
+
+        # generate MRF from a batch worker process
+        print("mrfgen_batch.py -w 2 " + test_config)
+        run_command("mrfgen_batch.py -w 2 " + test_config)
+
+    def test_generate_mrf_batch(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # Check the stage metrics were written next to the log (logfile_dir defaults to the working_dir)
+        metrics_files = glob.glob(os.path.join(self.staging_area, "working_dir/*_metrics.json"))
+        self.assertEqual(len(metrics_files), 1, "Stage metrics were not written")
+        with open(metrics_files[0]) as f:
+            stages = json.load(f)['stages']
+        self.assertTrue('insert' in stages and stages['insert_granule']['count'] > 0, "Insert metrics are missing")
+
+        # Convert and compare MRF
+        mrf = gdal.Open(self.output_mrf)
+        driver = gdal.GetDriverByName("PNG")
+        img = driver.CreateCopy(self.output_img, mrf, 0 )
+
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue(filecmp.cmp(self.output_img, self.compare_img), "Output image does not match")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_dedup(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config13.xml")
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'mixed_projections')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/sst2019231_.mrf")
+        self.output_img = os.path.join(self.staging_area, "output_dir/sst2019231_.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp8.png")
+
+        self.output_idx = os.path.join(self.staging_area, "output_dir/sst2019231_.idx")
+        self.output_data = os.path.join(self.staging_area, "output_dir/sst2019231_.ppg")
+
+        # generate MRF
+        print("mrfgen -c " + test_config)
+        run_command("mrfgen -c " + test_config)
+
+    def test_generate_mrf_dedup(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # Every distinct tile must be stored only once
+        with open(self.output_idx, 'rb') as f:
+            index = f.read()
+        records = set(struct.unpack('!QQ', index[i:i + 16]) for i in range(0, len(index), 16))
+        with open(self.output_data, 'rb') as f:
+            data = f.read()
+        tiles = [data[offset:offset + size] for offset, size in records if size > 0]
+        self.assertEqual(len(tiles), len(set(tiles)), "Identical tiles are stored more than once")
+
+        # Convert and compare MRF
+        mrf = gdal.Open(self.output_mrf)
+        driver = gdal.GetDriverByName("PNG")
+        img = driver.CreateCopy(self.output_img, mrf, 0 )
+
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue(filecmp.cmp(self.output_img, self.compare_img), "Output image does not match")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_partitions(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config8.xml")
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'mixed_projections')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/sst2019231_.mrf")
+        self.output_img = os.path.join(self.staging_area, "output_dir/sst2019231_.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp8.png")
+
+        # generate two partial MRFs and combine them
+        partials = []
+        for part in ("1/2", "2/2"):
+            print("mrfgen -c " + test_config + " --partition " + part)
+            run_command("mrfgen -c " + test_config + " --partition " + part)
+            partials.append(os.path.join(self.staging_area, "output_dir/sst2019231__part{0}of2.mrf".format(part[0])))
+        empty_tile = os.path.join(self.staging_area, 'empty_tiles/Blank_RGBA_256.png')
+        cmd = "mrf_combine.py -p {0} -o {1} {2}".format(os.path.getsize(empty_tile), self.output_mrf, " ".join(partials))
+        print(cmd)
+        run_command(cmd)
+
+    def test_generate_mrf_partitions(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        for partial in ("sst2019231__part1of2.mrf", "sst2019231__part2of2.mrf"):
+            self.assertTrue(os.path.isfile(os.path.join(self.staging_area, "output_dir", partial)),
+                            "Partial MRF generation failed")
+
+        # Convert and compare MRF
+        mrf = gdal.Open(self.output_mrf)
+        driver = gdal.GetDriverByName("PNG")
+        img = driver.CreateCopy(self.output_img, mrf, 0 )
+
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue(filecmp.cmp(self.output_img, self.compare_img), "Output image does not match")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_compact(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config14.xml")
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'mixed_projections')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/sst2019231_.mrf")
+        self.output_img = os.path.join(self.staging_area, "output_dir/sst2019231_.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp8.png")
+
+        self.output_idx = os.path.join(self.staging_area, "output_dir/sst2019231_.idx")
+        self.output_data = os.path.join(self.staging_area, "output_dir/sst2019231_.ppg")
+
+        # generate MRF
+        print("mrfgen -c " + test_config)
+        run_command("mrfgen -c " + test_config)
+
+    def test_generate_mrf_compact(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        self.assertFalse(os.path.isfile(os.path.join(self.staging_area, "output_dir/sst2019231_.compacting")),
+                         "Compaction did not finish")
+
+        # Every other byte of the data file must be referenced by the index
+        with open(self.output_idx, 'rb') as f:
+            index = f.read()
+        records = set(struct.unpack('!QQ', index[i:i + 16]) for i in range(0, len(index), 16))
+        # the empty tile that seeded the data file is always kept
+        live = set(range(os.path.getsize(os.path.join(self.staging_area, 'empty_tiles/Blank_RGBA_256.png'))))
+        for offset, size in records:
+            live.update(range(offset, offset + size))
+        self.assertEqual(len(live), os.path.getsize(self.output_data), "Data file has unreferenced bytes")
+
+        # Convert and compare MRF
+        mrf = gdal.Open(self.output_mrf)
+        driver = gdal.GetDriverByName("PNG")
+        img = driver.CreateCopy(self.output_img, mrf, 0 )
+
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue(filecmp.cmp(self.output_img, self.compare_img), "Output image does not match")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_layout(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config15.xml")
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'mixed_projections')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/sst2019231_.mrf")
+        self.output_img = os.path.join(self.staging_area, "output_dir/sst2019231_.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp8.png")
+
+        # generate MRF
+        print("mrfgen -c " + test_config)
+        run_command("mrfgen -c " + test_config)
+
+    def test_generate_mrf_layout(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # The tiles of each level must be stored in Hilbert curve order
+        index = MRFIndex(self.output_mrf)
+        prefix = os.path.getsize(os.path.join(self.staging_area, 'empty_tiles/Blank_RGBA_256.png'))
+        for level in range(len(index.levels)):
+            records = index.level_records(level)[0, :, :, 0]
+            order = hilbert_keys(*records.shape).ravel().argsort()
+            offsets = [int(offset) for offset in records['offset'].ravel()[order] if offset >= prefix]
+            self.assertEqual(offsets, sorted(offsets), "Level {0} is not in Hilbert order".format(level))
+
+        # Convert and compare MRF
+        mrf = gdal.Open(self.output_mrf)
+        driver = gdal.GetDriverByName("PNG")
+        img = driver.CreateCopy(self.output_img, mrf, 0 )
+
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue(filecmp.cmp(self.output_img, self.compare_img), "Output image does not match")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_coalesce(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config16.xml")
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'mixed_projections')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/sst2019231_.mrf")
+        self.output_img = os.path.join(self.staging_area, "output_dir/sst2019231_.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp8.png")
+
+        # generate MRF
+        print("mrfgen -c " + test_config)
+        run_command("mrfgen -c " + test_config)
+
+    def test_generate_mrf_coalesce(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # Inserting granules as mosaics must give the same image as inserting them one by one
+        mrf = gdal.Open(self.output_mrf)
+        driver = gdal.GetDriverByName("PNG")
+        img = driver.CreateCopy(self.output_img, mrf, 0 )
+
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue(filecmp.cmp(self.output_img, self.compare_img), "Output image does not match")
+
+        # No mosaic VRTs are left behind
+        self.assertEqual(glob.glob(os.path.join(self.staging_area, 'working_dir', '*_mosaic.vrt')), [],
+                         "Mosaic VRTs were not removed")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_coalesce_parallel(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config18.xml")
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        # The two adjacent granules share a 1024 pixel MRF block and become one mosaic; a copy of the first one,
+        # moved to another block, is a second region so the mosaic is inserted by a parallel worker
+        input_dir = os.path.join(self.staging_area, 'input_dir')
+        shutil.copytree(os.path.join(testdata_path, 'MORCR143LLDY'), input_dir)
+        self.granules = [os.path.join(input_dir, "MODIS_Terra_CorrectedReflectance_TrueColor_{0}.jpg".format(i)) for i in range(3)]
+        shutil.copy2(self.granules[0], self.granules[2])
+        with open(os.path.join(input_dir, "MODIS_Terra_CorrectedReflectance_TrueColor_2.wld"), 'w') as f:
+            f.write("0.0175781250\n0.0000000000\n0.0000000000\n-0.0175781250\n9.0087890625\n-9.0087890625\n")
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/MORCR143LLDY2014277_.mrf")
+
+        # generate MRF
+        print("mrfgen -c " + test_config)
+        run_command("mrfgen -c " + test_config)
+
+    def test_generate_mrf_coalesce_parallel(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # The granules are at the MRF resolution, so each one is copied to its pixel window unchanged
+        mrf = gdal.Open(self.output_mrf)
+        for granule, (x, y) in zip(self.granules, [(5120, 2560), (5632, 2560), (10752, 5632)]):
+            img = gdal.Open(granule)
+            self.assertTrue(mrf.ReadRaster(x, y, img.RasterXSize, img.RasterYSize) == img.ReadRaster(),
+                            "{0} does not match the MRF".format(granule))
+            img = None
+
+        # No mosaic VRTs are left behind
+        self.assertEqual(glob.glob(os.path.join(self.staging_area, 'working_dir', '*_mosaic.vrt')), [],
+                         "Mosaic VRTs were not removed")
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_direct(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config17.xml")
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        self.input_img = os.path.join(testdata_path, "bluemarble_small/bluemarble_small.jpg")
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/bluemarble2014277_.mrf")
+        self.output_ppg = os.path.join(self.staging_area, "output_dir/bluemarble2014277_.ppg")
+        self.output_idx = os.path.join(self.staging_area, "output_dir/bluemarble2014277_.idx")
+
+        # generate MRF
+        print("mrfgen -c " + test_config)
+        run_command("mrfgen -c " + test_config)
+
+    def test_generate_mrf_direct(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # The global granule is at the MRF resolution, so the base level is a lossless copy of it
+        mrf = gdal.Open(self.output_mrf)
+        img = gdal.Open(self.input_img)
+        self.assertEqual((mrf.RasterXSize, mrf.RasterYSize), (img.RasterXSize, img.RasterYSize), "Size does not match")
+        self.assertTrue(mrf.ReadRaster() == img.ReadRaster(), "Base level does not match the input")
+
+        # Every tile was written once, so the data file holds nothing but the seeded empty tile and indexed tiles
+        prefix = os.path.getsize(os.path.join(self.staging_area, 'empty_tiles/Blank_RGBA_512.png'))
+        index = open_index(self.output_idx)
+        tiles = set((int(offset), int(size)) for offset, size in zip(index['offset'], index['size']) if size > 0)
+        self.assertEqual(os.path.getsize(self.output_ppg), prefix + sum(size for _, size in tiles),
+                         "Data file has unreferenced bytes")
+
+        img = None
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+class TestMRFGeneration_epng(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+        test_config = os.path.join(testdata_path, "mrfgen_test_config19.xml")
+
+        # Make empty dirs for mrfgen output
+        mrfgen_dirs = ('input_dir', 'output_dir', 'working_dir', 'logfile_dir')
+        [make_dir_tree(os.path.join(self.staging_area, path)) for path in mrfgen_dirs]
+
+        # Copy empty output tile
+        shutil.copytree(os.path.join(testdata_path, 'empty_tiles'), os.path.join(self.staging_area, 'empty_tiles'))
+
+        # Two adjacent Float32 granules at the MRF resolution with value ranges far apart, so that packing each
+        # one with its own scale and offset would encode them differently
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        self.granules = []
+        for i in range(2):
+            granule = os.path.join(self.staging_area, 'input_dir', "epng_granule_{0}.tif".format(i))
+            ds = gdal.GetDriverByName('GTiff').Create(granule, 512, 512, 1, gdal.GDT_Float32)
+            ds.SetGeoTransform([9.0 * i, 0.017578125, 0, 9.0, 0, -0.017578125])
+            ds.SetProjection(srs.ExportToWkt())
+            values = [1000.0 * i + (x + y) * 0.125 for y in range(512) for x in range(512)]
+            ds.GetRasterBand(1).WriteRaster(0, 0, 512, 512, struct.pack('<{0}f'.format(len(values)), *values))
+            ds = None
+            self.granules.append(granule)
+
+        self.output_mrf = os.path.join(self.staging_area, "output_dir/EPNGTEST2014277_.mrf")
+
+        # generate MRF
+        print("mrfgen -c " + test_config)
+        run_command("mrfgen -c " + test_config)
+
+    def test_generate_mrf_epng(self):
+        # Check MRF generation succeeded
+        self.assertTrue(os.path.isfile(self.output_mrf), "MRF generation failed")
+
+        # Both granules are packed with the scale and offset of the range of all the values, 0 to 1127.75
+        offset = 0
+        scale = (2 ** 24 - 1) // 1127.75
+        mrf = gdal.Open(self.output_mrf)
+        for i, granule in enumerate(self.granules):
+            for x, y in [(0, 0), (100, 300), (511, 511)]:
+                packed = mrf.ReadRaster(10240 + 512 * i + x, 4608 + y, 1, 1, band_list=[1, 2, 3])
+                value = (packed[0] + (packed[1] << 8) + (packed[2] << 16)) / scale + offset
+                expected = 1000.0 * i + (x + y) * 0.125
+                self.assertAlmostEqual(value, expected, delta=1.0 / scale,
+                                       msg="{0} does not decode to its value at {1},{2}".format(granule, x, y))
+        mrf = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
 class TestMRFGeneration_antimeridian_crossing(unittest.TestCase):
     
     def setUp(self):
@@ -1811,6 +2378,50 @@ class TestRGBA2Pal(unittest.TestCase):
             print("Leaving test results in : " + self.staging_area)
 
 
+class TestMRFPalette(unittest.TestCase):
+
+    def setUp(self):
+        testdata_path = os.path.join(os.getcwd(), 'mrfgen_files')
+        self.staging_area = os.path.join(os.getcwd(), 'mrfgen_test_data')
+
+        # Make source image dir
+        input_dir = os.path.join(testdata_path, 'AIRS')
+        make_dir_tree(os.path.join(input_dir), ignore_existing=True)
+
+        # Make empty dir for output
+        make_dir_tree(os.path.join(self.staging_area, 'output_dir'))
+
+        self.output_img = os.path.join(self.staging_area, "output_dir/AIRS_L2_SST_A_LL_v6_NRT_2019344_indexed.png")
+        self.compare_img = os.path.join(testdata_path, "test_comp11.png")
+
+        # generate indexed PNG image
+        cmd = "mrf_palette.py -c " + testdata_path + "/colormaps/AIRS_Temperature.xml -f 0 -o " + self.output_img + " " + input_dir + "/AIRS_L2_SST_A_LL_v6_NRT_2019344.png"
+        print(cmd)
+        run_command(cmd)
+
+    def test_mrf_palette(self):
+        # Check the indexes and palette match the RGBApng2Palpng output
+        self.assertTrue(os.path.isfile(self.output_img), "Indexed PNG generation failed")
+        output = gdal.Open(self.output_img)
+        compare = gdal.Open(self.compare_img)
+        if DEBUG:
+            print("Comparing: " + self.output_img + " to " + self.compare_img)
+        self.assertTrue((output.ReadAsArray() == compare.ReadAsArray()).all(), "Output indexes do not match")
+        output_table = output.GetRasterBand(1).GetColorTable()
+        compare_table = compare.GetRasterBand(1).GetColorTable()
+        self.assertEqual([output_table.GetColorEntry(i) for i in range(output_table.GetCount())],
+                         [compare_table.GetColorEntry(i) for i in range(output_table.GetCount())],
+                         "Output palette does not match")
+        output = None
+        compare = None
+
+    def tearDown(self):
+        if not SAVE_RESULTS:
+            shutil.rmtree(self.staging_area)
+        else:
+            print("Leaving test results in : " + self.staging_area)
+
+
 if __name__ == '__main__':
     # Parse options before running tests
     available_tests = {
@@ -1828,7 +2439,18 @@ if __name__ == '__main__':
         'email_notification': TestMRFGeneration_email_notification,
         'mixed_projections': TestMRFGeneration_mixed_projections,
         'antimeridian_crossing': TestMRFGeneration_antimeridian_crossing,
+        'resume': TestMRFGeneration_resume,
+        'batch': TestMRFGeneration_batch,
+        'dedup': TestMRFGeneration_dedup,
+        'compact': TestMRFGeneration_compact,
+        'partitions': TestMRFGeneration_partitions,
+        'layout': TestMRFGeneration_layout,
+        'coalesce': TestMRFGeneration_coalesce,
+        'coalesce_parallel': TestMRFGeneration_coalesce_parallel,
+        'direct': TestMRFGeneration_direct,
+        'epng': TestMRFGeneration_epng,
         'rgba2pal': TestRGBA2Pal,
+        'mrf_palette': TestMRFPalette,
         'jpng': TestMRFGeneration_jpng,
         'zenjpeg': TestMRFGeneration_zenjpeg
     }
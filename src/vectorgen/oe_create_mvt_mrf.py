@@ -37,7 +37,6 @@ or by using the create_vector_mrf() function in another script.
 
 import os
 import sys
-import struct
 import io
 import gzip
 import xml.dom.minidom
@@ -51,6 +50,7 @@ from osgeo import osr
 import decimal
 import re
 from oe_utils import *
+from mrf_index import make_records, write_index
 
 
 # Main tile-creation function.
@@ -119,11 +119,11 @@ def create_vector_mrf(input_file_path,
     tile_matrices = get_tms(target_x, target_y, target_extents, tile_size,
                             overview_levels, proj)
 
-    # Open MRF data and index files and generate the MRF XML
-    fidx = open(os.path.join(output_path, mrf_prefix + '.idx'), 'wb+')
+    # Open the MRF data file and generate the MRF XML. Index records are collected and written once at the end.
     fout = open(os.path.join(output_path, mrf_prefix + '.pvt'), 'wb+')
-    notile = struct.pack('!QQ', 0, 0)
     pvt_offset = 0
+    tile_offsets = []
+    tile_sizes = []
 
     mrf_dom = build_mrf_dom(tile_matrices, target_extents, tile_size, proj)
     with open(os.path.join(output_path, mrf_prefix) + '.mrf', 'w+') as f:
@@ -302,20 +302,20 @@ def create_vector_mrf(input_file_path,
                     gzip_obj.write(mvt_tile)
                     gzip_obj.close()
                     zipped_tile_data = out.getvalue()
-                    tile_index = struct.pack('!QQ', pvt_offset,
-                                             len(zipped_tile_data))
+                    tile_offsets.append(pvt_offset)
+                    tile_sizes.append(len(zipped_tile_data))
                     pvt_offset += len(zipped_tile_data)
                     fout.write(zipped_tile_data)
 
                 else:
-                    tile_index = notile
-                fidx.write(tile_index)
+                    tile_offsets.append(0)
+                    tile_sizes.append(0)
 
         if debug:
             print(("Z-Level (" + str(z) + ") Tile Filtering - Orig: {0} / Reduced: {1} / Filtered: {2}".
                   format(z_orig_features, z_rdct_features, z_fltr_features)))
-    fidx.close()
     fout.close()
+    write_index(os.path.join(output_path, mrf_prefix + '.idx'), make_records(tile_offsets, tile_sizes))
 
     return True
 